@@ -0,0 +1,129 @@
+#!venv/bin/python3
+# compares a multi-student homework run three ways: one student at a time
+# on the sync psycopg2 layer, --concurrency threads on the sync layer with a
+# connection each (the way run_batch in codeabode_headless.py runs `run
+# --parallel`), and --concurrency students in flight on the async layer. the
+# threaded run gets the same overlap of model latency as the async one, so
+# the two of them compare the layers, and the sequential run shows what the
+# overlap itself is worth.
+#
+# the model call is simulated with a sleep so runs are repeatable, and every
+# write is rolled back, so this is safe to point at a real database.
+#
+# usage: ./bench-async.py [--students N] [--latency SECONDS] [--concurrency N]
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sys import argv
+
+import dotenv
+import psycopg2
+
+import codeabode_db
+import codeabode_db_async
+from codeabode_model import CompletedClass
+
+dotenv.load_dotenv(override=True)
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+students = flag("--students", 20)
+latency = flag("--latency", 2.0)
+concurrency = flag("--concurrency", 8)
+
+analysis = CompletedClass(notes="benchmark", taught_methods=None, needs_practice=None)
+
+conn = psycopg2.connect(os.getenv("DB_URL"))
+cur = conn.cursor()
+cur.execute(
+    "SELECT id, version FROM students WHERE current_class IS NOT NULL ORDER BY id LIMIT %s",
+    (students,)
+)
+versions = dict(cur.fetchall())
+student_ids = list(versions)
+conn.rollback()
+
+if not student_ids:
+    print("No students with a current class to benchmark against")
+    exit()
+
+print(f"{len(student_ids)} students, {latency}s simulated model latency")
+
+started = time.perf_counter()
+for student_id in student_ids:
+    current_class = codeabode_db.get_current_class(cur, student_id)
+    time.sleep(latency)
+    codeabode_db.save_homework(cur, student_id, versions[student_id], analysis, "benchmark homework")
+    conn.rollback()
+sequential = time.perf_counter() - started
+
+cur.close()
+conn.close()
+
+print(f"sync, one student at a time: {sequential:.2f}s")
+
+
+def run_threaded():
+    # the same shape as run_batch: a connection per thread, opened on first use
+    local = threading.local()
+    connections = []
+
+    def run(student_id):
+        if not hasattr(local, "conn"):
+            local.conn = psycopg2.connect(os.getenv("DB_URL"))
+            connections.append(local.conn)
+        with local.conn.cursor() as cur:
+            codeabode_db.get_current_class(cur, student_id)
+            local.conn.commit()
+            time.sleep(latency)
+            codeabode_db.save_homework(cur, student_id, versions[student_id], analysis, "benchmark homework")
+            local.conn.rollback()
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, student_ids))
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+started = time.perf_counter()
+run_threaded()
+threaded = time.perf_counter() - started
+
+print(f"sync, {concurrency} threads: {threaded:.2f}s")
+
+
+async def generate(context):
+    await asyncio.sleep(latency)
+    return "benchmark homework"
+
+
+async def store(cur, student_id, hw):
+    return await codeabode_db_async.save_homework(cur, student_id, versions[student_id], analysis, hw)
+
+
+async def main():
+    async with codeabode_db_async.connect_pool(os.getenv("DB_URL"), concurrency) as pool:
+        started = time.perf_counter()
+        results = await codeabode_db_async.run_pipeline(
+            pool, student_ids, codeabode_db_async.get_current_class,
+            generate, store, concurrency=concurrency, commit=False
+        )
+        return results, time.perf_counter() - started
+
+
+results, overlapped = asyncio.run(main())
+
+failures = [r for r in results if isinstance(r[1], Exception)]
+for student_id, error, _ in failures:
+    print(f"student {student_id} failed: {error}")
+
+print(f"async, {concurrency} in flight: {overlapped:.2f}s")
+print(f"speedup over one at a time: {sequential / threaded:.1f}x threaded, {sequential / overlapped:.1f}x async")
+print(f"async against threaded: {threaded / overlapped:.2f}x")
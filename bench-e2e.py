@@ -0,0 +1,150 @@
+#!venv/bin/python3
+# end to end benchmark of the real codeabode.py flows against ./mock-gemini.py
+# and the Postgres at DB_URL, so the whole path (startup, prompts, SDK,
+# database) can be timed repeatably without a Gemini key.
+#
+# it creates --students students with `run new --commit`, then for each
+# cycle writes their homework with `batch-homework`, refines the curriculum
+# with `run refine --commit` and writes the next classwork with `run
+# classwork --commit`. each phase is timed as a whole, and the `run` phases
+# per student too. the students are deleted afterwards unless --keep.
+#
+# usage: ./bench-e2e.py [--students N] [--cycles N] [--parallel N] [--latency DIST]
+#            [--errors CODE=RATE,...] [--seed N] [--keep]
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from sys import argv
+
+import dotenv
+import psycopg2
+
+dotenv.load_dotenv(override=True)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLI = os.path.join(HERE, "codeabode.py")
+PREFIX = "bench-e2e-"
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(port):
+    mock = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock-gemini.py"), "--port", str(port),
+         "--latency", flag("--latency", "lognormal:1.0,0.5"), "--errors", flag("--errors", ""),
+         "--seed", str(flag("--seed", 0))],
+        stdout=subprocess.PIPE, text=True
+    )
+    # it prints once it's listening
+    print(mock.stdout.readline().strip())
+    return mock
+
+
+def cli(env, *args, requests=None):
+    """
+    Run codeabode.py, with JSON lines on stdin if requests are given.
+
+    Returns:
+        (seconds, exit code, stdout)
+    """
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, CLI, *args], env=env, capture_output=True, text=True,
+        input="".join(json.dumps(request) + "\n" for request in requests or [])
+    )
+    if proc.returncode and proc.stderr:
+        print(proc.stderr.strip()[-2000:])
+    return time.perf_counter() - started, proc.returncode, proc.stdout
+
+
+def report(phase, elapsed, results=None):
+    if results is None:
+        print(f"{phase:<12} {elapsed:>7.1f}s")
+        return
+
+    failed = [result for result in results if not result["ok"]]
+    totals = sorted(result["timings"]["total"] for result in results) or [0]
+    model = sum(result["timings"].get("model", 0) for result in results)
+    db = sum(result["timings"].get("db", 0) for result in results)
+    print(f"{phase:<12} {elapsed:>7.1f}s  {len(results) - len(failed)} ok, {len(failed)} failed, "
+          f"median {totals[len(totals) // 2]:.2f}s, max {totals[-1]:.2f}s per student, "
+          f"model {model:.1f}s, db {db:.2f}s")
+    for result in failed[:3]:
+        print(f"    {result['error']}")
+
+
+def run_phase(env, phase, step, requests):
+    elapsed, _, out = cli(env, "run", step, "--commit", requests=requests)
+    results = [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+    report(phase, elapsed, results)
+    return results
+
+
+students = flag("--students", 10)
+cycles = flag("--cycles", 2)
+parallel = flag("--parallel", 4)
+
+port = free_port()
+mock = start_mock(port)
+
+env = {
+    **os.environ,
+    "GEMINI_BASE_URL": f"http://127.0.0.1:{port}",
+    "GEMINI_API_KEY": "mock",
+    # never hand the commands to a warm daemon, its client talks to the real API
+    "CODEABODE_SOCKET": os.path.join(tempfile.gettempdir(), f"bench-e2e-{os.getpid()}.sock"),
+}
+
+print(f"{students} students, {cycles} cycle(s), homework {parallel} at a time\n")
+started = time.perf_counter()
+
+try:
+    results = run_phase(env, "new", "new", [
+        {"info": f"Age 1{i % 6}. Knows print and variables, wants to make a platformer.",
+         "name": f"{PREFIX}{i}", "age": 10 + i % 6, "teacher_notes": "Start with conditionals."}
+        for i in range(students)
+    ])
+    student_ids = [result["result"]["student"] for result in results if result["ok"]]
+
+    for cycle in range(1, cycles + 1):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({str(student_id): "Went well, needed help with elif." for student_id in student_ids}, f)
+
+        try:
+            elapsed, code, _ = cli(env, "batch-homework", f.name, "--parallel", str(parallel))
+        finally:
+            os.unlink(f.name)
+        report(f"homework {cycle}", elapsed)
+
+        run_phase(env, f"refine {cycle}", "refine",
+                  [{"student": student_id, "hw_notes": "Finished days 1-4."} for student_id in student_ids])
+        run_phase(env, f"classwork {cycle}", "classwork",
+                  [{"student": student_id, "teacher_notes": ""} for student_id in student_ids])
+
+    print(f"\n{'total':<12} {time.perf_counter() - started:>7.1f}s")
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        print(f"mock: {json.load(response)}")
+finally:
+    mock.terminate()
+    mock.wait()
+
+    if "--keep" not in argv:
+        # drafts, emails and classes go with the students
+        conn = psycopg2.connect(os.getenv("DB_URL"))
+        with conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM students WHERE name LIKE %s", (PREFIX + "%",))
+            print(f"Deleted {cur.rowcount} benchmark students")
+        conn.close()
@@ -0,0 +1,91 @@
+#!venv/bin/python3
+# startup time of the CLI: how long `help` takes to finish and how long
+# `continue` takes to show the student picker, against a time budget, plus
+# the slowest imports on each path from `python -X importtime`.
+#
+# the picker run connects to DB_URL (it only reads) and is stopped at the
+# first prompt.
+#
+# usage: ./bench-startup.py [--runs N] [--budget MS] [--top N]
+import os
+import re
+import subprocess
+import sys
+import time
+from sys import argv
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codeabode.py")
+
+# "import time: self [us] | cumulative | imported package"
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+def run_help(python_args=()):
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, *python_args, CLI, "help"],
+                          capture_output=True, text=True)
+    return time.perf_counter() - started, proc.stderr
+
+
+def run_picker(python_args=()):
+    """
+    Seconds until the picker's search prompt is on screen, and stderr.
+    """
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, *python_args, CLI, "continue"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, text=True)
+
+    # the prompt has no newline, so read a character at a time
+    seen = ""
+    while "Search students" not in seen:
+        char = proc.stdout.read(1)
+        if not char:
+            break
+        seen += char
+    elapsed = time.perf_counter() - started
+
+    proc.kill()
+    _, err = proc.communicate()
+
+    if "Search students" not in seen:
+        print(f"picker never showed up:\n{seen}{err}")
+        exit(1)
+
+    return elapsed, err
+
+
+def slowest_imports(stderr, top):
+    """
+    The top-level imports (what the CLI itself imported) by cumulative time.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        # nested imports are indented under the module that pulled them in
+        if match and match.group(3) == "":
+            imports.append((int(match.group(2)), match.group(4)))
+
+    return sorted(imports, reverse=True)[:top]
+
+
+runs = flag("--runs", 5)
+budget = flag("--budget", 100.0)
+top = flag("--top", 8)
+over = False
+
+for name, run in (("help", run_help), ("picker", run_picker)):
+    times = sorted(run()[0] * 1000 for _ in range(runs))
+    median = times[len(times) // 2]
+    status = "ok" if median <= budget else "OVER BUDGET"
+    over = over or median > budget
+    print(f"{name:<8} median {median:.0f} ms, best {times[0]:.0f} ms (budget {budget:.0f} ms) {status}")
+
+    for cumulative, module in slowest_imports(run(["-X", "importtime"])[1], top):
+        print(f"    {cumulative / 1000:>7.1f} ms  {module}")
+
+exit(1 if over else 0)
@@ -0,0 +1,121 @@
+#!venv/bin/python3
+# peak memory of walking every student's full history with fetchall()
+# versus the server-side cursor helpers in codeabode_db.
+#
+# the data is synthetic and lives in its own schema (codeabode_bench), so
+# this never reads or writes the real tables. each mode runs in a fresh
+# process so its peak RSS is measured on its own.
+#
+# usage: ./bench-stream.py [--setup] [--students N] [--classes N] [--text-size BYTES] [--itersize N]
+import os
+import resource
+import subprocess
+import sys
+import time
+from sys import argv
+
+import dotenv
+import psycopg2
+
+import codeabode_db
+
+dotenv.load_dotenv(override=True)
+
+SCHEMA = "codeabode_bench"
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+def connect():
+    return psycopg2.connect(os.getenv("DB_URL"), options=f"-c search_path={SCHEMA}")
+
+
+def setup(students, classes, text_size):
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(
+        """
+        CREATE TABLE students (
+            id SERIAL PRIMARY KEY,
+            name TEXT, age INTEGER, current_level TEXT, final_goal TEXT,
+            future_concepts TEXT[], notes TEXT, step INTEGER, current_class INTEGER
+        );
+        CREATE TABLE students_classes (
+            student_id INTEGER REFERENCES students(id),
+            class_id SERIAL PRIMARY KEY,
+            status VARCHAR(15), name TEXT, methods TEXT[], stretch_methods TEXT[],
+            description TEXT, classwork TEXT, notes TEXT, hw TEXT, hw_notes TEXT,
+            taught_methods TEXT[], needs_practice TEXT[]
+        );
+        CREATE TABLE students_classes_archive (LIKE students_classes);
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO students (name, age, current_level, final_goal, future_concepts, notes, step)
+        SELECT 'student ' || i, 12, 'loops', 'a game', ARRAY['classes', 'pygame'], 'notes', 1
+        FROM generate_series(1, %s) AS i
+        """,
+        (students,)
+    )
+    # md5 chains so the text doesn't compress away in TOAST
+    cur.execute(
+        """
+        INSERT INTO students_classes
+        (student_id, status, name, methods, description, classwork, notes, hw, hw_notes)
+        SELECT s.id, 'completed', 'class ' || c, ARRAY['print', 'input'], 'a class',
+            text, 'went well', text, 'done'
+        FROM students s,
+            generate_series(1, %s) AS c,
+            LATERAL (
+                SELECT left(string_agg(md5(s.id::text || c::text || g::text), ''), %s) AS text
+                FROM generate_series(1, %s / 32 + 1) AS g
+            ) t
+        """,
+        (classes, text_size, text_size)
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(mode, itersize):
+    conn = connect()
+    started = time.perf_counter()
+    students = 0
+    classes = 0
+
+    if mode == "fetchall":
+        cur = conn.cursor()
+        cur.execute(codeabode_db.STREAM_STUDENTS_SQL)
+        student_rows = cur.fetchall()
+        cur.execute(codeabode_db.STREAM_CLASSES_SQL, {"student_id": None})
+        class_rows = cur.fetchall()
+        students, classes = len(student_rows), len(class_rows)
+    else:
+        for student, history in codeabode_db.iter_histories(conn, itersize):
+            students += 1
+            classes += len(history)
+
+    elapsed = time.perf_counter() - started
+    conn.close()
+
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+    print(f"{mode:<10} {students} students, {classes} classes in {elapsed:.2f}s, peak RSS {peak_mb:.0f} MB")
+
+
+if "--mode" in argv:
+    measure(argv[argv.index("--mode") + 1], flag("--itersize", 1000))
+    exit()
+
+if "--setup" in argv:
+    setup(flag("--students", 10000), flag("--classes", 10), flag("--text-size", 3000))
+
+for mode in ("fetchall", "stream"):
+    subprocess.run([sys.executable, __file__, "--mode", mode,
+                    "--itersize", str(flag("--itersize", 1000))], check=True)
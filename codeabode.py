@@ -1,44 +1,94 @@
 #!venv/bin/python3
-from google import genai
-from google.api_core import retry
-from google.genai.types import GenerateContentConfig
-from typing import Literal, Optional
-import dotenv
+# heavy imports (google.genai, the pydantic models and prompts, psycopg2 and
+# the worker and mail modules) happen in the commands that need them, and
+# the Gemini client is only built on first use, so `help` and the student
+# picker start quickly. ./bench-startup.py checks that.
 import os
-import psycopg2
-from psycopg2 import sql
-from psycopg2.extras import execute_values
-from sys import argv, stdin
-import subprocess
-import smtplib
-import ssl
+import atexit
+import sys
+from sys import argv, stdin, stdout, stderr
 import json
+import time
 from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
-from codeabode_model import *
+# set when `serve` runs this file for a forwarded command, along with its
+# warm client and conn (see codeabode_serve.py)
+serving = globals().get("serving", False)
+client = globals().get("client")
+
+# --profile and --timings cover the whole command, so they start first
+# (see codeabode_profile.py)
+show_timings = "--timings" in argv and not serving
+if show_timings or ("--profile" in argv and not serving):
+    import codeabode_profile
+
+    if "--profile" in argv:
+        codeabode_profile.start_profile(argv[1] if len(argv) > 1 else "help")
+    if show_timings:
+        codeabode_profile.start_timings()
+
+# --trace, or CODEABODE_TRACE=FILE for daemons (see codeabode_trace.py)
+tracing = not serving and ("--trace" in argv or bool(os.getenv("CODEABODE_TRACE")))
+if tracing:
+    import codeabode_trace
+
+    codeabode_trace.start_tracing(
+        os.getenv("CODEABODE_TRACE")
+        or f"codeabode-trace-{argv[1] if len(argv) > 1 else 'help'}-{datetime.now():%Y%m%d-%H%M%S}.jsonl",
+        float(argv[argv.index("--trace-sample") + 1]) if "--trace-sample" in argv
+        else float(os.getenv("CODEABODE_TRACE_SAMPLE", 1))
+    )
 
-is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
+SOCKET = os.getenv("CODEABODE_SOCKET") or os.path.join(
+    os.getenv("XDG_RUNTIME_DIR", "/tmp"), f"codeabode-{os.getuid()}.sock"
+)
 
-genai.models.Models.generate_content = retry.Retry(
-    predicate=is_retriable)(genai.models.Models.generate_content)
+# long-running commands keep their own process
+FORWARDED = ("new", "n", "continue", "cont", "c", "run", "batch-homework", "import", "export", "archive")
 
-dotenv.load_dotenv(override=True)
+# profiling and tracing have to happen in this process, not the daemon
+if (not serving and len(argv) > 1 and argv[1] in FORWARDED and os.path.exists(SOCKET)
+        and not {"--profile", "--timings", "--trace"} & set(argv)):
+    from codeabode_serve import forward
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(
-    api_key=GEMINI_API_KEY,
-)
+    code = forward(SOCKET, argv[1:])
+    # a stale socket from a daemon that died, just run here
+    if code is not None:
+        exit(code)
 
-# connect to the database and upload for a student
-conn = psycopg2.connect(
-    os.getenv("DB_URL")
-)
 
-cur = conn.cursor()
+def get_client():
+    """
+    The Gemini client, built (and google.genai imported) on first use.
+    """
+    global client
+    if client is None:
+        from google import genai
+        from google.api_core import retry
+
+        is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
+
+        if tracing:
+            codeabode_trace.wrap_model(genai.models.Models, attempts=True)
+
+        genai.models.Models.generate_content = retry.Retry(
+            predicate=is_retriable)(genai.models.Models.generate_content)
+
+        if tracing:
+            codeabode_trace.wrap_model(genai.models.Models)
+        if show_timings:
+            # retries and their backoff count as part of the call
+            codeabode_profile.wrap(genai.models.Models, "generate_content", "model")
+            codeabode_profile.wrap(genai.models.Models, "generate_content_stream", "model")
+
+        # GEMINI_BASE_URL points at a stand-in like ./mock-gemini.py
+        client = genai.Client(
+            api_key=os.getenv("GEMINI_API_KEY"),
+            http_options={"base_url": os.getenv("GEMINI_BASE_URL")} if os.getenv("GEMINI_BASE_URL") else None,
+        )
+    return client
 
-def get_finished_response(client, model, config, initial_message):
+def get_finished_response(client, model, config, initial_message, draft=None, on_class=None):
     """
     Get a finished response from the chat, with options to modify, restart, upload, or save.
     
@@ -47,16 +97,35 @@ def get_finished_response(client, model, config, initial_message):
         model: The model to use
         config: Model configuration
         initial_message: The initial message to send
+        draft: A Draft generated ahead of time to start from instead of
+            sending initial_message
+        on_class: Streams the first response as a Curriculum and passes it
+            each class as it closes (see ClassStream)
     
     Returns:
         The final response from the model
     """
 
-    chat = client.chats.create(model=model, config=config)
     chat_history = []  # Track conversation manually if API doesn't provide it
     
     # Store initial message and response
-    response = chat.send_message(initial_message)
+    if draft is None and on_class is not None:
+        chat = client.chats.create(model=model, config=config)
+        classes = ClassStream(on_class)
+        text = ""
+        for chunk in chat.send_message_stream(initial_message):
+            if chunk.text:
+                text += chunk.text
+                classes.feed(chunk.text)
+        # validated (and repaired if need be) by parsed()
+        response = Draft(initial_message, text)
+    elif draft is None:
+        chat = client.chats.create(model=model, config=config)
+        response = chat.send_message(initial_message)
+    else:
+        chat = client.chats.create(model=model, config=config, history=draft.history())
+        initial_message = draft.message
+        response = draft
     chat_history.append({"role": "user", "content": initial_message})
     chat_history.append({"role": "assistant", "content": response.text})
     
@@ -130,6 +199,12 @@ def print_with_pager(text):
     Prints a string using the 'less' pager.
     Works on Linux, macOS, and Windows (if less is installed).
     """
+    if not stdout.isatty():
+        print(text)
+        return
+
+    import subprocess
+
     # Start the less process
     pager = subprocess.Popen(['less'], stdin=subprocess.PIPE, text=True)
     
@@ -140,592 +215,813 @@ def print_with_pager(text):
     except KeyboardInterrupt:
         pass  # Allow user to quit with Ctrl+C
 
-if len(argv) == 1 or argv[1] == "help":
-    print(
- """Usage: ./codeabode.py [COMMAND]
+def read_input():
+    """
+    Read everything the teacher types or pastes, up to Ctrl+D. Kept apart
+    from stdin so --timings counts it as waiting on the teacher.
+    """
+    return stdin.read()
 
-Commands:
-    new, n - create a new student
-    continue, cont, c - continue for existing student (from options)
-"""
-    )
+def flag(name, default=None):
+    """
+    The value after a --flag in argv, or default if the flag wasn't given.
+    """
+    if name in argv and argv.index(name) + 1 < len(argv):
+        return argv[argv.index(name) + 1]
+    return default
 
-elif argv[1] in ["new", "n"]:
-    print("Give me information about the student then hit Ctrl + D.")
-    message = stdin.read()
-    print("Done reading.")
+def choose_student(cur, page_size=20):
+    """
+    Pick a student from --student <id|name>, or by searching the roster by
+    name and paging through the matches. Only one page is fetched at a time.
+    --step N limits the search to students at that step.
 
-    response = get_finished_response(
-        client, 'gemini-2.5-flash', 
-        GenerateContentConfig(
-            system_instruction=[curcgpt_prompt],
-            response_mime_type="application/json",
-            response_schema=Curriculum
-        ), message
-    )
+    Returns:
+        (name, id, step, version) of the chosen student
+    """
+    if flag("--student"):
+        with cur.connection:
+            matches = find_student(cur, flag("--student"))
+        if len(matches) != 1:
+            print(f"{len(matches)} students match {flag('--student')}")
+            for match in matches:
+                print(f"{match[1]}: {match[0]}")
+            exit()
 
-    name = input("Name: ")
-    age = input("Age: ")
+        return matches[0]
 
-    cur.execute(
-        """
-        INSERT INTO students (name, age, current_level, final_goal, future_concepts, notes)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        RETURNING id
-        """,
-        (name, age, response.parsed.current_level, response.parsed.final_goal,
-        response.parsed.future_concepts, response.parsed.notes)
-    )
+    step = int(flag("--step")) if flag("--step") else None
+    query = input("Search students by name (blank for everyone): ").strip() or None
+    offset = 0
 
-    student_id = cur.fetchone()[0]
+    while True:
+        # one extra row tells us whether there's another page
+        with cur.connection:
+            students = search_students(cur, query, step, offset, page_size + 1)
+        has_next = len(students) > page_size
+        students = students[:page_size]
 
-    # Fetch all inserted ids and get the minimum
-    inserted_ids = execute_values(
-        cur, "INSERT INTO students_classes \
-        (student_id, status, name,  \
-        methods, stretch_methods, description) \
-        VALUES %s \
-        RETURNING class_id",  # Add RETURNING clause
-        
-        [(student_id, 'upcoming', x.name,
-        x.methods, x.stretch_methods, x.description) 
-        for x in response.parsed.classes],
-        fetch=True  # Need to fetch the returned values
-    )
+        if not students:
+            print("No students found")
 
-    # After executing new classes and before asking for input choice
-    lowest_class_id = min([row[0] for row in inserted_ids]) if inserted_ids else None
+        i = 0
+        while i < len(students):
+            print(f"{i}: {students[i][0]} (step {students[i][2]})")
+            i += 1
 
-    cur.execute(
-        """
-        UPDATE students
-        SET current_class = %s
-        WHERE id = %s
-        """,
-        (lowest_class_id, students[choice][1])
-    )
+        choice = input("Choose a number, (n)ext or (p)revious page, or search again: ").strip()
 
-    # Get the minimum id
+        if choice.isdigit() and int(choice) < len(students):
+            return students[int(choice)]
+        elif choice == "n":
+            if has_next:
+                offset += page_size
+        elif choice == "p":
+            offset = max(0, offset - page_size)
+        elif choice:
+            query = choice
+            offset = 0
 
-    current_class = response.parsed.classes[0]
+def commit_step(step, *args):
+    """
+    Run one step transition in its own short transaction, so no locks are
+    held while waiting on the model or the teacher. If another session
+    changed the student in the meantime, nothing is written and the
+    StaleStudentError is raised after saying so: `continue` stops there,
+    the shell moves on to the next student.
+    """
+    try:
+        with conn:
+            return step(cur, *args)
+    except StaleStudentError as e:
+        print(f"{e}. Nothing was saved, please start again.")
+        raise
 
-    # TODO: assessment on first day?
+def due_students(query=None, step=None, page_size=100):
+    """
+    The students with a step to do (or only those at step), in roster
+    order, read a page at a time as they're needed. The step is filtered
+    here rather than in SQL, so students moving on as they're worked
+    through don't shift the later pages.
+    """
+    offset = 0
+    while True:
+        with conn:
+            page = search_students(cur, query, None, offset, page_size)
+        offset += len(page)
 
-    input_choice = input("(u)pload or (g)enerate the first class? ")
-    response_text = None
+        for student in page:
+            if student[2] in (1, 2) and step in (None, student[2]):
+                yield student
 
-    if input_choice == 'g':
-        message = f"""
-        Age: {age}
-        Student Level: {response.parsed.current_level}
-        Student Notes: {response.parsed.notes}
-
-        Class Name: {current_class.name}
-        Methods: {current_class.methods}
-        Stretch Methods: {current_class.stretch_methods}
-        Description: {current_class.description}
-        This is the first class for the student.
-
-        """ 
-        print(message)
+        if len(page) < page_size:
+            return
 
-        chat = client.chats.create(
-            model="gemini-2.5-flash",
-            config=GenerateContentConfig(
-                system_instruction=[classnotesgpt_prompt],
-            ),
-        )
+def digest_window():
+    """
+    Seconds to hold parent emails for a per-account digest, from --digest
+    or EMAIL_DIGEST_WINDOW. None sends each email on its own.
+    """
+    window = flag("--digest", os.getenv("EMAIL_DIGEST_WINDOW"))
+    return float(window) if window else None
 
 
-        response_text = get_response(chat, 
-            f"""
-            {message}
-            Teacher notes:
-            {input("> ")}
-            """
-        ).text
-    else:
-        response_text = stdin.read()
-
-    # upload the class notes
-    cur.execute(
-        """
-        UPDATE students_classes
-        SET classwork = %s
-        WHERE class_id = %s
-        """,
-        (response_text, lowest_class_id)
-    )
+def start_sender():
+    """
+    Deliver what's in the outbox from a detached process, so we don't wait
+    on SMTP. Harmless if a send-mail daemon is already running, senders
+    never claim the same email.
+    """
+    import subprocess
 
-    cur.execute(
-        """
-        UPDATE students
-        SET step = 2
-        WHERE id = %s
-        """,
-        (student_id,)
+    command = [sys.executable] if getattr(sys, "frozen", False) else [sys.executable, argv[0]]
+    subprocess.Popen(
+        command + ["send-mail", "--once"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
     )
 
-elif argv[1] in ["continue", "cont", "c"]:
-    cur.execute("select name, id, step from students")
-    students = cur.fetchall()
-
-    choice = -1 
-    while choice > len(students) or choice < 0:
-        i = 0
-        while i < len(students):
-            print(f"{i}: {students[i][0]}")
-            i += 1
-
-        print("Please choose a student from the list")
-        choice = int(input("> "))
 
-    if students[choice][2] == 1:
+def continue_student(student):
+    """
+    Run the next step (refine and classwork, or homework) for one student
+    picked with choose_student.
+    """
+    if student[2] == 1:
         # step 3 no homework, u can assume it may have been more than one class since the last time the system was used (or hw notes will say that lol ig
-        print(f"Re-optimizing curriculum for {students[choice][0]}... ")
-
-        cur.execute(
-            sql.SQL("""
-                SELECT 
-                    COUNT(*) FILTER (WHERE sc.status = 'completed') OVER (PARTITION BY sc.student_id) as completed_count,
-                    s.age,
-                    s.current_level, 
-                    s.notes,
-                    sc.name, 
-                    sc.methods, 
-                    sc.stretch_methods, 
-                    sc.description,
-                    sc.classwork,
-                    sc.notes,
-                    sc.hw,
-                    sc.hw_notes,
-                    sc.status
-                FROM students_classes sc
-                JOIN students s ON s.id = sc.student_id
-                WHERE sc.student_id = {student_id}
-                ORDER BY sc.class_id ASC
-            """).format(student_id=sql.Literal(students[choice][1]))
-        )
+        print(f"Re-optimizing curriculum for {student[0]}... ")
+
+        with conn:
+            classes = get_class_history(cur, student[1])
+            refined = is_refined(cur, student[1])
 
         # TODO: final goal missing?
         # this can be optimized out
         # they dont need to update everything each time
 
-        classes = cur.fetchall()
-
         if len(classes) == 0:
             print("No upcoming or assessment classes found")
-            exit()
+            return
 
         if classes[0][0] == 0:
             print("No past classes")
-            exit()
+            return
 
-        curc_message = f"""
-        Age: {classes[0][1]}
-        Student Level: {classes[0][2]}
-        Student Notes: {classes[0][3]}
+        curc_message, last_completed, last_completed_index = history_message(classes)
 
-        """
+        if refined:
+            # refined by `run refine --commit`, only the classwork is left
+            print(f"The curriculum for {student[0]} was already refined.")
+        else:
+            print_with_pager(curc_message)
 
-        last_completed = None
-        last_completed_index = -1
+            with conn:
+                draft = get_draft(cur, student[1], student[3], "refine")
 
-        i = 0
-        while i < len(classes):
-            curc_message += f"""
-            ===========================
+            if draft:
+                print("A refined curriculum was drafted ahead of time. Enter notes on the last hw to regenerate with them, or leave it empty to review the draft (Ctrl+D when done): ")
+            else:
+                print("Enter any notes on the last hw (Ctrl+D when done): ")
+            last_hw_notes = read_input()
+            print("Done reading.")
 
-            Class Name: {classes[i][4]}
-            Methods: {classes[i][5]}
-            Stretch Methods: {classes[i][6]}
-            Description: {classes[i][7]}
-            Teacher notes: {classes[i][9]}
-            Teacher notes on homework: {classes[i][11]}
+            if draft and not last_hw_notes.strip():
+                # None if it doesn't validate, and the curriculum is generated live
+                draft = load_draft(draft["message"], draft["curriculum"], Curriculum)
+            else:
+                draft = None
+            curc_message += f"\n\nLast homework notes: {last_hw_notes}"
 
-            """
+            response = get_finished_response(
+                client, MODEL, refiner_config(), curc_message, draft
+            )
+            # saved with the classwork below, so quitting keeps neither
+            curriculum = parsed(response, Curriculum)
 
-            if classes[i][12] == "completed":
-                last_completed_index = i
-                last_completed = classes[i]
+        input_choice = input("(A)ssessment, 10-(m)inute warm up, (u)pload assignment, (g)enerate, (n)one, or (q)uit: ")
+        
+            # nerfed assessment then normal class
+        classwork = None
+        if input_choice == "u":
+            classwork = read_input()
 
-            i += 1
+        elif input_choice == "q":
+            return
+        elif input_choice == "n":
+            print("No class notes this time")
 
-        print_with_pager(curc_message)
+        else:
+            print(f"Generating class notes for {student[0]}")
 
-        print("Enter any notes on the last hw (Ctrl+D when done): ")
-        last_hw_notes = stdin.read()
-        print("Done reading.")
-        cur.execute(
-            sql.SQL(
-                """UPDATE students_classes
-                SET hw_notes = {last_hw_notes}
-                WHERE student_id = {student_id}
-                AND status IN ('upcoming', 'assessment')
-                RETURNING class_id
-                """).format(student_id=sql.Literal(students[choice][1]), last_hw_notes=sql.Literal(last_hw_notes)))
+            with conn:
+                last_hw, old_classwork = classwork_context(
+                    cur, classes, last_completed, last_completed_index
+                )
 
-        curc_message += f"\n\nLast homework notes: {last_hw_notes}"
+            message = classwork_message(classes, last_completed, last_hw, old_classwork)
 
-        last_class = cur.fetchone()[0]
+            print(message)
 
-        response = get_finished_response(
-            client, 'gemini-2.5-flash', 
-            GenerateContentConfig(
-                system_instruction=[curcgpt_refiner_prompt],
-                response_mime_type="application/json",
-                response_schema=Curriculum
-            ), curc_message
-        )
+            kind = {"a": "assessment", "m": "warmup"}.get(input_choice, "normal")
 
-        cur.execute(
-            """
-            UPDATE students 
-            SET current_level = %s, 
-                final_goal = %s, 
-                future_concepts = %s,
-                notes = %s
-            WHERE id = %s
-            """,
-            (response.parsed.current_level, response.parsed.final_goal,
-            response.parsed.future_concepts, response.parsed.notes, 
-             students[choice][1])
-        )
+            # a warm up is written first, then the class itself
+            classwork = ""
+            for prompt in CLASSWORK_PROMPTS[kind]:
+                classwork += get_finished_response(
+                    client, MODEL, classwork_config(prompt),
+                    with_teacher_notes(message, input("> "))
+                ).text
 
-        cur.execute(
-            """
-            UPDATE students_classes
-            SET hw_notes = %s,
-            status = 'completed'
-            WHERE class_id = %s
-            """,
-            (last_hw_notes, last_class)
-        )
+        # upload the class notes
+        if refined:
+            with conn:
+                current_class_num = get_current_class(cur, student[1])[8]
+            commit_step(save_classwork, student[1], student[3], current_class_num, classwork)
+        else:
+            commit_step(save_refined_classwork, student[1], student[3], last_hw_notes, curriculum, classwork)
 
-        cur.execute(
-            """
-            DELETE FROM students_classes
-            WHERE student_id = %s
-            AND status = 'upcoming'
-            """,
-            (students[choice][1],)
-        )
+    elif student[2] == 2:
+        print(f"Generating homework for {student[0]}")
 
-        execute_values(cur, 
-            """
-            INSERT INTO students_classes 
-            (student_id, status, name,
-            methods, stretch_methods, description)
-            VALUES %s
-            """, 
-            [(students[choice][1], 'upcoming', x.name,
-            x.methods, x.stretch_methods, 
-            x.description) for x in response.parsed.classes]
-        )
+        with conn:
+            current_class = get_current_class(cur, student[1])
 
-        # change lowest class
+        message = homework_message(current_class)
 
-        cur.execute(
-            """
-            UPDATE students
-            SET current_class = (
-                SELECT MIN(class_id)
-                FROM students_classes
-                WHERE student_id = %s
-                AND status = 'upcoming'
-            )
-            WHERE id = %s
-            RETURNING current_class
-            """,
-            (students[choice][1], students[choice][1])
+        with conn:
+            draft = get_draft(cur, student[1], student[3], "homework")
+
+        print(message)
+
+        # a draft that doesn't validate is ignored and generated live
+        analysis_draft = None
+        if draft:
+            analysis_draft = load_draft(draft["message"], draft["analysis"], CompletedClass)
+            if analysis_draft is None:
+                draft = None
+
+        if draft:
+            # drafted by the worker from the class notes saved earlier
+            print(f"Using the class notes already saved:\n{current_class[11]}")
+            message = draft["message"]
+        else:
+            print("How did he do in class? (Ctrl + D to finish)")
+            first_msg = read_input()
+            message += first_msg
+            print("\nDone reading.")
+
+        # first we generate the info for CompletedClass and insert that information
+
+        response = get_finished_response(
+            client, MODEL, analysis_config(), message, analysis_draft
         )
 
-        current_class_num = cur.fetchone()[0]
-                        
-        input_choice = input("(A)ssessment, 10-(m)inute warm up, (u)pload assignment, (g)enerate, (n)one, or (q)uit: ")
-        
-            # nerfed assessment then normal class
+        analysis = parsed(response, CompletedClass)
+        message = with_analysis(message, analysis)
+
+        if draft:
+            input_choice = input("(u)pload assignment, (5) day (drafted), or (c)reative generated: ")
+        else:
+            input_choice = input("(u)pload assignment, (5) day, or (c)reative generated: ")
+        response_text = None
+
         if input_choice == "u":
-            cur.execute(
-                """
-                UPDATE students_classes
-                SET classwork = %s,
-                status = 'completed'
-                WHERE class_id = %s
-                """,
-                (stdin.read(), current_class_num)
-            )
+            response_text = read_input()
+        elif input_choice == "5" and draft and response.text == draft["analysis"]:
+            # the drafted homework only holds if the analysis wasn't changed
+            response_text = get_finished_response(
+                client, MODEL, homework_config(hwgpt_prompt), message,
+                Draft(draft["hw_message"], draft["hw"])
+            ).text
+        else:
+            prompt = None
+            if input_choice == "5":
+                prompt = HOMEWORK_PROMPTS["5"]
+            elif input_choice == "c":
+                prompt = HOMEWORK_PROMPTS["creative"]
 
-        elif input_choice == "q":
-            exit()
-        elif input_choice == "n":
-            print("No class notes this time")
+            response_text = get_finished_response(
+                client, MODEL, homework_config(prompt), message
+            ).text
+
+
+
+        from codeabode_mail import save_homework_and_notify
 
+        # the emails are queued with the homework and sent in the background,
+        # so a slow or failing mail server can't hold up or lose the commit
+        version, queued = commit_step(
+            save_homework_and_notify, student[1], student[3],
+            analysis, response_text, current_class
+        )
+
+        if queued and digest_window() is not None:
+            print(f"Done. {queued} email(s) to the student's accounts will go out in the next digest.")
+        elif queued:
+            start_sender()
+            print(f"Done. {queued} email(s) to the student's accounts are on their way.")
         else:
-            print(f"Generating class notes for {students[choice][0]}")
+            print("Done.")
 
-            message = f"""
-            Age: {classes[0][1]}
-            Student Level: {classes[0][2]}
-            Student Notes: {classes[0][3]}
 
-            Previous Class as Context (if you want to bridge new classwork to previous homework):
-            {last_completed[4]}
-            Methods: {last_completed[5]}
-            Stretch Methods: {last_completed[6]}
-            Description: {last_completed[7]}
-            Classwork Notes: {last_completed[9]}
+def load_import_file(path, age=None):
+    """
+    Read one student for bulk import. Accepts either a Curriculum JSON file or
+    a chat_history_*.json file written by the (s)ave option, in which case the
+    curriculum is the last response. Name and age are read from "name" and
+    "age" keys in the file; the name falls back to the file name. Chat
+    history saves never have an age, so it comes from the age argument
+    (--age) or, at a terminal, is asked for.
+    """
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+
+    student = json.loads(data["last_response"]) if "last_response" in data else dict(data)
+    if not isinstance(student, dict):
+        raise ValueError("expected a curriculum object")
+
+    student.setdefault("name", data.get("name") or os.path.splitext(os.path.basename(path))[0])
+    if "age" in data:
+        student.setdefault("age", data["age"])
+    elif "age" not in student:
+        if age is None and stdin.isatty():
+            age = input(f"Age for {student['name']} ({os.path.basename(path)}): ")
+        if age is None:
+            raise ValueError("no age in the file, pass --age")
+        student["age"] = age
+
+    return ImportedStudent.model_validate(student)
+
+if tracing:
+    print_with_pager = codeabode_trace.traced(print_with_pager, "pager", "pager")
+    continue_student = codeabode_trace.traced(
+        continue_student, "continue", "step", lambda student: {"student": student[1], "name": student[0]}
+    )
 
-            Homework:
-            {last_completed[10]}
+if show_timings:
+    print_with_pager = codeabode_profile.timed_function(print_with_pager, "pager")
+    commit_step = codeabode_profile.timed_function(commit_step, "commit")
+    read_input = codeabode_profile.timed_function(read_input, "input")
 
-            Homework Notes: {last_completed[11]}
+if len(argv) == 1 or argv[1] == "help":
+    print(
+ """Usage: ./codeabode.py [COMMAND]
 
-            Class to Generate for:
+Commands:
+    new, n - create a new student
+    continue, cont, c - continue for existing student (from options)
+        --student ID|NAME - skip the picker and use this student
+        --step N - only list students at this step
+    import DIR [--batch-size N] [--age N] - bulk load students from curriculum JSON files
+    export [--output FILE] [--itersize N] - write every student and their classes as JSON lines
+    archive [--keep N] [--batch-size N] - move old completed classes out of the hot table
+    worker [--once] - generate drafts ahead of time as students change step
+    send-mail [--once] [--batch-size N] [--rate N] [--digest SECONDS] - deliver queued parent emails,
+        with --digest, one email per account for everything queued within SECONDS
+    run STEP [--commit] - run one step (new, refine, classwork, analysis, homework) without prompts,
+        JSON request(s) on stdin, JSON results with timings on stdout (see codeabode_headless.py)
+    batch-homework NOTES.json [--parallel N] [--kind 5|creative] [--dry-run] - analysis and homework
+        for every student in a file of {"student id or name": "class notes"}, N at a time
+    api [--host H] [--port N] [--workers STEP=N,...] [--queue N] - serve the steps over HTTP
+        with a worker pool and bounded queue per step (see codeabode_api.py)
+    jobs add STEP --student ID|NAME|--all [--priority N] [--urgent] [--request JSON] [--commit]
+        - queue a step to run in the background, for one student or everyone at that step
+    jobs list [--status S] - the queue, most urgent first
+    jobs work [--workers N] [--reserve N] [--once] - run queued jobs, keeping N of the workers
+        (1 by default) for urgent ones (see codeabode_jobs.py)
+    shell [--search NAME] [--step N] [--lookahead N] - work through every student due a step,
+        drafting the next N (2 by default) in the background while you review the current one
+    serve - keep a warm process on a Unix socket ($CODEABODE_SOCKET) that new, continue, run,
+        batch-homework, import, export and archive hand themselves to while it runs
+
+Options:
+    --db-stats - print rows and bytes fetched per query on exit
+    --profile - profile the command (pyinstrument if installed, else cProfile) into
+        codeabode-COMMAND-TIME.html/.prof
+    --timings - print wall-clock time per phase on exit (startup, db, model calls, smtp,
+        commit), with time waiting on you at prompts and in the pager kept separate
+    --trace [--trace-sample F] - write spans for every query, model call, pager and smtp
+        command to codeabode-trace-COMMAND-TIME.jsonl ($CODEABODE_TRACE), keeping F of them
+        (see codeabode_trace.py)
+"""
+    )
+    exit()
 
-            """ 
+import dotenv
+import psycopg2
 
-            # TODO: class name, description, stretch_methods removed
-            # class notes is "actually taught concepts" because this is made after re-adjusting the curriculum for homework 
-            # homework notes is "homework performance" and "homework" can be turned into "homework summary" to save bytes
+from codeabode_db import *
 
-            # u forgot to add the class after this
+if show_timings:
+    codeabode_profile.wrap(CountingCursor, "execute", "db")
+if tracing:
+    codeabode_trace.wrap_cursor(CountingCursor)
 
-            if classes[last_completed_index + 1][8] is not None:
-                message += "Here are the old class notes: \n\n" + current_class[10]
+dotenv.load_dotenv(override=True)
 
-            print(message)
 
-            prompt = None
-            response = ""
-            if input_choice == "a":
-                prompt = assessmentgpt_prompt
-            elif input_choice == "m":
-                response = get_finished_response(
-                    client, 'gemini-2.5-flash',
-                    GenerateContentConfig(
-                        system_instruction=[classwork_with_warmup_prompt],
-                    ),
-                    f"""
-                    {message}
-                    Teacher notes:
-                    {input("> ")}
-                    """
-                ).text
-                prompt = classnotesgpt_prompt
+def connect():
+    return psycopg2.connect(
+        os.getenv("DB_URL"),
+        cursor_factory=CountingCursor
+    )
 
-            else:
-                prompt = classnotesgpt_prompt
-
-            response += get_finished_response(
-                client, 'gemini-2.5-flash',
-                GenerateContentConfig(
-                    system_instruction=[prompt],
-                ),
-                f"""
-                {message}
-                Teacher notes:
-                {input("> ")}
-                """
-            ).text
 
-            # upload the class notes
-            cur.execute(
-                """
-                UPDATE students_classes
-                SET classwork = %s,
-                status = 'completed'
-                WHERE class_id = %s
-                """,
-                (response, current_class_num)
-            )
+if argv[1] == "serve":
+    from codeabode_serve import serve
 
-        cur.execute(
-            """
-            UPDATE students
-            SET step = 2
-            WHERE id = %s
-            """,
-            (students[choice][1],)
-        )
+    try:
+        # the code that's running, since a frozen build has no codeabode.py
+        # on disk to run again
+        serve(SOCKET, sys._getframe().f_code, connect, get_client())
+    except KeyboardInterrupt:
+        pass
+    exit()
 
-    elif students[choice][2] == 2:
-        print(f"Generating homework for {students[choice][0]}")
-
-        cur.execute("""
-            SELECT 
-                s.age,
-                s.current_level, 
-                s.notes,
-                sc.name, 
-                sc.description, 
-                sc.methods, 
-                sc.stretch_methods, 
-                sc.description,
-                sc.class_id,
-                sc.classwork,
-                s.name
-            FROM students_classes sc
-            JOIN students s ON s.id = sc.student_id
-            WHERE sc.class_id = (
-                SELECT current_class
-                FROM students
-                WHERE id = %s
-            )
-            """,
-            (students[choice][1],)
-        )
+# connect to the database and upload for a student
+conn = globals().get("conn") or connect()
+
+cur = conn.cursor()
+
+if show_timings:
+    codeabode_profile.startup_done()
+
+if "--db-stats" in argv and not serving:
+    atexit.register(print_query_stats)
+
+if argv[1] in ["new", "n"]:
+    from codeabode_agents import *
+
+    client = get_client()
+
+    print("Give me information about the student then hit Ctrl + D.")
+    message = read_input()
+    print("Done reading.")
+
+    # asked before the curriculum, so the first class's classwork can be
+    # written while the rest of the curriculum streams in
+    name = input("Name: ")
+    age = input("Age: ")
 
-        current_class = cur.fetchone()
+    # TODO: assessment on first day?
+
+    input_choice = input("(u)pload or (g)enerate the first class? ")
+    teacher_notes = input("Notes for the first class > ") if input_choice == "g" else None
 
-        message = f"""
-        Age: {current_class[0]}
-        Student Level: {current_class[1]}
-        Student Notes: {current_class[2]}
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
 
-        Class Name: {current_class[3]}
-        Relevance: {current_class[4]}
-        Methods: {current_class[5]}
-        Stretch Methods: {current_class[6]}
-        Skills Tested: {current_class[7]}
-        Description: {current_class[8]}
+    pool = ThreadPoolExecutor(max_workers=1)
+    early = {}
 
-        Classwork:
+    def write_classwork(class_message):
+        return client.models.generate_content(
+            model=MODEL, contents=class_message, config=classwork_config(classnotesgpt_prompt)
+        ).text
 
-        {current_class[9]}
+    def class_closed(index, cls, fields):
+        # the first class with the level and notes is all first_class_message
+        # reads, keyed by the message so it's only used if they're kept
+        if index == 0 and {"current_level", "notes"} <= fields.keys():
+            class_message = with_teacher_notes(
+                first_class_message(age, SimpleNamespace(**fields, classes=[cls])), teacher_notes
+            )
+            early[class_message] = pool.submit(write_classwork, class_message)
 
+    curriculum = parsed(get_finished_response(
+        client, MODEL, new_student_config(), message,
+        on_class=class_closed if teacher_notes is not None else None
+    ), Curriculum)
 
-        """ 
+    response_text = None
 
+    if input_choice == 'g':
+        message = first_class_message(age, curriculum)
         print(message)
+        message = with_teacher_notes(message, teacher_notes)
 
-        print("How did he do in class? (Ctrl + D to finish)")
-        first_msg = stdin.read()
-        message += first_msg
-        print("\nDone reading.")
+        # the early classwork holds unless the curriculum was modified since
+        draft = Draft(message, early[message].result()) if message in early else None
+        response_text = get_finished_response(
+            client, MODEL, classwork_config(classnotesgpt_prompt), message, draft
+        ).text
+    else:
+        response_text = read_input()
 
-        # first we generate the info for CompletedClass and insert that information
+    pool.shutdown(wait=False, cancel_futures=True)
 
-        response = get_finished_response(
-            client, "gemini-2.5-flash",
-            GenerateContentConfig(
-                system_instruction=[classanalysis_prompt],
-                response_mime_type="application/json",
-                response_schema=CompletedClass,
-            ),
-            message
+    # upload the student, their classes and the class notes in one go
+    commit_step(create_student, name, age, curriculum, response_text)
+
+elif argv[1] == "import":
+    if len(argv) < 3:
+        print("Usage: ./codeabode.py import DIR [--batch-size N] [--age N]")
+        exit()
+
+    from codeabode_model import ImportedStudent
+
+    batch_size = int(flag("--batch-size", 500))
+
+    records = []
+    for filename in sorted(os.listdir(argv[2])):
+        if not filename.endswith(".json"):
+            continue
+
+        try:
+            records.append(load_import_file(os.path.join(argv[2], filename), flag("--age")))
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Skipping {filename}: {e}")
+
+    print(f"Importing {len(records)} students...")
+
+    started = time.perf_counter()
+    stats = import_students(conn, records, batch_size)
+    elapsed = time.perf_counter() - started
+
+    for i, batch in enumerate(stats):
+        rows = batch["students"] + batch["classes"]
+        print(f"batch {i}: {batch['students']} students, {batch['classes']} classes "
+              f"in {batch['seconds']:.2f}s ({rows / batch['seconds']:.0f} rows/sec)")
+
+    rows = sum(batch["students"] + batch["classes"] for batch in stats)
+    if elapsed > 0:
+        print(f"✓ Imported {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/sec)")
+
+elif argv[1] == "export":
+    output = open(flag("--output"), "w", encoding="utf-8") if flag("--output") else stdout
+    count = 0
+
+    # streamed from server-side cursors, one student's classes in memory at a time
+    with conn:
+        for student, classes in iter_histories(conn, int(flag("--itersize", 1000))):
+            record = dict(zip(STUDENT_COLUMNS, student))
+            record["classes"] = [dict(zip(CLASS_COLUMNS, row)) for row in classes]
+            output.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            count += 1
+
+    if output is not stdout:
+        output.close()
+    print(f"✓ Exported {count} students", file=stderr)
+
+elif argv[1] == "archive":
+    keep = int(flag("--keep", 3))
+    print(f"Archiving completed classes, keeping the last {keep} per student...")
+
+    started = time.perf_counter()
+    archived = archive_classes(conn, keep, int(flag("--batch-size", 1000)))
+    print(f"✓ Archived {archived} classes in {time.perf_counter() - started:.2f}s")
+
+elif argv[1] == "send-mail":
+    from codeabode_mail import run_sender
+
+    once = "--once" in argv
+    if not once:
+        print("Sending queued emails (Ctrl+C to stop)...")
+    try:
+        sent, failed = run_sender(
+            conn, connect, int(flag("--batch-size", 50)), float(flag("--rate", 2)),
+            once=once, digest=digest_window()
         )
+        print(f"✓ Sent {sent} emails, {failed} failed")
+    except KeyboardInterrupt:
+        pass
 
-        message += f"""
-        Notes on Class: {response.parsed.notes}
-        """
+elif argv[1] == "worker":
+    from codeabode_worker import run_worker
 
-        if response.parsed.taught_methods:
-            message += f"""
-            Taught Methods: {response.parsed.taught_methods}
-            """
+    client = get_client()
+    print("Waiting for drafts to generate (Ctrl+C to stop)...")
+    try:
+        run_worker(conn, client, connect, once="--once" in argv)
+    except KeyboardInterrupt:
+        pass
 
-        if response.parsed.needs_practice:
-            message += f"""
-            Stretch Methods: {response.parsed.needs_practice}
-            """
+elif argv[1] in ["continue", "cont", "c"]:
+    student = choose_student(cur)
 
-        input_choice = input("(u)pload assignment, (5) day, or (c)reative generated: ")
-        response_text = None
+    # only needed once a student is picked
+    from codeabode_agents import *
 
-        if input_choice == "u":
-            response_text = stdin.read()
+    client = get_client()
+    try:
+        continue_student(student)
+    except StaleStudentError:
+        exit()
+
+elif argv[1] == "run":
+    from codeabode_agents import parse_report
+    from codeabode_headless import STEPS, read_requests, run_step
+
+    if len(argv) < 3 or argv[2] not in STEPS:
+        print(f"Usage: ./codeabode.py run {{{','.join(STEPS)}}} [--commit] < request.json", file=stderr)
+        exit(2)
+
+    client = get_client()
+    failed = 0
+
+    for request in read_requests(stdin):
+        result = run_step(client, conn, argv[2], request, "--commit" in argv)
+        failed += not result["ok"]
+        print(json.dumps(result, ensure_ascii=False, default=str), flush=True)
+
+    # stdout is only results
+    if parse_report():
+        print(parse_report(), file=stderr)
+    exit(1 if failed else 0)
+
+elif argv[1] == "batch-homework":
+    from codeabode_agents import parse_report
+    from codeabode_headless import load_notes, run_batch
+
+    if len(argv) < 3:
+        print("Usage: ./codeabode.py batch-homework NOTES.json [--parallel N] [--kind 5|creative] [--dry-run]")
+        exit()
+
+    client = get_client()
+    requests = load_notes(argv[2])
+    for request in requests:
+        request.setdefault("kind", flag("--kind", "5"))
+
+    parallel = int(flag("--parallel", 4))
+    print(f"Generating homework for {len(requests)} students, {parallel} at a time...")
+
+    started = time.perf_counter()
+    results = run_batch(client, connect, "homework", requests, parallel, "--dry-run" not in argv)
+    elapsed = time.perf_counter() - started
+
+    print(f"\n{'student':<24} {'status':<8} {'model':>7} {'db':>7} {'total':>7}  emails")
+    for request, result in zip(requests, results):
+        timings = result["timings"]
+        if result["ok"]:
+            status, detail = "ok", result["result"].get("emails_queued", "-")
         else:
-            prompt = None
-            if input_choice == "5":
-                prompt = hwgpt_prompt
-            elif input_choice == "c":
-                prompt = creative_hwgpt_prompt
+            status, detail = "FAILED", result["error"]
+        print(f"{str(request['student'])[:24]:<24} {status:<8} {timings.get('model', 0):>6.1f}s "
+              f"{timings.get('db', 0):>6.2f}s {timings['total']:>6.1f}s  {detail}")
+
+    failed = sum(not result["ok"] for result in results)
+    latencies = sorted(result["timings"]["total"] for result in results)
+    if latencies:
+        print(f"\n{len(results) - failed} done, {failed} failed in {elapsed:.1f}s "
+              f"(median {latencies[len(latencies) // 2]:.1f}s, max {latencies[-1]:.1f}s per student, "
+              f"{sum(latencies) / elapsed:.1f}x from running in parallel)")
+    if parse_report():
+        print(parse_report())
+
+    if any(result["ok"] and result["result"].get("emails_queued") for result in results):
+        if digest_window() is None:
+            start_sender()
+
+elif argv[1] == "api":
+    import asyncio
+
+    from codeabode_api import serve_api
+    from codeabode_headless import STEPS
+
+    # --workers homework=4,refine=1
+    workers = {}
+    for pair in filter(None, flag("--workers", "").split(",")):
+        step, _, count = pair.partition("=")
+        # every step needs a worker, or its requests would queue forever
+        if step not in STEPS or not count.isdigit() or int(count) < 1:
+            print(f"Bad --workers entry {pair!r}, expected STEP=N with STEP one of {', '.join(STEPS)} "
+                  "and N at least 1", file=stderr)
+            exit(2)
+        workers[step] = int(count)
 
-            response_text = get_finished_response(
-                client, 'gemini-2.5-flash', 
-                GenerateContentConfig(
-                    system_instruction=[prompt],
-                ), message
-            ).text
+    try:
+        asyncio.run(serve_api(
+            connect, get_client(), flag("--host", "127.0.0.1"), int(flag("--port", 8300)),
+            workers, int(flag("--queue", 16))
+        ))
+    except KeyboardInterrupt:
+        pass
+
+elif argv[1] == "jobs":
+    from codeabode_agents import parse_report
+    from codeabode_jobs import URGENT, run_jobs
+
+    # the step a student has to be at for each kind of job
+    JOB_STEPS = {"refine": 1, "classwork": 1, "analysis": 2, "homework": 2}
+
+    if len(argv) > 3 and argv[2] == "add" and argv[3] in JOB_STEPS:
+        request = json.loads(flag("--request", "{}"))
+        priority = URGENT if "--urgent" in argv else int(flag("--priority", 0))
+
+        if "--all" in argv:
+            students = []
+            with conn:
+                while True:
+                    page = search_students(cur, None, JOB_STEPS[argv[3]], len(students), 500)
+                    students += page
+                    if len(page) < 500:
+                        break
+        elif flag("--student"):
+            with conn:
+                students = find_student(cur, flag("--student"))
+            if len(students) != 1:
+                print(f"{len(students)} students match {flag('--student')}")
+                exit(1)
+        else:
+            print("Pass --student ID|NAME or --all")
+            exit(2)
+
+        with conn:
+            for name, student_id, step, version in students:
+                queue_job(cur, argv[3], {**request, "student": student_id}, student_id,
+                          "--commit" in argv, priority)
+
+        print(f"Queued {len(students)} {argv[3]} job(s) at priority {priority}")
+
+    elif len(argv) > 2 and argv[2] == "list":
+        with conn:
+            jobs = list_jobs(cur, flag("--status"))
+
+        print(f"{'id':>6} {'kind':<10} {'student':<24} {'prio':>5} {'status':<8} tries  error")
+        for job_id, kind, name, priority, status, attempts, max_attempts, created, finished, error in jobs:
+            # the last line of a traceback is the exception itself
+            error = (error or "").strip().splitlines()[-1:] or [""]
+            print(f"{job_id:>6} {kind:<10} {str(name)[:24]:<24} {priority:>5} {status:<8} "
+                  f"{attempts}/{max_attempts}    {error[0][:60]}")
+
+    elif len(argv) > 2 and argv[2] == "work":
+        workers = int(flag("--workers", 2))
+        print(f"Running jobs on {workers} worker(s), {flag('--reserve', 1)} kept for urgent ones")
+        counts = run_jobs(connect, get_client(), workers, int(flag("--reserve", 1)),
+                          once="--once" in argv)
+        print(", ".join(f"{n} {status or 'lost'}" for status, n in counts.items()) or "No jobs run")
+        if parse_report():
+            print(parse_report())
 
+    else:
+        print(f"Usage: ./codeabode.py jobs add {{{','.join(JOB_STEPS)}}} --student ID|NAME|--all "
+              "[--priority N] [--urgent] [--request JSON] [--commit]\n"
+              "       ./codeabode.py jobs list [--status S]\n"
+              "       ./codeabode.py jobs work [--workers N] [--reserve N] [--once]")
+        exit(2)
 
+elif argv[1] == "shell":
+    import itertools
 
-        cur.execute(
-            """
-            UPDATE students_classes
-            SET notes = %s,
-            taught_methods = %s,
-            needs_practice = %s,
-            hw = %s
-            WHERE class_id = (
-                SELECT current_class
-                FROM students
-                WHERE id = %s
-            )
-            """,
-            (response.parsed.notes, response.parsed.taught_methods, response.parsed.needs_practice, response_text, students[choice][1])
-        )
+    from codeabode_agents import *
+    from codeabode_worker import Lookahead
 
-        print("Done. Sending email to student's accounts...")
-
-        cur.execute(
-            """
-            UPDATE students
-            SET step = 1,
-            sent_email = false
-            WHERE id = %s
-            RETURNING account_id 
-            """, (students[choice][1],))
-
-        account_id_array = cur.fetchone()[0]
-
-        if account_id_array:
-            cur.execute(
-                """
-                SELECT name, email
-                FROM accounts
-                WHERE id = ANY(%s)
-                """,
-                (account_id_array,)
-            )
+    client = get_client()
+    step = int(flag("--step")) if flag("--step") else None
+    lookahead_size = int(flag("--lookahead", 2))
+
+    print(f"Working through the students due a step, drafting {lookahead_size} ahead")
+    students = due_students(flag("--search"), step)
+    lookahead = Lookahead(connect, client, lookahead_size)
+    upcoming = []
+    count = 0
 
-            accounts = cur.fetchall()
-
-            email = os.getenv("EMAIL_ADDRESS")
-            password = os.getenv("EMAIL_PASSWORD")
-            for account in accounts:
-                if account[1]:
-                    msg = MIMEMultipart()
-                    msg['From'] = f"Codeabode <{email}>"
-                    msg['To'] = f"{account[0]} <{account[1]}>"
-                    msg['Subject'] = f"Assignment Uploaded for {current_class[10]}"
-                    
-                    # Create the email body
-                    body = f"""
-Hi {account[0]},
-
-Your son/daughter completed the {current_class[3]} class. Homework is available at https://app.codeabode.co
-
-Class info:
-Methods taught: {response.parsed.taught_methods}
-What needs practice: {response.parsed.needs_practice}
-Class Description: {current_class[4]}
-Methods intended to be taught: {current_class[5]}
-Stretch Methods: {current_class[6]}
-
-Best,
-Om
-                    """
-
-                    msg.attach(MIMEText(body, 'plain'))
-                    with smtplib.SMTP("smtp.gmail.com", 587) as server:
-                        server.starttls(context=ssl.create_default_context())
-                        server.login(email, password)
-                        server.send_message(msg)
-            print("Email sent to student accounts.")
+    try:
+        while True:
+            # the next few are drafted while this one is reviewed
+            upcoming += itertools.islice(students, lookahead_size + 1 - len(upcoming))
+            if not upcoming:
+                print("No more students due.")
+                break
+            lookahead.prefetch(upcoming)
+            student = upcoming.pop(0)
+            count += 1
+
+            choice = input(f"\n[{count}] {student[0]} (step {student[2]}). "
+                           "Enter to start, (s)kip or (q)uit: ").strip().lower()
+            if choice == "q":
+                break
+            if choice == "s":
+                continue
+
+            # the page was read a while ago, someone may have done the step since
+            with conn:
+                matches = find_student(cur, student[1])
+            if not matches:
+                print(f"{student[0]} was deleted or archived, skipping.")
+                continue
+            student = matches[0]
+            if student[2] not in (1, 2):
+                print(f"{student[0]} is already done, skipping.")
+                continue
+
+            lookahead.wait(student)
+
+            try:
+                continue_student(student)
+            except StaleStudentError:
+                print("Skipping to the next student.")
+    except (KeyboardInterrupt, EOFError):
+        print()
+    finally:
+        print("Finishing drafts already under way...")
+        lookahead.close()
 
 conn.commit()
 
 cur.close()
-conn.close()
+if not serving:
+    conn.close()
@@ -0,0 +1,481 @@
+import json
+import re
+import threading
+
+from google.genai.types import Content, GenerateContentConfig, Part
+from pydantic import TypeAdapter, ValidationError
+
+from codeabode_model import *
+
+MODEL = 'gemini-2.5-flash'
+
+# classwork kinds: the interactive (a)ssessment, 10-(m)inute warm up and
+# (g)enerate choices. a warm up is written first, then the normal class.
+CLASSWORK_PROMPTS = {
+    "assessment": [assessmentgpt_prompt],
+    "warmup": [classwork_with_warmup_prompt, classnotesgpt_prompt],
+    "normal": [classnotesgpt_prompt],
+}
+
+# homework kinds: the (5) day and (c)reative choices
+HOMEWORK_PROMPTS = {
+    "5": hwgpt_prompt,
+    "creative": creative_hwgpt_prompt,
+}
+
+# validators for the structured outputs, built once instead of per response
+ADAPTERS = {schema: TypeAdapter(schema) for schema in (Curriculum, CompletedClass, Class)}
+
+# model outputs that validated as they were, that validated after
+# repair_json (each one a generation that didn't have to be redone) and
+# that didn't validate even then
+parse_counts = {"parsed": 0, "repaired": 0, "failed": 0}
+parse_lock = threading.Lock()
+
+# what's left of a key/value pair or array item that was cut off: a key
+# with no value, or a partial number or true/false/null
+CUT_PAIR = re.compile(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*(?::[^"{}\[\],]*)?$')
+CUT_ITEM = re.compile(r'([\[,])\s*[^"{}\[\],\s][^"{}\[\],]*$')
+
+
+def new_student_config():
+    return GenerateContentConfig(
+        system_instruction=[curcgpt_prompt],
+        response_mime_type="application/json",
+        response_schema=Curriculum
+    )
+
+
+def classwork_config(prompt):
+    return GenerateContentConfig(
+        system_instruction=[prompt],
+    )
+
+
+def refiner_config():
+    return GenerateContentConfig(
+        system_instruction=[curcgpt_refiner_prompt],
+        response_mime_type="application/json",
+        response_schema=Curriculum
+    )
+
+
+def analysis_config():
+    return GenerateContentConfig(
+        system_instruction=[classanalysis_prompt],
+        response_mime_type="application/json",
+        response_schema=CompletedClass,
+    )
+
+
+def homework_config(prompt):
+    return GenerateContentConfig(
+        system_instruction=[prompt],
+    )
+
+
+def history_message(classes):
+    """
+    Build the refiner's input from a student's class history (rows from
+    get_class_history).
+
+    Returns:
+        (message, last completed class row, its index in classes)
+    """
+    curc_message = f"""
+        Age: {classes[0][1]}
+        Student Level: {classes[0][2]}
+        Student Notes: {classes[0][3]}
+
+        """
+
+    if classes[0][13]:
+        curc_message += f"""
+        Earlier classes (summarized):
+        {classes[0][13]}
+
+        """
+
+    last_completed = None
+    last_completed_index = -1
+
+    i = 0
+    while i < len(classes):
+        curc_message += f"""
+            ===========================
+
+            Class Name: {classes[i][4]}
+            Methods: {classes[i][5]}
+            Stretch Methods: {classes[i][6]}
+            Description: {classes[i][7]}
+            Teacher notes: {classes[i][9]}
+            Teacher notes on homework: {classes[i][11]}
+
+            """
+
+        if classes[i][12] == "completed":
+            last_completed_index = i
+            last_completed = classes[i]
+
+        i += 1
+
+    return curc_message, last_completed, last_completed_index
+
+
+def with_teacher_notes(message, notes):
+    return f"""
+                {message}
+                Teacher notes:
+                {notes}
+                """
+
+
+def first_class_message(age, curriculum):
+    """
+    The classwork input for a new student's first class.
+    """
+    current_class = curriculum.classes[0]
+    return f"""
+        Age: {age}
+        Student Level: {curriculum.current_level}
+        Student Notes: {curriculum.notes}
+
+        Class Name: {current_class.name}
+        Methods: {current_class.methods}
+        Stretch Methods: {current_class.stretch_methods}
+        Description: {current_class.description}
+        This is the first class for the student.
+
+        """
+
+
+def classwork_message(classes, last_completed, last_hw, old_classwork=None):
+    """
+    The classwork input after a refinement, bridging from the last completed
+    class and its homework (loaded with load_class_text).
+    """
+    message = f"""
+            Age: {classes[0][1]}
+            Student Level: {classes[0][2]}
+            Student Notes: {classes[0][3]}
+
+            Previous Class as Context (if you want to bridge new classwork to previous homework):
+            {last_completed[4]}
+            Methods: {last_completed[5]}
+            Stretch Methods: {last_completed[6]}
+            Description: {last_completed[7]}
+            Classwork Notes: {last_completed[9]}
+
+            Homework:
+            {last_hw}
+
+            Homework Notes: {last_completed[11]}
+
+            Class to Generate for:
+
+            """
+
+    # TODO: class name, description, stretch_methods removed
+    # class notes is "actually taught concepts" because this is made after re-adjusting the curriculum for homework
+    # homework notes is "homework performance" and "homework" can be turned into "homework summary" to save bytes
+
+    # u forgot to add the class after this
+
+    if old_classwork:
+        message += "Here are the old class notes: \n\n" + old_classwork
+
+    return message
+
+
+def homework_message(current_class):
+    """
+    The class context for analysis and homework generation, from a
+    get_current_class row. The teacher's notes on the class go after it.
+    """
+    return f"""
+        Age: {current_class[0]}
+        Student Level: {current_class[1]}
+        Student Notes: {current_class[2]}
+
+        Class Name: {current_class[3]}
+        Relevance: {current_class[4]}
+        Methods: {current_class[5]}
+        Stretch Methods: {current_class[6]}
+        Skills Tested: {current_class[7]}
+        Description: {current_class[8]}
+
+        Classwork:
+
+        {current_class[9]}
+
+
+        """
+
+
+def with_analysis(message, analysis):
+    """
+    Add a CompletedClass analysis to the homework message.
+    """
+    message += f"""
+        Notes on Class: {analysis.notes}
+        """
+
+    if analysis.taught_methods:
+        message += f"""
+            Taught Methods: {analysis.taught_methods}
+            """
+
+    if analysis.needs_practice:
+        message += f"""
+            Stretch Methods: {analysis.needs_practice}
+            """
+
+    return message
+
+
+def repair_json(text):
+    """
+    Best effort at turning almost-JSON from the model into JSON: whatever is
+    around the outermost object (a code fence, a sentence after it) is
+    dropped, so are trailing commas, and output that was cut off part way
+    has its arrays and objects closed. Whatever was cut off in the middle
+    (a string, number or key) is dropped rather than kept half written, so
+    the output either validates without it or not at all.
+    """
+    start = text.find("{")
+    if start == -1:
+        return text
+
+    out = []
+    # the closing bracket for each open one
+    stack = []
+    in_string = escaped = False
+
+    for char in text[start:]:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            out.append(stack.pop() if stack else char)
+            if not stack:
+                return "".join(out)
+            continue
+
+        if char == '"':
+            in_string = True
+            string_start = len(out)
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        out.append(char)
+
+    # cut off part way
+    if in_string:
+        del out[string_start:]
+    text = "".join(out).rstrip()
+    text = (CUT_PAIR if stack[-1] == "}" else CUT_ITEM).sub(r"\1", text).rstrip()
+    return text.rstrip(",") + "".join(reversed(stack))
+
+
+def count_parse(outcome):
+    with parse_lock:
+        parse_counts[outcome] += 1
+
+
+def parse_json(schema, text):
+    """
+    Validate the model's JSON output (text or bytes) as schema in one pass,
+    without building dicts first. Output that isn't quite JSON is put
+    through repair_json and validated again rather than generated again.
+
+    Raises:
+        ValidationError: if it's still not valid after repairing
+    """
+    adapter = ADAPTERS.get(schema) or TypeAdapter(schema)
+    try:
+        result = adapter.validate_json(text)
+    except ValidationError as e:
+        # valid JSON of the wrong shape can't be repaired
+        if e.errors()[0]["type"] != "json_invalid":
+            count_parse("failed")
+            raise
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "replace")
+        try:
+            result = adapter.validate_json(repair_json(text))
+        except ValidationError:
+            count_parse("failed")
+            raise e
+        count_parse("repaired")
+        return result
+
+    count_parse("parsed")
+    return result
+
+
+def parsed(response, schema):
+    """
+    A response's structured output as schema. The SDK has already validated
+    the live responses it could; drafts are validated by the worker that
+    makes them and again by load_draft, and anything else is validated (and
+    repaired if need be) here.
+    """
+    if isinstance(response, Draft) and isinstance(response.parsed, schema):
+        return response.parsed
+    if isinstance(response.parsed, schema):
+        count_parse("parsed")
+        return response.parsed
+    return parse_json(schema, response.text)
+
+
+def parse_report():
+    """
+    A line on how many outputs needed repairing, or None if none did.
+    """
+    repaired, failed = parse_counts["repaired"], parse_counts["failed"]
+    if not repaired and not failed:
+        return None
+    return (f"{repaired} of {sum(parse_counts.values())} model outputs repaired locally "
+            f"({repaired} regenerations avoided), {failed} invalid")
+
+
+class Draft:
+    """
+    A model response generated ahead of time by the worker. It stands in for
+    a live response in get_finished_response, which seeds the chat with it
+    so it can still be modified.
+    """
+
+    def __init__(self, message, text, schema=None):
+        self.message = message
+        self.text = text
+        self.parsed = parse_json(schema, text) if schema else None
+
+    def history(self):
+        return [
+            Content(role="user", parts=[Part(text=self.message)]),
+            Content(role="model", parts=[Part(text=self.text)]),
+        ]
+
+
+def load_draft(message, text, schema):
+    """
+    A stored draft as a Draft, or None if its text isn't a valid schema, in
+    which case the caller generates a live response instead.
+    """
+    try:
+        return Draft(message, text, schema)
+    except ValidationError:
+        return None
+
+
+class ClassStream:
+    """
+    Parses a Curriculum as its JSON streams in. Each class in "classes" is
+    validated and passed to on_class(index, cls, fields) as soon as its
+    closing brace arrives, with fields holding the top-level values that
+    have finished so far (current_level, final_goal and notes come before
+    the classes).
+    """
+
+    def __init__(self, on_class):
+        self.on_class = on_class
+        self.text = ""
+        self.fields = {}
+        self.classes = []
+        # open brackets, and whether we're in a string (and after a backslash)
+        self.stack = []
+        self.in_string = self.escaped = False
+        self.key = self.string_start = self.value_start = self.class_start = None
+
+    def feed(self, chunk):
+        offset = len(self.text)
+        self.text += chunk
+
+        for i, char in enumerate(chunk, offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1 and self.value_start is None:
+                        self.key = json.loads(self.text[self.string_start:i + 1])
+                continue
+
+            depth = len(self.stack)
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char == ":" and depth == 1:
+                self.value_start = i + 1
+            elif char in "{[":
+                self.stack.append(char)
+                if depth == 2 and self.key == "classes" and char == "{":
+                    self.class_start = i
+            elif char in "}]":
+                self.stack.pop()
+                if depth == 3 and self.key == "classes" and char == "}":
+                    self.add_class(self.text[self.class_start:i + 1])
+                elif depth == 1:
+                    self.end_field(i)
+            elif char == "," and depth == 1:
+                self.end_field(i)
+
+    def add_class(self, raw):
+        cls = ADAPTERS[Class].validate_json(raw)
+        self.classes.append(cls)
+        self.on_class(len(self.classes) - 1, cls, self.fields)
+
+    def end_field(self, end):
+        if self.key is not None and self.value_start is not None:
+            self.fields[self.key] = json.loads(self.text[self.value_start:end])
+        self.key = self.value_start = None
+
+
+def draft_refinement(client, classes):
+    """
+    Refine the curriculum from the stored history alone, without waiting for
+    the teacher's notes on the last homework.
+    """
+    message = history_message(classes)[0]
+    response = client.models.generate_content(
+        model=MODEL, contents=message, config=refiner_config()
+    )
+
+    # an invalid curriculum raises here, so the draft is stored as failed
+    curriculum = parsed(response, Curriculum)
+    return {"message": message, "curriculum": curriculum.model_dump_json()}
+
+
+def draft_homework(client, current_class, class_notes, prompt=hwgpt_prompt):
+    """
+    Analyse the class from notes already saved on it, then write the
+    homework, the same way the step 2 flow does with the teacher's input.
+    """
+    message = homework_message(current_class) + class_notes
+    analysis = client.models.generate_content(
+        model=MODEL, contents=message, config=analysis_config()
+    )
+
+    analysis = parsed(analysis, CompletedClass)
+    hw_message = with_analysis(message, analysis)
+    hw = client.models.generate_content(
+        model=MODEL, contents=hw_message, config=homework_config(prompt)
+    )
+
+    return {
+        "message": message, "analysis": analysis.model_dump_json(),
+        "hw_message": hw_message, "hw": hw.text,
+    }
@@ -0,0 +1,213 @@
+# `./codeabode.py api` serves the agent steps over HTTP on localhost, so the
+# webapp can ask for generation directly instead of going through the CLI.
+#
+#   POST /new, /refine, /classwork, /analysis, /homework[?commit=1]
+#       body: the same JSON request as `./codeabode.py run STEP`
+#   GET /health
+#       queue depth and busy workers per step
+#
+# every step has its own bounded pool of workers and a bounded queue in
+# front of it. when the queue is full the request is turned away with a 503
+# and Retry-After, rather than piling up. responses are streamed as JSON
+# lines: {"event": "queued", "position"}, {"event": "started"}, any number
+# of {"event": "text", "text"} as the model writes, {"event": "class",
+# "index", "class"} for each class of a new or refined curriculum as soon as
+# it's complete, then {"event": "result", ...} with what `run` would print. to scale out, run more workers per step
+# (--workers homework=4) or more api processes on other ports.
+#
+# the steps themselves are the blocking ones from codeabode_headless, run on
+# threads, each worker with its own Postgres connection.
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from codeabode_headless import STEPS, run_step
+
+DEFAULT_WORKERS = {"new": 1, "refine": 2, "classwork": 2, "analysis": 2, "homework": 2}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           503: "Service Unavailable"}
+
+
+class Job:
+    def __init__(self, request, commit):
+        self.request = request
+        self.commit = commit
+        self.events = asyncio.Queue()
+        self.queued_at = time.perf_counter()
+
+
+class StepPool:
+    """
+    The queue and workers for one step.
+    """
+
+    def __init__(self, step, workers, queue_size, connect, client, executor):
+        self.step = step
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.busy = 0
+        self.size = workers
+        self.connect = connect
+        self.client = client
+        self.executor = executor
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(workers)]
+
+    def submit(self, job):
+        """
+        Queue a job, or return False if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+
+        job.events.put_nowait({"event": "queued", "position": self.queue.qsize()})
+        return True
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(self.executor, self.connect)
+
+        try:
+            while True:
+                job = await self.queue.get()
+                self.busy += 1
+                job.events.put_nowait({
+                    "event": "started", "waited": round(time.perf_counter() - job.queued_at, 4)
+                })
+
+                def on_text(text, job=job):
+                    loop.call_soon_threadsafe(job.events.put_nowait, {"event": "text", "text": text})
+
+                def on_class(index, cls, fields, job=job):
+                    loop.call_soon_threadsafe(job.events.put_nowait, {
+                        "event": "class", "index": index, "class": cls.model_dump()
+                    })
+
+                try:
+                    result = await loop.run_in_executor(
+                        self.executor, run_step, self.client, conn, self.step,
+                        job.request, job.commit, on_text, on_class
+                    )
+                except Exception as e:
+                    # the connection itself broke, start over with a new one
+                    result = {"step": self.step, "ok": False, "error": f"{type(e).__name__}: {e}"}
+                    conn = await loop.run_in_executor(self.executor, self.connect)
+
+                job.events.put_nowait({"event": "result", **result})
+                self.busy -= 1
+                self.queue.task_done()
+        finally:
+            conn.close()
+
+    def health(self):
+        return {"queued": self.queue.qsize(), "busy": self.busy, "workers": self.size}
+
+
+async def read_request(reader):
+    """
+    (method, path, query, body) of one HTTP/1.1 request.
+    """
+    method, target, _ = (await reader.readline()).decode().split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode().split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query), body
+
+
+async def respond(writer, status, body, headers=()):
+    payload = (json.dumps(body) + "\n").encode()
+    head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/json",
+            f"Content-Length: {len(payload)}", "Connection: close", *headers]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + payload)
+    await writer.drain()
+
+
+async def stream(writer, job):
+    """
+    Send the job's events as chunked JSON lines until its result.
+    """
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+                 b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+
+    while True:
+        event = await job.events.get()
+        line = (json.dumps(event, default=str) + "\n").encode()
+        writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        await writer.drain()
+
+        if event["event"] == "result":
+            break
+
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def serve_api(connect, client, host="127.0.0.1", port=8300, workers=None, queue_size=16):
+    """
+    Serve the API until cancelled.
+
+    Args:
+        connect: makes a new Postgres connection (one per worker)
+        client: the Gemini client, shared by every worker
+        workers: workers per step, overriding DEFAULT_WORKERS
+        queue_size: requests that can wait per step before new ones get a 503
+    """
+    workers = {**DEFAULT_WORKERS, **(workers or {})}
+    executor = ThreadPoolExecutor(max_workers=sum(workers.values()))
+    pools = {
+        step: StepPool(step, workers[step], queue_size, connect, client, executor)
+        for step in STEPS
+    }
+
+    async def handle(reader, writer):
+        try:
+            method, path, query, body = await read_request(reader)
+            step = path.strip("/")
+
+            if method == "GET" and step == "health":
+                await respond(writer, 200, {name: pool.health() for name, pool in pools.items()})
+            elif step not in pools:
+                await respond(writer, 404, {"error": f"no step {step}"})
+            elif method != "POST":
+                await respond(writer, 405, {"error": "POST a JSON request"})
+            else:
+                try:
+                    request = json.loads(body or b"{}")
+                except ValueError as e:
+                    await respond(writer, 400, {"error": f"bad JSON: {e}"})
+                    return
+
+                job = Job(request, query.get("commit", ["0"])[0] not in ("0", "false", ""))
+                if pools[step].submit(job):
+                    await stream(writer, job)
+                else:
+                    await respond(writer, 503, {"error": f"{step} queue is full"}, ["Retry-After: 5"])
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # the client went away, or didn't speak HTTP
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Serving the agents on http://{host}:{port} "
+          f"({', '.join(f'{step} x{n}' for step, n in workers.items())}, queue {queue_size})")
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for pool in pools.values():
+            for task in pool.tasks:
+                task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,1309 @@
+import io
+import itertools
+import json
+import threading
+import time
+
+from psycopg2.extensions import cursor
+
+
+# queries are kept as module constants so the async layer in
+# codeabode_db_async.py can run exactly the same SQL
+
+# the name filters are served by the trigram index from initdb.py
+SEARCH_STUDENTS_SQL = """
+    SELECT name, id, step, version
+    FROM students
+    WHERE {where}
+    ORDER BY {order} name, id
+    LIMIT %(limit)s OFFSET %(offset)s
+"""
+
+STUDENT_BY_ID_SQL = "SELECT name, id, step, version FROM students WHERE id = %s"
+
+STUDENT_BY_NAME_SQL = """
+    SELECT name, id, step, version
+    FROM students
+    WHERE name ILIKE %s
+    ORDER BY id
+    LIMIT 10
+"""
+
+# metadata only: classwork and homework can be several KB per class and
+# are fetched with load_class_text for the one class that needs them.
+# [8] says whether the class has classwork and [10] is the class id.
+# [13] is the summary of classes already moved to the archive.
+CLASS_HISTORY_SQL = """
+    SELECT 
+        COUNT(*) FILTER (WHERE sc.status = 'completed') OVER (PARTITION BY sc.student_id) as completed_count,
+        s.age,
+        s.current_level, 
+        -- only needed once, so only sent on the first row
+        CASE WHEN ROW_NUMBER() OVER (PARTITION BY sc.student_id ORDER BY sc.class_id) = 1
+            THEN s.notes END,
+        sc.name, 
+        sc.methods, 
+        sc.stretch_methods, 
+        sc.description,
+        sc.classwork IS NOT NULL,
+        sc.notes,
+        sc.class_id,
+        sc.hw_notes,
+        sc.status,
+        CASE WHEN ROW_NUMBER() OVER (PARTITION BY sc.student_id ORDER BY sc.class_id) = 1
+            THEN s.history_summary END
+    FROM students_classes sc
+    JOIN students s ON s.id = sc.student_id
+    WHERE sc.student_id = %s
+    ORDER BY sc.class_id ASC
+"""
+
+# column names are fixed strings, never user input
+CLASS_TEXT_SQL = "SELECT {field} FROM students_classes WHERE class_id = %s"
+CLASS_TEXT_FIELDS = ("classwork", "hw", "notes", "hw_notes")
+
+CURRENT_CLASS_SQL = """
+    SELECT 
+        s.age,
+        s.current_level, 
+        s.notes,
+        sc.name, 
+        sc.description, 
+        sc.methods, 
+        sc.stretch_methods, 
+        sc.description,
+        sc.class_id,
+        sc.classwork,
+        s.name,
+        sc.notes
+    FROM students_classes sc
+    JOIN students s ON s.id = sc.student_id
+    WHERE sc.class_id = (
+        SELECT current_class
+        FROM students
+        WHERE id = %s
+    )
+"""
+
+# the step transitions below are each one statement, so they cost a single
+# round-trip. classes are sent as one jsonb array and unpacked server-side.
+
+CLASS_FROM_JSON = """
+        x.cls->>'name',
+        ARRAY(SELECT jsonb_array_elements_text(x.cls->'methods')),
+        CASE WHEN jsonb_typeof(x.cls->'stretch_methods') = 'array'
+            THEN ARRAY(SELECT jsonb_array_elements_text(x.cls->'stretch_methods'))
+        END,
+        x.cls->>'description'
+"""
+
+# class ids are drawn from the sequence up front so the new student row can
+# point at its first class in the same statement
+CREATE_STUDENT_SQL = """
+    WITH ids AS (
+        SELECT nextval(pg_get_serial_sequence('students_classes', 'class_id')) AS class_id, ord
+        FROM generate_series(1, jsonb_array_length(%(classes)s::jsonb)) AS ord
+    ), student AS (
+        INSERT INTO students (name, age, current_level, final_goal, future_concepts, notes,
+                              current_class, step)
+        VALUES (%(name)s, %(age)s, %(current_level)s, %(final_goal)s, %(future_concepts)s, %(notes)s,
+                (SELECT MIN(class_id) FROM ids), 2)
+        RETURNING id, current_class
+    ), classes AS (
+        INSERT INTO students_classes
+        (class_id, student_id, status, name, methods, stretch_methods, description, classwork)
+        SELECT ids.class_id, student.id, 'upcoming',""" + CLASS_FROM_JSON + """,
+            CASE WHEN ids.class_id = student.current_class THEN %(classwork)s::text END
+        FROM student,
+            jsonb_array_elements(%(classes)s::jsonb) WITH ORDINALITY AS x(cls, ord)
+            JOIN ids ON ids.ord = x.ord
+    )
+    SELECT id, current_class FROM student
+"""
+
+# the transitions on an existing student only apply if students.version still
+# matches the version the session started from, and bump it. the `student`
+# CTE locks that row for the statement and everything else hangs off it, so
+# a stale version means nothing is written and no row comes back.
+LOCK_STUDENT_SQL = """
+    SELECT id, current_class, account_id
+    FROM students
+    WHERE id = %(student_id)s
+    AND version = %(version)s
+    FOR UPDATE
+"""
+
+# the homework notes go on the lowest upcoming/assessment class, which is
+# marked completed; the rest of the upcoming classes are replaced. the
+# sub-statements never touch the same row twice.
+REFINE_SQL = """
+    WITH student AS (""" + LOCK_STUDENT_SQL + """
+    ), last_class AS (
+        SELECT MIN(class_id) AS class_id
+        FROM students_classes
+        WHERE student_id IN (SELECT id FROM student)
+        AND status IN ('upcoming', 'assessment')
+    ), noted AS (
+        UPDATE students_classes
+        SET hw_notes = %(hw_notes)s,
+        status = CASE WHEN class_id = (SELECT class_id FROM last_class)
+            THEN 'completed' ELSE status END
+        WHERE student_id IN (SELECT id FROM student)
+        AND (status = 'assessment' OR class_id = (SELECT class_id FROM last_class))
+    ), dropped AS (
+        DELETE FROM students_classes
+        WHERE student_id IN (SELECT id FROM student)
+        AND status = 'upcoming'
+        AND class_id IS DISTINCT FROM (SELECT class_id FROM last_class)
+    ), added AS (
+        INSERT INTO students_classes
+        (student_id, status, name, methods, stretch_methods, description)
+        SELECT student.id, 'upcoming',""" + CLASS_FROM_JSON + """
+        FROM student,
+            jsonb_array_elements(%(classes)s::jsonb) WITH ORDINALITY AS x(cls, ord)
+        ORDER BY x.ord
+        RETURNING class_id
+    )
+    UPDATE students
+    SET current_level = %(current_level)s,
+        final_goal = %(final_goal)s,
+        future_concepts = %(future_concepts)s,
+        notes = %(notes)s,
+        current_class = (SELECT MIN(class_id) FROM added),
+        refined = true,
+        version = version + 1
+    WHERE id IN (SELECT id FROM student)
+    RETURNING current_class, version
+"""
+
+# a refinement marks the student refined until its classwork is saved, so a
+# second refine can't mark the untaught first new class completed
+REFINED_SQL = "SELECT refined FROM students WHERE id = %s"
+
+SAVE_CLASSWORK_SQL = """
+    WITH student AS (""" + LOCK_STUDENT_SQL + """
+    ), classwork AS (
+        UPDATE students_classes
+        SET classwork = %(classwork)s::text,
+        status = 'completed'
+        WHERE class_id = %(class_id)s
+        AND student_id IN (SELECT id FROM student)
+        AND %(classwork)s::text IS NOT NULL
+    )
+    UPDATE students
+    SET step = 2,
+    refined = false,
+    version = version + 1
+    WHERE id IN (SELECT id FROM student)
+    RETURNING version
+"""
+
+# one row per account (or a single row with no account), each carrying the
+# new version
+SAVE_HOMEWORK_SQL = """
+    WITH student AS (""" + LOCK_STUDENT_SQL + """
+    ), homework AS (
+        UPDATE students_classes sc
+        SET notes = %(notes)s,
+        taught_methods = %(taught_methods)s,
+        needs_practice = %(needs_practice)s,
+        hw = %(hw)s
+        FROM student
+        WHERE sc.class_id = student.current_class
+    ), finished AS (
+        UPDATE students
+        SET step = 1,
+        sent_email = false,
+        version = version + 1
+        WHERE id IN (SELECT id FROM student)
+        RETURNING version, account_id
+    )
+    SELECT finished.version, a.id, a.name, a.email
+    FROM finished
+    LEFT JOIN accounts a ON a.id = ANY(finished.account_id)
+"""
+
+
+# drafts are queued by the triggers in initdb.py. only drafts for the
+# student's current version are worth running, and a draft stuck in
+# 'running' past the timeout belongs to a worker that died.
+CLAIM_DRAFT_SQL = """
+    UPDATE student_drafts
+    SET status = 'running',
+    claimed_at = now(),
+    requeued = false
+    WHERE id = (
+        SELECT d.id
+        FROM student_drafts d
+        JOIN students s ON s.id = d.student_id AND s.version = d.version
+        WHERE d.status = 'pending'
+        OR (d.status = 'running' AND d.claimed_at < now() - %(timeout)s * interval '1 second')
+        ORDER BY d.id
+        FOR UPDATE OF d SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id, student_id, version, kind
+"""
+
+# for drafting one particular student now (the shell's look-ahead) rather
+# than whatever is next in the queue. nothing comes back if the draft is
+# done or another worker is on it.
+CLAIM_STUDENT_DRAFT_SQL = """
+    INSERT INTO student_drafts (student_id, version, kind, status, claimed_at)
+    SELECT id, version, %(kind)s, 'running', now()
+    FROM students
+    WHERE id = %(student_id)s AND version = %(version)s
+    ON CONFLICT (student_id, version, kind) DO UPDATE
+    SET status = 'running',
+    claimed_at = now(),
+    requeued = false
+    WHERE student_drafts.status IN ('pending', 'waiting', 'failed')
+    OR (student_drafts.status = 'running'
+        AND student_drafts.claimed_at < now() - %(timeout)s * interval '1 second')
+    RETURNING id, student_id, version, kind
+"""
+
+# a draft queued again while it was running was written from stale input,
+# so it goes back to pending for another go instead of being kept
+FINISH_DRAFT_SQL = """
+    UPDATE student_drafts
+    SET status = CASE WHEN requeued THEN 'pending' ELSE %(status)s END,
+    output = CASE WHEN requeued THEN NULL ELSE %(output)s::jsonb END,
+    error = %(error)s,
+    requeued = false
+    WHERE id = %(draft_id)s
+    RETURNING status
+"""
+
+# a draft someone is working on right now, as opposed to one whose worker
+# died (which claims treat as free again after the timeout)
+DRAFT_RUNNING_SQL = """
+    SELECT 1
+    FROM student_drafts
+    WHERE student_id = %(student_id)s
+    AND version = %(version)s
+    AND kind = %(kind)s
+    AND status = 'running'
+    AND claimed_at >= now() - %(timeout)s * interval '1 second'
+"""
+
+GET_DRAFT_SQL = """
+    SELECT output
+    FROM student_drafts
+    WHERE student_id = %s
+    AND version = %s
+    AND kind = %s
+    AND status = 'done'
+"""
+
+
+# the outbox is filled in the same transaction as the step that sends the
+# emails, and drained by the sender in codeabode_mail
+QUEUE_EMAILS_SQL = """
+    WITH queued AS (
+        INSERT INTO email_outbox
+        (student_id, class_id, account_id, kind, name, address, subject, body)
+        SELECT student_id, class_id, account_id, kind, name, address, subject, body
+        FROM jsonb_to_recordset(%s::jsonb) AS x(
+            student_id INTEGER, class_id INTEGER, account_id INTEGER, kind TEXT,
+            name TEXT, address TEXT, subject TEXT, body TEXT
+        )
+        ON CONFLICT (class_id, account_id, kind) DO NOTHING
+        RETURNING id
+    )
+    SELECT count(*), pg_notify('codeabode_mail', '') FROM queued
+"""
+
+# a message stuck in 'sending' past the timeout belongs to a sender that died
+CLAIM_EMAILS_SQL = """
+    UPDATE email_outbox
+    SET status = 'sending',
+    claimed_at = now(),
+    attempts = attempts + 1
+    WHERE id IN (
+        SELECT id
+        FROM email_outbox
+        WHERE (status = 'pending' AND next_attempt <= now())
+        OR (status = 'sending' AND claimed_at < now() - %(timeout)s * interval '1 second')
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+        LIMIT %(limit)s
+    )
+    RETURNING id, student_id, class_id, account_id, name, address, subject, body, attempts, section
+"""
+
+# digests go out once an account's oldest due email has waited out the
+# window, taking everything else due for that account with it
+CLAIM_DIGESTS_SQL = """
+    WITH due AS (
+        SELECT id, account_id, created_at
+        FROM email_outbox
+        WHERE (status = 'pending' AND next_attempt <= now())
+        OR (status = 'sending' AND claimed_at < now() - %(timeout)s * interval '1 second')
+    ), ready AS (
+        SELECT account_id
+        FROM due
+        GROUP BY account_id
+        HAVING min(created_at) <= now() - %(window)s * interval '1 second'
+        ORDER BY min(created_at)
+        LIMIT %(limit)s
+    )
+    UPDATE email_outbox
+    SET status = 'sending',
+    claimed_at = now(),
+    attempts = attempts + 1
+    WHERE id IN (
+        SELECT id
+        FROM email_outbox
+        WHERE id IN (SELECT id FROM due)
+        AND account_id IN (SELECT account_id FROM ready)
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, student_id, class_id, account_id, name, address, subject, body, attempts, section
+"""
+
+# the student's sent_email flag goes back to true once nothing is left to
+# send for them. the rows being marked still read as 'sending' here.
+EMAIL_SENT_SQL = """
+    WITH sent AS (
+        UPDATE email_outbox
+        SET status = 'sent',
+        sent_at = now(),
+        error = NULL
+        WHERE id = ANY(%(email_ids)s)
+        RETURNING id, student_id
+    )
+    UPDATE students s
+    SET sent_email = true
+    FROM sent
+    WHERE s.id = sent.student_id
+    AND NOT EXISTS (
+        SELECT 1
+        FROM email_outbox o
+        WHERE o.student_id = sent.student_id
+        AND o.id <> ALL(%(email_ids)s)
+        AND o.status IN ('pending', 'sending')
+    )
+"""
+
+# exponential backoff, until max_attempts
+EMAIL_FAILED_SQL = """
+    UPDATE email_outbox
+    SET status = CASE WHEN %(permanent)s OR attempts >= %(max_attempts)s
+        THEN 'failed' ELSE 'pending' END,
+    next_attempt = now() + %(retry_delay)s * 2 ^ (attempts - 1) * interval '1 second',
+    error = %(error)s
+    WHERE id = ANY(%(email_ids)s)
+    RETURNING status
+"""
+
+MAIL_CHANNEL = "codeabode_mail"
+
+
+# generation jobs are claimed highest priority first. a running job whose
+# lease ran out belongs to a runner that died, and is claimed again with
+# its attempt number bumped, which also fences off the old runner.
+QUEUE_JOB_SQL = """
+    WITH queued AS (
+        INSERT INTO generation_jobs (kind, student_id, request, save, priority, max_attempts)
+        VALUES (%(kind)s, %(student_id)s, %(request)s::jsonb, %(save)s, %(priority)s, %(max_attempts)s)
+        RETURNING id
+    )
+    SELECT id, pg_notify('codeabode_jobs', '') FROM queued
+"""
+
+CLAIM_JOB_SQL = """
+    UPDATE generation_jobs
+    SET status = 'running',
+    attempts = attempts + 1,
+    lease_expires_at = now() + %(lease)s * interval '1 second'
+    WHERE id = (
+        SELECT id
+        FROM generation_jobs
+        WHERE ((status = 'queued' AND run_after <= now())
+            OR (status = 'running' AND lease_expires_at < now()))
+        AND attempts < max_attempts
+        AND priority >= %(min_priority)s
+        ORDER BY priority DESC, id
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id, kind, student_id, request, save, priority, attempts
+"""
+
+# jobs that died on their last attempt
+EXPIRE_JOBS_SQL = """
+    UPDATE generation_jobs
+    SET status = 'failed',
+    finished_at = now(),
+    error = coalesce(error, 'lease expired')
+    WHERE status = 'running'
+    AND lease_expires_at < now()
+    AND attempts >= max_attempts
+"""
+
+EXTEND_JOB_SQL = """
+    UPDATE generation_jobs
+    SET lease_expires_at = now() + %(lease)s * interval '1 second'
+    WHERE id = %(job_id)s AND attempts = %(attempt)s AND status = 'running'
+"""
+
+COMPLETE_JOB_SQL = """
+    UPDATE generation_jobs
+    SET status = 'done',
+    result = %(result)s::jsonb,
+    error = NULL,
+    finished_at = now()
+    WHERE id = %(job_id)s AND attempts = %(attempt)s AND status = 'running'
+    RETURNING id
+"""
+
+# exponential backoff, until max_attempts
+FAIL_JOB_SQL = """
+    UPDATE generation_jobs
+    SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+    run_after = now() + %(retry_delay)s * 2 ^ (attempts - 1) * interval '1 second',
+    finished_at = CASE WHEN attempts >= max_attempts THEN now() END,
+    error = %(error)s
+    WHERE id = %(job_id)s AND attempts = %(attempt)s AND status = 'running'
+    RETURNING status
+"""
+
+LIST_JOBS_SQL = """
+    SELECT j.id, j.kind, s.name, j.priority, j.status, j.attempts, j.max_attempts,
+    j.created_at, j.finished_at, j.error
+    FROM generation_jobs j
+    LEFT JOIN students s ON s.id = j.student_id
+    WHERE %(status)s IS NULL OR j.status = %(status)s
+    ORDER BY j.status = 'running' DESC, j.status = 'queued' DESC, j.priority DESC, j.id DESC
+    LIMIT %(limit)s
+"""
+
+# model outputs kept per job, so a retried job doesn't pay for them twice
+GET_JOB_OUTPUT_SQL = """
+    SELECT text
+    FROM generation_outputs
+    WHERE job_id = %s AND prompt_hash = %s
+"""
+
+SAVE_JOB_OUTPUT_SQL = """
+    INSERT INTO generation_outputs (job_id, prompt_hash, text)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (job_id, prompt_hash) DO NOTHING
+"""
+
+JOB_CHANNEL = "codeabode_jobs"
+
+
+class LostLeaseError(Exception):
+    """
+    The job's lease ran out and another runner has claimed it since.
+    """
+
+
+class StaleStudentError(Exception):
+    """
+    The student was changed by another session since this one read it.
+    """
+
+
+def curriculum_params(curriculum):
+    return {
+        "current_level": curriculum.current_level,
+        "final_goal": curriculum.final_goal,
+        "future_concepts": curriculum.future_concepts,
+        "notes": curriculum.notes,
+        "classes": json.dumps([x.model_dump() for x in curriculum.classes]),
+    }
+
+
+def homework_params(analysis, hw):
+    return {
+        "notes": analysis.notes,
+        "taught_methods": analysis.taught_methods,
+        "needs_practice": analysis.needs_practice,
+        "hw": hw,
+    }
+
+
+def search_students_sql(query=None, step=None):
+    where = ["TRUE"]
+    order = ""
+    if query:
+        # prefix matches first, then anything trigram-similar
+        where.append("(name ILIKE %(prefix)s OR name %% %(query)s)")
+        order = "name ILIKE %(prefix)s DESC, similarity(name, %(query)s) DESC,"
+    if step is not None:
+        where.append("step = %(step)s")
+
+    return SEARCH_STUDENTS_SQL.format(where=" AND ".join(where), order=order)
+
+
+def like_escape(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_params(query=None, step=None, offset=0, limit=20):
+    return {"query": query, "prefix": like_escape(query or "") + "%", "step": step,
+            "offset": offset, "limit": limit}
+
+
+def search_students(cur, query=None, step=None, offset=0, limit=20):
+    """
+    One page of students whose name starts with or resembles query,
+    optionally only those at a given step.
+    """
+    cur.execute(search_students_sql(query, step),
+                search_params(query, step, offset, limit))
+    return cur.fetchall()
+
+
+def find_student(cur, student):
+    """
+    Look a student up by id or by (case-insensitive) name.
+
+    Returns:
+        A list of matching (name, id, step) rows
+    """
+    if str(student).isdigit():
+        cur.execute(STUDENT_BY_ID_SQL, (int(student),))
+    else:
+        cur.execute(STUDENT_BY_NAME_SQL, (like_escape(student),))
+    return cur.fetchall()
+
+
+def get_class_history(cur, student_id):
+    """
+    Every class the student has taken or has coming up, oldest first, with
+    the student's profile repeated on each row.
+    """
+    cur.execute(CLASS_HISTORY_SQL, (student_id,))
+    return cur.fetchall()
+
+
+def load_class_text(cur, class_id, field):
+    """
+    Fetch one large text field (classwork, hw, ...) of one class on demand.
+    """
+    if field not in CLASS_TEXT_FIELDS:
+        raise ValueError(f"not a class text field: {field}")
+
+    cur.execute(CLASS_TEXT_SQL.format(field=field), (class_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def classwork_context(cur, classes, last_completed, last_completed_index):
+    """
+    The large text classwork generation needs from a class history: the
+    last completed class's homework, and the classwork already written for
+    the class after it, if any.
+
+    Returns:
+        (last homework, old classwork or None)
+    """
+    last_hw = load_class_text(cur, last_completed[10], "hw")
+
+    old_classwork = None
+    if last_completed_index + 1 < len(classes) and classes[last_completed_index + 1][8]:
+        old_classwork = load_class_text(cur, classes[last_completed_index + 1][10], "classwork")
+
+    return last_hw, old_classwork
+
+
+def get_current_class(cur, student_id):
+    cur.execute(CURRENT_CLASS_SQL, (student_id,))
+    return cur.fetchone()
+
+
+def create_student(cur, name, age, curriculum, classwork):
+    """
+    Insert a new student with their curriculum as upcoming classes and the
+    classwork for the first one, ready for the homework step.
+
+    Returns:
+        (student_id, class_id of the first class)
+    """
+    cur.execute(CREATE_STUDENT_SQL, {
+        "name": name, "age": age, "classwork": classwork,
+        **curriculum_params(curriculum)
+    })
+    return cur.fetchone()
+
+
+def save_refinement(cur, student_id, version, hw_notes, curriculum):
+    """
+    Record the last homework notes and replace the student's upcoming classes
+    with a refined curriculum.
+
+    Returns:
+        (new current class id, new version)
+
+    Raises:
+        StaleStudentError: the student's version no longer matches
+    """
+    cur.execute(REFINE_SQL, {
+        "student_id": student_id, "version": version, "hw_notes": hw_notes,
+        **curriculum_params(curriculum)
+    })
+    return checked_row(cur.fetchone(), student_id)
+
+
+def is_refined(cur, student_id):
+    """
+    Whether the student's curriculum was refined and is waiting on its
+    classwork.
+    """
+    cur.execute(REFINED_SQL, (student_id,))
+    return cur.fetchone()[0]
+
+
+def save_classwork(cur, student_id, version, class_id, classwork):
+    """
+    Store the classwork for a class, marking it completed, and move the
+    student on to the homework step. A classwork of None only moves the step.
+
+    Returns:
+        The new version
+
+    Raises:
+        StaleStudentError: the student's version no longer matches
+    """
+    cur.execute(SAVE_CLASSWORK_SQL, {
+        "student_id": student_id, "version": version,
+        "class_id": class_id, "classwork": classwork
+    })
+    return checked_row(cur.fetchone(), student_id)[0]
+
+
+def save_refined_classwork(cur, student_id, version, hw_notes, curriculum, classwork):
+    """
+    save_refinement and save_classwork together, for a caller that only
+    saves the refinement once the classwork is picked.
+
+    Returns:
+        The new version
+
+    Raises:
+        StaleStudentError: the student's version no longer matches
+    """
+    class_id, version = save_refinement(cur, student_id, version, hw_notes, curriculum)
+    return save_classwork(cur, student_id, version, class_id, classwork)
+
+
+def save_homework(cur, student_id, version, analysis, hw):
+    """
+    Store the class analysis and homework, and send the student back to
+    step 1.
+
+    Returns:
+        (new version, [(account id, name, email) of every account attached
+        to the student])
+
+    Raises:
+        StaleStudentError: the student's version no longer matches
+    """
+    cur.execute(SAVE_HOMEWORK_SQL, {
+        "student_id": student_id, "version": version,
+        **homework_params(analysis, hw)
+    })
+    return homework_result(cur.fetchall(), student_id)
+
+
+def claim_draft(cur, timeout=600):
+    """
+    Claim the oldest pending draft. Several workers can call this at once,
+    each gets a different draft.
+
+    Returns:
+        (draft_id, student_id, version, kind), or None if there's nothing to do
+    """
+    cur.execute(CLAIM_DRAFT_SQL, {"timeout": timeout})
+    return cur.fetchone()
+
+
+def claim_student_draft(cur, student_id, version, kind, timeout=600):
+    """
+    Claim the draft of one kind for this version of a student, queueing it
+    if it wasn't already.
+
+    Returns:
+        (draft_id, student_id, version, kind), or None if it's done or
+        being drafted elsewhere
+    """
+    cur.execute(CLAIM_STUDENT_DRAFT_SQL, {
+        "student_id": student_id, "version": version, "kind": kind, "timeout": timeout
+    })
+    return cur.fetchone()
+
+
+def finish_draft(cur, draft_id, status, output=None, error=None):
+    """
+    Store a draft's result.
+
+    Returns:
+        The status it was stored with: 'pending' rather than status if it
+        was queued again while running
+    """
+    cur.execute(FINISH_DRAFT_SQL, {
+        "draft_id": draft_id, "status": status,
+        "output": json.dumps(output) if output is not None else None,
+        "error": error
+    })
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def draft_running(cur, student_id, version, kind, timeout=600):
+    """
+    Whether this version of a student's draft is being written right now,
+    by a worker or another session's lookahead.
+    """
+    cur.execute(DRAFT_RUNNING_SQL, {
+        "student_id": student_id, "version": version, "kind": kind, "timeout": timeout
+    })
+    return cur.fetchone() is not None
+
+
+def get_draft(cur, student_id, version, kind):
+    """
+    The finished draft for this exact version of the student, if any.
+    """
+    cur.execute(GET_DRAFT_SQL, (student_id, version, kind))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def queue_emails(cur, emails):
+    """
+    Add emails to the outbox. Emails already queued for the same class,
+    account and kind are skipped.
+
+    Args:
+        emails: dicts with student_id, class_id, account_id, kind, name,
+            address, subject and body
+
+    Returns:
+        Number of emails actually queued
+    """
+    if not emails:
+        return 0
+
+    cur.execute(QUEUE_EMAILS_SQL, (json.dumps(emails),))
+    return cur.fetchone()[0]
+
+
+def claim_emails(cur, limit=50, timeout=600):
+    """
+    Claim up to limit emails that are due. Several senders can call this at
+    once, each gets different emails.
+
+    Returns:
+        Rows of (id, student_id, class_id, account_id, name, address,
+        subject, body, attempts, section), where section is false or None
+        for a body that's already a whole letter
+    """
+    cur.execute(CLAIM_EMAILS_SQL, {"limit": limit, "timeout": timeout})
+    return cur.fetchall()
+
+
+def claim_digests(cur, window, limit=50, timeout=600):
+    """
+    Claim every due email of up to limit accounts whose oldest due email is
+    at least window seconds old, so they can be sent as one digest each.
+
+    Returns:
+        Rows like claim_emails
+    """
+    cur.execute(CLAIM_DIGESTS_SQL, {"window": window, "limit": limit, "timeout": timeout})
+    return cur.fetchall()
+
+
+def email_sent(cur, email_ids):
+    cur.execute(EMAIL_SENT_SQL, {"email_ids": list(email_ids)})
+
+
+def email_failed(cur, email_ids, error, permanent=False, max_attempts=5, retry_delay=60):
+    """
+    Record a failed send of one message (which may carry several emails)
+    and schedule a retry.
+
+    Returns:
+        'pending' if any of the emails will be retried, otherwise 'failed'
+    """
+    cur.execute(EMAIL_FAILED_SQL, {
+        "email_ids": list(email_ids), "error": error, "permanent": permanent,
+        "max_attempts": max_attempts, "retry_delay": retry_delay
+    })
+    statuses = [row[0] for row in cur.fetchall()]
+    return "pending" if "pending" in statuses else "failed"
+
+
+def queue_job(cur, kind, request, student_id=None, save=False, priority=0, max_attempts=3):
+    """
+    Queue a generation job.
+
+    Args:
+        kind: the headless step to run
+        request: the step's JSON request
+        save: commit the step's result, like `run --commit`
+        priority: higher runs first
+
+    Returns:
+        The job's id
+    """
+    cur.execute(QUEUE_JOB_SQL, {
+        "kind": kind, "student_id": student_id, "request": json.dumps(request),
+        "save": save, "priority": priority, "max_attempts": max_attempts
+    })
+    return cur.fetchone()[0]
+
+
+def claim_job(cur, lease=600, min_priority=None):
+    """
+    Claim the most urgent job that's due. Several runners can call this at
+    once, each gets a different job.
+
+    Args:
+        lease: seconds the job is ours before another runner may take it
+        min_priority: only claim jobs at least this urgent
+
+    Returns:
+        (id, kind, student_id, request, save, priority, attempt), or None
+    """
+    cur.execute(EXPIRE_JOBS_SQL)
+    cur.execute(CLAIM_JOB_SQL, {
+        "lease": lease,
+        "min_priority": -2 ** 31 if min_priority is None else min_priority
+    })
+    return cur.fetchone()
+
+
+def extend_job(cur, job_id, attempt, lease=600):
+    cur.execute(EXTEND_JOB_SQL, {"job_id": job_id, "attempt": attempt, "lease": lease})
+
+
+def complete_job(cur, job_id, attempt, result):
+    """
+    Mark a job done with its result, in the caller's transaction.
+
+    Raises:
+        LostLeaseError: this attempt no longer owns the job, so whatever
+            else the transaction saved has to be rolled back
+    """
+    cur.execute(COMPLETE_JOB_SQL, {
+        "job_id": job_id, "attempt": attempt, "result": json.dumps(result, default=str)
+    })
+    if cur.fetchone() is None:
+        raise LostLeaseError(f"job {job_id} attempt {attempt} lost its lease")
+
+
+def fail_job(cur, job_id, attempt, error, retry_delay=30):
+    """
+    Record a failed attempt and schedule a retry with backoff.
+
+    Returns:
+        'queued' if it will be retried, 'failed' if not, or None if the
+        attempt had lost its lease anyway
+    """
+    cur.execute(FAIL_JOB_SQL, {
+        "job_id": job_id, "attempt": attempt, "error": error, "retry_delay": retry_delay
+    })
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def list_jobs(cur, status=None, limit=50):
+    cur.execute(LIST_JOBS_SQL, {"status": status, "limit": limit})
+    return cur.fetchall()
+
+
+def get_job_output(cur, job_id, prompt_hash):
+    cur.execute(GET_JOB_OUTPUT_SQL, (job_id, prompt_hash))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def save_job_output(cur, job_id, prompt_hash, text):
+    cur.execute(SAVE_JOB_OUTPUT_SQL, (job_id, prompt_hash, text))
+
+
+def checked_row(row, student_id):
+    if row is None:
+        raise StaleStudentError(f"student {student_id} was changed by another session")
+    return row
+
+
+def homework_result(rows, student_id):
+    checked_row(rows[0] if rows else None, student_id)
+    return rows[0][0], [(account_id, name, email) for _, account_id, name, email in rows
+                        if account_id is not None]
+
+
+# full rows for exports and analysis, streamed rather than fetched at once
+STUDENT_COLUMNS = ("id", "name", "age", "current_level", "final_goal",
+                   "future_concepts", "notes", "step", "current_class")
+
+CLASS_COLUMNS = ("student_id", "class_id", "status", "name", "methods",
+                 "stretch_methods", "description", "classwork", "notes", "hw",
+                 "hw_notes", "taught_methods", "needs_practice")
+
+STREAM_STUDENTS_SQL = f"SELECT {', '.join(STUDENT_COLUMNS)} FROM students ORDER BY id"
+
+# archived classes are part of the history too
+STREAM_CLASSES_SQL = f"""
+    SELECT {', '.join(CLASS_COLUMNS)}
+    FROM students_classes
+    WHERE %(student_id)s::int IS NULL OR student_id = %(student_id)s::int
+    UNION ALL
+    SELECT {', '.join(CLASS_COLUMNS)}
+    FROM students_classes_archive
+    WHERE %(student_id)s::int IS NULL OR student_id = %(student_id)s::int
+    ORDER BY student_id, class_id
+"""
+
+# moves completed classes out of the hot table, keeping the most recent
+# `keep` per student (the refiner and classwork steps read the last one)
+# and never the class a student is currently on. the columns are named so
+# a column added to students_classes can't shift what lands in the archive.
+ARCHIVED_COLUMNS = ", ".join(CLASS_COLUMNS + ("relevance", "skills_tested"))
+
+ARCHIVE_SQL = f"""
+    WITH old AS (
+        SELECT sc.class_id
+        FROM (
+            SELECT class_id, student_id,
+                ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY class_id DESC) AS recent
+            FROM students_classes
+            WHERE status = 'completed'
+        ) sc
+        JOIN students s ON s.id = sc.student_id
+        WHERE sc.recent > %(keep)s
+        AND sc.class_id IS DISTINCT FROM s.current_class
+        ORDER BY sc.class_id
+        LIMIT %(batch_size)s
+    ), moved AS (
+        DELETE FROM students_classes
+        WHERE class_id IN (SELECT class_id FROM old)
+        RETURNING {ARCHIVED_COLUMNS}
+    ), archived AS (
+        INSERT INTO students_classes_archive ({ARCHIVED_COLUMNS}, archived_at)
+        SELECT {ARCHIVED_COLUMNS}, now() FROM moved
+    )
+    SELECT student_id, class_id, name, methods, notes, hw_notes
+    FROM moved
+    ORDER BY student_id, class_id
+"""
+
+ADD_SUMMARY_SQL = """
+    UPDATE students
+    SET history_summary = concat_ws(E'\\n', history_summary, %s)
+    WHERE id = %s
+"""
+
+stream_names = itertools.count()
+
+
+def stream_rows(conn, query, params=None, itersize=1000):
+    """
+    Yield the rows of a query from a named (server-side) cursor, fetching
+    itersize rows per round-trip, so memory stays flat however many rows
+    there are. The caller must keep the transaction open while iterating.
+    """
+    with conn.cursor(name=f"codeabode_stream_{next(stream_names)}") as cur:
+        cur.itersize = itersize
+        cur.execute(query, params)
+        yield from cur
+
+
+def iter_students(conn, itersize=1000):
+    """
+    Every student, by id, as rows of STUDENT_COLUMNS.
+    """
+    return stream_rows(conn, STREAM_STUDENTS_SQL, itersize=itersize)
+
+
+def iter_classes(conn, student_id=None, itersize=1000):
+    """
+    Every class (of one student, or of everyone), ordered by student then
+    class, as rows of CLASS_COLUMNS.
+    """
+    return stream_rows(conn, STREAM_CLASSES_SQL, {"student_id": student_id}, itersize)
+
+
+def iter_histories(conn, itersize=1000):
+    """
+    Yield (student row, [class rows]) for every student, holding only one
+    student's classes in memory at a time.
+    """
+    classes = itertools.groupby(iter_classes(conn, itersize=itersize), key=lambda row: row[0])
+    group = next(classes, None)
+
+    for student in iter_students(conn, itersize):
+        # both streams are ordered by student id, so walk them together
+        while group is not None and group[0] < student[0]:
+            group = next(classes, None)
+
+        history = []
+        if group is not None and group[0] == student[0]:
+            history = list(group[1])
+            group = next(classes, None)
+
+        yield student, history
+
+
+# per-query totals of what was fetched, kept by CountingCursor:
+# label -> [executions, rows, bytes]. batch-homework, api and jobs update
+# it from several threads, hence the lock
+query_stats = {}
+query_stats_lock = threading.Lock()
+
+
+def query_label(query):
+    """
+    The name of the *_SQL constant a query came from, or its first line.
+    """
+    for name, value in globals().items():
+        if name.endswith("_SQL") and value == query:
+            return name
+
+    return " ".join(str(query).split())[:60]
+
+
+def value_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value.encode() if isinstance(value, str) else value)
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(x) for x in value)
+    if isinstance(value, dict):
+        return len(json.dumps(value))
+    return 8
+
+
+class CountingCursor(cursor):
+    """
+    A psycopg2 cursor that adds the rows and approximate bytes it fetches to
+    query_stats under the query's label. Use it as the connection's
+    cursor_factory.
+    """
+
+    def execute(self, query, vars=None):
+        self.label = query_label(query)
+        with query_stats_lock:
+            query_stats.setdefault(self.label, [0, 0, 0])[0] += 1
+        return super().execute(query, vars)
+
+    def count(self, rows):
+        size = sum(value_size(v) for row in rows for v in row)
+        with query_stats_lock:
+            stats = query_stats.setdefault(getattr(self, "label", "?"), [0, 0, 0])
+            stats[1] += len(rows)
+            stats[2] += size
+        return rows
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self.count([row])
+        return row
+
+    def fetchmany(self, size=None):
+        return self.count(super().fetchmany(size) if size is not None else super().fetchmany())
+
+    def fetchall(self):
+        return self.count(super().fetchall())
+
+    # iterating calls __next__ (a cursor is its own iterator), so rows read
+    # with `for row in cur` are counted here
+    def __next__(self):
+        row = super().__next__()
+        self.count([row])
+        return row
+
+
+def summarize_classes(rows):
+    """
+    The default rolling-summary hook: one short line per archived class.
+
+    Args:
+        rows: (student_id, class_id, name, methods, notes, hw_notes) of one
+            student's newly archived classes, oldest first
+
+    Returns:
+        Text to append to the student's history_summary
+    """
+    lines = []
+    for _, _, name, methods, notes, hw_notes in rows:
+        line = f"{name} ({', '.join(methods or [])})"
+        if notes:
+            line += f" - {notes}"
+        if hw_notes:
+            line += f" - homework: {hw_notes}"
+        lines.append(line[:300])
+
+    return "\n".join(lines)
+
+
+def archive_classes(conn, keep=3, batch_size=1000, summarize=summarize_classes):
+    """
+    Move old completed classes into students_classes_archive, one
+    transaction per batch, and append a summary of them to each student's
+    history_summary so the refiner still sees them.
+
+    Args:
+        conn: psycopg2 connection
+        keep: completed classes per student to leave in the hot table
+        batch_size: classes moved per transaction
+        summarize: hook turning one student's archived rows into summary text
+
+    Returns:
+        Number of classes archived
+    """
+    cur = conn.cursor()
+    total = 0
+
+    while True:
+        with conn:
+            cur.execute(ARCHIVE_SQL, {"keep": max(keep, 1), "batch_size": batch_size})
+            rows = cur.fetchall()
+
+            for student_id, student_rows in itertools.groupby(rows, key=lambda row: row[0]):
+                cur.execute(ADD_SUMMARY_SQL, (summarize(list(student_rows)), student_id))
+
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    cur.close()
+    return total
+
+
+def print_query_stats():
+    print(f"{'query':<40} {'runs':>6} {'rows':>8} {'bytes':>12}")
+    for label, (runs, rows, size) in sorted(query_stats.items(), key=lambda x: -x[1][2]):
+        print(f"{label[:40]:<40} {runs:>6} {rows:>8} {size:>12}")
+
+
+def copy_value(value):
+    """
+    Format a python value as one field of a text-format COPY row.
+    Lists become postgres array literals (TEXT[] columns).
+    """
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, (list, tuple)):
+        items = []
+        for item in value:
+            if item is None:
+                items.append("NULL")
+            else:
+                item = str(item).replace("\\", "\\\\").replace('"', '\\"')
+                items.append(f'"{item}"')
+        value = "{" + ",".join(items) + "}"
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    Load rows into table with COPY FROM STDIN. Returns the number of rows sent.
+    """
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write("\t".join(copy_value(v) for v in row))
+        buf.write("\n")
+        count += 1
+
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN",
+        buf
+    )
+
+    return count
+
+
+def import_students(conn, records, batch_size=500):
+    """
+    Bulk load students and their upcoming classes, one transaction per batch.
+
+    Args:
+        conn: psycopg2 connection
+        records: list of validated ImportedStudent models
+        batch_size: number of students per transaction
+
+    Returns:
+        A list of per-batch stats dicts (students, classes, seconds)
+    """
+    stats = []
+    cur = conn.cursor()
+
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        started = time.perf_counter()
+
+        # commits the batch, or rolls it back if anything in it fails
+        with conn:
+            # COPY can't hand back ids, so reserve them from the sequence first
+            cur.execute(
+                """
+                SELECT nextval(pg_get_serial_sequence('students', 'id'))
+                FROM generate_series(1, %s)
+                """,
+                (len(batch),)
+            )
+            student_ids = [row[0] for row in cur.fetchall()]
+
+            copy_rows(
+                cur, "students",
+                ("id", "name", "age", "current_level", "final_goal",
+                 "future_concepts", "notes"),
+                ((student_id, s.name, s.age, s.current_level, s.final_goal,
+                  s.future_concepts, s.notes)
+                 for student_id, s in zip(student_ids, batch))
+            )
+
+            class_count = copy_rows(
+                cur, "students_classes",
+                ("student_id", "status", "name", "methods",
+                 "stretch_methods", "description"),
+                ((student_id, 'upcoming', x.name, x.methods,
+                  x.stretch_methods, x.description)
+                 for student_id, s in zip(student_ids, batch)
+                 for x in s.classes)
+            )
+
+            # same as the new command: the current class is the lowest upcoming one
+            cur.execute(
+                """
+                UPDATE students s
+                SET current_class = c.class_id
+                FROM (
+                    SELECT student_id, MIN(class_id) AS class_id
+                    FROM students_classes
+                    WHERE student_id = ANY(%s)
+                    GROUP BY student_id
+                ) c
+                WHERE s.id = c.student_id
+                """,
+                (student_ids,)
+            )
+
+        stats.append({
+            "students": len(batch),
+            "classes": class_count,
+            "seconds": time.perf_counter() - started,
+        })
+
+    cur.close()
+    return stats
@@ -0,0 +1,200 @@
+# async versions of some of the query functions in codeabode_db, on psycopg
+# 3: the student and class reads, the step transitions, streaming, and
+# claiming and reading drafts, which is what run_pipeline needs. same names
+# and arguments, but they take an AsyncCursor and must be awaited. the SQL is
+# shared with codeabode_db so the two layers can't drift apart.
+#
+# the worker's per-student drafts, the email outbox, the job queue, import
+# and archive are sync only. add them here when something async needs them.
+import asyncio
+import json
+import time
+
+from psycopg_pool import AsyncConnectionPool
+
+from codeabode_db import *
+
+
+def connect_pool(db_url, max_size=8):
+    """
+    An (unopened) pool of async connections. Open it with `async with`.
+    """
+    return AsyncConnectionPool(db_url, min_size=1, max_size=max_size, open=False)
+
+
+async def search_students(cur, query=None, step=None, offset=0, limit=20):
+    await cur.execute(search_students_sql(query, step),
+                      search_params(query, step, offset, limit))
+    return await cur.fetchall()
+
+
+async def find_student(cur, student):
+    if str(student).isdigit():
+        await cur.execute(STUDENT_BY_ID_SQL, (int(student),))
+    else:
+        await cur.execute(STUDENT_BY_NAME_SQL, (like_escape(student),))
+    return await cur.fetchall()
+
+
+async def get_class_history(cur, student_id):
+    await cur.execute(CLASS_HISTORY_SQL, (student_id,))
+    return await cur.fetchall()
+
+
+async def load_class_text(cur, class_id, field):
+    if field not in CLASS_TEXT_FIELDS:
+        raise ValueError(f"not a class text field: {field}")
+
+    await cur.execute(CLASS_TEXT_SQL.format(field=field), (class_id,))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def get_current_class(cur, student_id):
+    await cur.execute(CURRENT_CLASS_SQL, (student_id,))
+    return await cur.fetchone()
+
+
+async def create_student(cur, name, age, curriculum, classwork):
+    await cur.execute(CREATE_STUDENT_SQL, {
+        "name": name, "age": age, "classwork": classwork,
+        **curriculum_params(curriculum)
+    })
+    return await cur.fetchone()
+
+
+async def save_refinement(cur, student_id, version, hw_notes, curriculum):
+    await cur.execute(REFINE_SQL, {
+        "student_id": student_id, "version": version, "hw_notes": hw_notes,
+        **curriculum_params(curriculum)
+    })
+    return checked_row(await cur.fetchone(), student_id)
+
+
+async def is_refined(cur, student_id):
+    await cur.execute(REFINED_SQL, (student_id,))
+    return (await cur.fetchone())[0]
+
+
+async def save_classwork(cur, student_id, version, class_id, classwork):
+    await cur.execute(SAVE_CLASSWORK_SQL, {
+        "student_id": student_id, "version": version,
+        "class_id": class_id, "classwork": classwork
+    })
+    return checked_row(await cur.fetchone(), student_id)[0]
+
+
+async def save_refined_classwork(cur, student_id, version, hw_notes, curriculum, classwork):
+    class_id, version = await save_refinement(cur, student_id, version, hw_notes, curriculum)
+    return await save_classwork(cur, student_id, version, class_id, classwork)
+
+
+async def save_homework(cur, student_id, version, analysis, hw):
+    await cur.execute(SAVE_HOMEWORK_SQL, {
+        "student_id": student_id, "version": version,
+        **homework_params(analysis, hw)
+    })
+    return homework_result(await cur.fetchall(), student_id)
+
+
+async def stream_rows(conn, query, params=None, itersize=1000):
+    async with conn.cursor(name=f"codeabode_stream_{next(stream_names)}") as cur:
+        cur.itersize = itersize
+        await cur.execute(query, params)
+        async for row in cur:
+            yield row
+
+
+def iter_students(conn, itersize=1000):
+    return stream_rows(conn, STREAM_STUDENTS_SQL, itersize=itersize)
+
+
+def iter_classes(conn, student_id=None, itersize=1000):
+    return stream_rows(conn, STREAM_CLASSES_SQL, {"student_id": student_id}, itersize)
+
+
+async def iter_histories(conn, itersize=1000):
+    classes = iter_classes(conn, itersize=itersize)
+    row = await anext(classes, None)
+
+    async for student in iter_students(conn, itersize):
+        # both streams are ordered by student id, so walk them together
+        while row is not None and row[0] < student[0]:
+            row = await anext(classes, None)
+
+        history = []
+        while row is not None and row[0] == student[0]:
+            history.append(row)
+            row = await anext(classes, None)
+
+        yield student, history
+
+
+async def claim_draft(cur, timeout=600):
+    await cur.execute(CLAIM_DRAFT_SQL, {"timeout": timeout})
+    return await cur.fetchone()
+
+
+async def finish_draft(cur, draft_id, status, output=None, error=None):
+    await cur.execute(FINISH_DRAFT_SQL, {
+        "draft_id": draft_id, "status": status,
+        "output": json.dumps(output) if output is not None else None,
+        "error": error
+    })
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def get_draft(cur, student_id, version, kind):
+    await cur.execute(GET_DRAFT_SQL, (student_id, version, kind))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def run_pipeline(pool, student_ids, fetch, generate, store, concurrency=4, commit=True):
+    """
+    Run fetch -> generate -> store for many students on one event loop.
+
+    A connection is only held while fetching and while storing, never across
+    the model call, so one student's DB work overlaps other students' model
+    latency. At most `concurrency` students are in flight at once.
+
+    Args:
+        pool: an open AsyncConnectionPool
+        student_ids: students to process
+        fetch: async (cur, student_id) -> context
+        generate: async (context) -> result, usually the model call
+        store: async (cur, student_id, result) -> anything
+        concurrency: students in flight at once
+        commit: commit each student's store, otherwise roll it back
+
+    Returns:
+        A list of (student_id, stored value or exception, seconds), in order
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(student_id):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        context = await fetch(cur, student_id)
+                    # don't sit idle in a transaction through the model call
+                    await conn.commit()
+
+                result = await generate(context)
+
+                async with pool.connection() as conn:
+                    async with conn.cursor() as cur:
+                        stored = await store(cur, student_id, result)
+                    if commit:
+                        await conn.commit()
+                    else:
+                        await conn.rollback()
+
+                return student_id, stored, time.perf_counter() - started
+            except Exception as e:
+                return student_id, e, time.perf_counter() - started
+
+    return await asyncio.gather(*(run_one(x) for x in student_ids))
@@ -0,0 +1,386 @@
+# `./codeabode.py run STEP` runs one agent step without any prompts: it
+# reads a JSON request (or JSON lines, one request each) from stdin and
+# writes one JSON result per request with how long the database and the
+# model took. nothing is saved unless --commit is given.
+#
+# steps and their requests:
+#   new       {"info", "name", "age", "classwork": text | null, "teacher_notes"}
+#             classwork is generated from teacher_notes unless it's given
+#   refine    {"student", "hw_notes"}
+#             with --commit the student stays refined until classwork is saved
+#   classwork {"student", "kind": normal | assessment | warmup, "teacher_notes",
+#              "classwork": text to save instead of generating}
+#   analysis  {"student", "class_notes"}
+#   homework  {"student", "class_notes", "analysis": CompletedClass (optional),
+#              "kind": 5 | creative, "homework": text to save instead of generating}
+#
+# "student" is an id or a name, and "version" can be passed to make sure
+# nobody else has changed the student since it was read.
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import codeabode_trace
+from codeabode_db import *
+from codeabode_agents import *
+
+
+class StepError(Exception):
+    """
+    The request can't be run, e.g. the student isn't at that step.
+    """
+
+
+class Timings(dict):
+    """
+    Seconds spent per phase ("db", "model"), summed over the step.
+    """
+
+    @contextmanager
+    def __call__(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self[phase] = self.get(phase, 0) + time.perf_counter() - started
+
+
+def generate(client, config, message, on_text=None, on_class=None):
+    """
+    One model call. With on_text, the response is streamed and each chunk
+    of text is passed to it as it arrives. With on_class, a streamed
+    Curriculum's classes are passed to it one by one as they close (see
+    ClassStream).
+    """
+    if on_text is None and on_class is None:
+        return client.models.generate_content(model=MODEL, contents=message, config=config)
+
+    classes = ClassStream(on_class) if on_class else None
+    text = ""
+    for chunk in client.models.generate_content_stream(model=MODEL, contents=message, config=config):
+        if chunk.text:
+            text += chunk.text
+            if on_text:
+                on_text(chunk.text)
+            if classes:
+                classes.feed(chunk.text)
+
+    return Draft(message, text, config.response_schema)
+
+
+def finished(commit, cur, result):
+    # commit can also be a function to run in the step's own transaction,
+    # e.g. to mark a queued job done exactly when its work is saved
+    if callable(commit):
+        commit(cur, result)
+
+
+def lookup(cur, request, step):
+    """
+    The (name, id, step, version) of the request's student, who has to be
+    at the given step.
+    """
+    matches = find_student(cur, request["student"])
+    if len(matches) != 1:
+        raise StepError(f"{len(matches)} students match {request['student']}")
+
+    name, student_id, at_step, version = matches[0]
+    if at_step != step:
+        raise StepError(f"{name} is at step {at_step}, not {step}")
+
+    return name, student_id, at_step, request.get("version", version)
+
+
+def step_new(client, conn, cur, request, timings, commit, on_text=None, on_class=None):
+    classwork = request.get("classwork")
+    wanted = classwork is None and request.get("teacher_notes") is not None
+    pool = ThreadPoolExecutor(max_workers=1)
+    early = []
+
+    def write_classwork(curriculum, on_text=None):
+        return generate(
+            client, classwork_config(classnotesgpt_prompt),
+            with_teacher_notes(first_class_message(request["age"], curriculum), request["teacher_notes"]),
+            on_text
+        ).text
+
+    def class_closed(index, cls, fields):
+        # the first class (with the level and notes first_class_message
+        # reads) is all the classwork needs, so it's written while the rest
+        # of the curriculum streams in
+        if wanted and index == 0 and {"current_level", "notes"} <= fields.keys():
+            early.append(pool.submit(write_classwork, SimpleNamespace(**fields, classes=[cls])))
+        if on_class:
+            on_class(index, cls, fields)
+
+    try:
+        with timings("model"):
+            curriculum = parsed(generate(client, new_student_config(), request["info"], on_text,
+                                         class_closed if wanted or on_class else None), Curriculum)
+
+        if wanted and early:
+            with timings("model"):
+                classwork = early[0].result()
+            if on_text:
+                on_text(classwork)
+        elif wanted:
+            with timings("model"):
+                classwork = write_classwork(curriculum, on_text)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    result = {"curriculum": curriculum.model_dump(), "classwork": classwork}
+
+    if commit:
+        with timings("db"), conn:
+            result["student"], result["current_class"] = create_student(
+                cur, request["name"], request["age"], curriculum, classwork
+            )
+            finished(commit, cur, result)
+
+    return result
+
+
+def step_refine(client, conn, cur, request, timings, commit, on_text=None, on_class=None):
+    hw_notes = request.get("hw_notes", "")
+
+    with timings("db"), conn:
+        student = lookup(cur, request, 1)
+        classes = get_class_history(cur, student[1])
+        draft = get_draft(cur, student[1], student[3], "refine")
+        refined = is_refined(cur, student[1])
+
+    if refined:
+        raise StepError(f"{student[0]} was already refined, run classwork first")
+    if not classes or classes[0][0] == 0:
+        raise StepError(f"{student[0]} has no past classes")
+
+    # the worker's draft holds as long as there are no new notes to add, and
+    # it validates
+    if draft and not hw_notes.strip():
+        draft = load_draft(draft["message"], draft["curriculum"], Curriculum)
+    else:
+        draft = None
+
+    if draft:
+        curriculum = draft.parsed
+    else:
+        message = history_message(classes)[0] + f"\n\nLast homework notes: {hw_notes}"
+        with timings("model"):
+            curriculum = parsed(generate(client, refiner_config(), message, on_text, on_class), Curriculum)
+
+    result = {"curriculum": curriculum.model_dump(), "drafted": draft is not None}
+
+    if commit:
+        with timings("db"), conn:
+            result["current_class"], result["version"] = save_refinement(
+                cur, student[1], student[3], hw_notes, curriculum
+            )
+            finished(commit, cur, result)
+
+    return result
+
+
+def step_classwork(client, conn, cur, request, timings, commit, on_text=None, on_class=None):
+    kind = request.get("kind", "normal")
+    if kind not in CLASSWORK_PROMPTS:
+        raise StepError(f"unknown classwork kind {kind}")
+
+    with timings("db"), conn:
+        student = lookup(cur, request, 1)
+        classes = get_class_history(cur, student[1])
+        current_class = get_current_class(cur, student[1])
+
+        _, last_completed, last_completed_index = history_message(classes)
+        if last_completed is None:
+            raise StepError(f"{student[0]} has no completed classes")
+        last_hw, old_classwork = classwork_context(cur, classes, last_completed, last_completed_index)
+
+    classwork = request.get("classwork")
+    if classwork is None:
+        message = with_teacher_notes(
+            classwork_message(classes, last_completed, last_hw, old_classwork),
+            request.get("teacher_notes", "")
+        )
+
+        # a warm up is written first, then the class itself
+        classwork = ""
+        for prompt in CLASSWORK_PROMPTS[kind]:
+            with timings("model"):
+                classwork += generate(client, classwork_config(prompt), message, on_text).text
+
+    result = {"classwork": classwork}
+
+    if commit:
+        with timings("db"), conn:
+            result["version"] = save_classwork(
+                cur, student[1], student[3], current_class[8], classwork
+            )
+            finished(commit, cur, result)
+
+    return result
+
+
+def analyse(client, request, timings, current_class, message, draft, on_text=None):
+    # the worker's draft was made from the notes already saved on the class
+    if draft and not request.get("class_notes"):
+        drafted = load_draft(draft["message"], draft["analysis"], CompletedClass)
+        if drafted:
+            return drafted.parsed, drafted.message
+
+    message += request.get("class_notes") or current_class[11] or ""
+    with timings("model"):
+        return parsed(generate(client, analysis_config(), message, on_text), CompletedClass), message
+
+
+def step_analysis(client, conn, cur, request, timings, commit, on_text=None, on_class=None):
+    with timings("db"), conn:
+        student = lookup(cur, request, 2)
+        current_class = get_current_class(cur, student[1])
+        draft = get_draft(cur, student[1], student[3], "homework")
+
+    analysis, _ = analyse(client, request, timings, current_class,
+                          homework_message(current_class), draft, on_text)
+    return {"analysis": analysis.model_dump()}
+
+
+def step_homework(client, conn, cur, request, timings, commit, on_text=None, on_class=None):
+    from codeabode_mail import save_homework_and_notify
+
+    kind = str(request.get("kind", "5"))
+    if kind not in HOMEWORK_PROMPTS:
+        raise StepError(f"unknown homework kind {kind}")
+
+    with timings("db"), conn:
+        student = lookup(cur, request, 2)
+        current_class = get_current_class(cur, student[1])
+        draft = get_draft(cur, student[1], student[3], "homework")
+
+    message = homework_message(current_class)
+    if request.get("analysis") is not None:
+        analysis = CompletedClass.model_validate(request["analysis"])
+        message += request.get("class_notes") or current_class[11] or ""
+    else:
+        analysis, message = analyse(client, request, timings, current_class, message, draft, on_text)
+
+    homework = request.get("homework")
+    if homework is None:
+        with timings("model"):
+            homework = generate(
+                client, homework_config(HOMEWORK_PROMPTS[kind]), with_analysis(message, analysis),
+                on_text
+            ).text
+
+    result = {"analysis": analysis.model_dump(), "homework": homework}
+
+    if commit:
+        # the emails are left in the outbox for `./codeabode.py send-mail`
+        with timings("db"), conn:
+            result["version"], result["emails_queued"] = save_homework_and_notify(
+                cur, student[1], student[3], analysis, homework, current_class
+            )
+            finished(commit, cur, result)
+
+    return result
+
+
+STEPS = {
+    "new": step_new,
+    "refine": step_refine,
+    "classwork": step_classwork,
+    "analysis": step_analysis,
+    "homework": step_homework,
+}
+
+
+def run_step(client, conn, step, request, commit=False, on_text=None, on_class=None):
+    """
+    Run one step for one request. on_text, if given, gets the model's text
+    as it streams in, and on_class(index, cls, fields) each class of a new
+    or refined curriculum as soon as it's complete. commit is True to save
+    the result, or a function of (cur, result) to also run in the
+    transaction that saves it.
+
+    Returns:
+        {"step", "ok", "result" or "error", "timings"}, ready for json.dumps
+    """
+    timings = Timings()
+    started = time.perf_counter()
+    cur = conn.cursor()
+
+    try:
+        with codeabode_trace.attributes(student=request.get("student", request.get("name"))), \
+                codeabode_trace.span(step, "step"):
+            result = {"step": step, "ok": True, "result": STEPS[step](
+                client, conn, cur, request, timings, commit, on_text, on_class
+            )}
+    except Exception as e:
+        # reported in the result, so one bad request doesn't stop a batch
+        conn.rollback()
+        result = {"step": step, "ok": False, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        cur.close()
+
+    timings["total"] = time.perf_counter() - started
+    result["timings"] = {phase: round(seconds, 4) for phase, seconds in timings.items()}
+    return result
+
+
+def read_requests(stream):
+    """
+    One JSON object, or JSON lines.
+    """
+    text = stream.read().strip()
+    if not text:
+        return []
+
+    try:
+        return [json.loads(text)]
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def run_batch(client, connect, step, requests, parallel=4, commit=False):
+    """
+    Run a step for many requests at once, at most parallel at a time, each
+    thread on its own connection. Every request commits (or fails) on its
+    own.
+
+    Returns:
+        The run_step results, in the order of requests
+    """
+    local = threading.local()
+    connections = []
+
+    def run(request):
+        if not hasattr(local, "conn"):
+            local.conn = connect()
+            connections.append(local.conn)
+        return run_step(client, local.conn, step, request, commit)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+            return list(pool.map(run, requests))
+    finally:
+        for conn in connections:
+            conn.close()
+
+
+def load_notes(path):
+    """
+    Homework requests from a notes file: a JSON object keyed by student id
+    or name, with either the class notes or a homework request as values.
+    """
+    with open(path, encoding="utf-8") as f:
+        notes = json.load(f)
+
+    requests = []
+    for student, value in notes.items():
+        request = dict(value) if isinstance(value, dict) else {"class_notes": value}
+        request["student"] = student
+        requests.append(request)
+
+    return requests
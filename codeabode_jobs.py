@@ -0,0 +1,221 @@
+# generation work that doesn't need a teacher waiting on it, queued in the
+# generation_jobs table and run in the background by `./codeabode.py jobs
+# work`. a job is one headless step (see codeabode_headless.py) with its
+# JSON request, and with save set its result is committed like `run
+# --commit` does.
+#
+# higher priority jobs are claimed first, and the first --reserve runners
+# only ever take urgent ones (priority >= URGENT), so a class about to start
+# never waits behind a nightly batch of refinements.
+#
+# a job is leased to one runner at a time. if the runner dies, the lease runs
+# out and another runner picks the job up again. every model response is
+# stored against the job as it comes in, so the retry only pays for the
+# calls the crashed attempt didn't finish. a job is marked done in the same
+# transaction that saves its result, so it can't be saved twice either.
+import hashlib
+import select
+import threading
+import traceback
+
+import codeabode_trace
+from codeabode_db import *
+from codeabode_agents import Draft, MODEL
+from codeabode_headless import run_step
+
+# priority at which a job counts as urgent
+URGENT = 100
+
+
+class CachedClient:
+    """
+    Stands in for the Gemini client while a job runs. Responses already
+    stored for the job are returned without calling the model, new ones
+    are stored as soon as they arrive, and each call renews the job's
+    lease.
+
+    cache_conn should be an autocommit connection of its own, so outputs
+    are kept even when the step's transaction is rolled back.
+    """
+
+    def __init__(self, client, cache_conn, job_id, attempt, lease=600):
+        self.client = client
+        self.conn = cache_conn
+        self.job_id = job_id
+        self.attempt = attempt
+        self.lease = lease
+        self.models = self
+        self.calls = self.cached = 0
+
+    def cached_output(self, model, contents, config):
+        self.calls += 1
+        prompt_hash = hashlib.sha256(repr((model, contents, config)).encode()).hexdigest()
+
+        # a cursor per call, a new student's classwork is written on another
+        # thread while the curriculum streams
+        with self.conn.cursor() as cur:
+            text = get_job_output(cur, self.job_id, prompt_hash)
+        if text is not None:
+            self.cached += 1
+        return prompt_hash, text
+
+    def save_output(self, prompt_hash, text):
+        with self.conn.cursor() as cur:
+            save_job_output(cur, self.job_id, prompt_hash, text)
+            extend_job(cur, self.job_id, self.attempt, self.lease)
+
+    def generate_content(self, model=MODEL, contents=None, config=None):
+        prompt_hash, text = self.cached_output(model, contents, config)
+        if text is not None:
+            return Draft(contents, text, config.response_schema if config else None)
+
+        response = self.client.models.generate_content(model=model, contents=contents, config=config)
+        self.save_output(prompt_hash, response.text)
+        return response
+
+    def generate_content_stream(self, model=MODEL, contents=None, config=None):
+        # a stored response comes back as a single chunk, a new one is
+        # stored once it's complete
+        prompt_hash, text = self.cached_output(model, contents, config)
+        if text is not None:
+            yield Draft(contents, text)
+            return
+
+        text = ""
+        for chunk in self.client.models.generate_content_stream(model=model, contents=contents, config=config):
+            text += chunk.text or ""
+            yield chunk
+        self.save_output(prompt_hash, text)
+
+
+def run_job(conn, cache_conn, client, job, lease=600):
+    """
+    Run one claimed job and record how it went.
+
+    Returns:
+        The job's status afterwards ('done', 'queued' to be retried,
+        'failed', or None if it was lost to another runner), and the
+        run_step result
+    """
+    job_id, kind, student_id, request, save, priority, attempt = job
+    cached = CachedClient(client, cache_conn, job_id, attempt, lease)
+
+    def done(cur, result):
+        complete_job(cur, job_id, attempt, result)
+
+    with codeabode_trace.attributes(job=job_id, attempt=attempt):
+        result = run_step(cached, conn, kind, request, done if save else False)
+    result["calls"], result["cached"] = cached.calls, cached.cached
+
+    try:
+        with conn:
+            cur = conn.cursor()
+            if not result["ok"]:
+                return fail_job(cur, job_id, attempt, result["error"]), result
+            if not save:
+                complete_job(cur, job_id, attempt, result["result"])
+            return "done", result
+    except LostLeaseError:
+        return None, result
+
+
+def run_jobs(connect, client, workers=2, reserve=1, lease=600, poll=60, once=False):
+    """
+    Run queued jobs on worker threads until Ctrl+C, sleeping on
+    LISTEN/NOTIFY when there's nothing to do. Any number of these can run
+    against the same database.
+
+    Args:
+        connect: makes a new Postgres connection (two per worker)
+        client: the Gemini client, shared by every worker
+        workers: jobs run at once
+        reserve: how many of the workers only take urgent jobs
+        lease: seconds a job can go without a model response before it's
+            considered crashed and handed to another runner
+        poll: seconds to wait for a notification before checking anyway
+        once: stop when nothing is due instead of waiting
+
+    Returns:
+        {status: number of jobs}
+    """
+    # at least one worker has to take everything
+    workers = max(workers, 1)
+    reserve = min(reserve, workers - 1)
+
+    wake = threading.Condition()
+    stopping = threading.Event()
+    counts = {}
+
+    def work(slot):
+        conn, cache_conn = connect(), connect()
+        cache_conn.autocommit = True
+        cur = conn.cursor()
+
+        try:
+            while not stopping.is_set():
+                with conn:
+                    job = claim_job(cur, lease, URGENT if slot < reserve else None)
+
+                if job is None:
+                    if once:
+                        return
+                    with wake:
+                        wake.wait(poll)
+                    continue
+
+                job_id, kind, student_id, request, save, priority, attempt = job
+                print(f"[{slot}] job {job_id}: {kind} for {request.get('student', request.get('name'))} "
+                      f"(priority {priority}, attempt {attempt})")
+
+                try:
+                    status, result = run_job(conn, cache_conn, client, job, lease)
+                except Exception:
+                    # the connection broke, the lease will hand the job back
+                    traceback.print_exc()
+                    conn.close()
+                    conn = connect()
+                    cur = conn.cursor()
+                    continue
+
+                counts[status] = counts.get(status, 0) + 1
+                detail = "" if result["ok"] else f": {result['error']}"
+                print(f"[{slot}] job {job_id} {status or 'lost its lease'} in "
+                      f"{result['timings']['total']:.1f}s, {result['cached']}/{result['calls']} "
+                      f"model calls reused{detail}")
+        finally:
+            conn.close()
+            cache_conn.close()
+
+    threads = [threading.Thread(target=work, args=(slot,), daemon=True) for slot in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    if once:
+        for thread in threads:
+            thread.join()
+        return counts
+
+    listener = connect()
+    listener.autocommit = True
+    listener.cursor().execute(f"LISTEN {JOB_CHANNEL}")
+
+    try:
+        while True:
+            if select.select([listener], [], [], poll) != ([], [], []):
+                listener.poll()
+                listener.notifies.clear()
+                with wake:
+                    wake.notify_all()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # jobs already running are finished so their tokens aren't wasted
+        print("Finishing jobs already under way...")
+        stopping.set()
+        with wake:
+            wake.notify_all()
+        for thread in threads:
+            thread.join()
+        listener.close()
+
+    return counts
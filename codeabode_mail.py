@@ -0,0 +1,297 @@
+# parent notification emails. steps queue them in the email_outbox table
+# and `./codeabode.py send-mail` delivers them over one authenticated SMTP
+# session.
+#
+# the server comes from SMTP_HOST / SMTP_PORT (gmail by default) and logs in
+# with EMAIL_ADDRESS / EMAIL_PASSWORD. to try it locally without sending
+# anything, run a stand-in server and point at it:
+#
+#   python -m aiosmtpd -n -l localhost:8025
+#   SMTP_HOST=localhost SMTP_PORT=8025 SMTP_STARTTLS=0 EMAIL_PASSWORD= ./codeabode.py send-mail
+import os
+import select
+import smtplib
+import ssl
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from codeabode_db import *
+
+
+class Mailer:
+    """
+    Sends every message over a single SMTP connection, so the connect,
+    STARTTLS and login handshakes happen once per run instead of once per
+    message. Use it as a context manager.
+
+    If the server drops the connection (idle timeouts, connection limits),
+    the next send reconnects and tries that message again once.
+    """
+
+    def __init__(self, host=None, port=None, user=None, password=None, starttls=None):
+        self.host = host or os.getenv("SMTP_HOST", "smtp.gmail.com")
+        self.port = int(port or os.getenv("SMTP_PORT", 587))
+        self.user = user if user is not None else os.getenv("EMAIL_ADDRESS")
+        self.password = password if password is not None else os.getenv("EMAIL_PASSWORD")
+        self.starttls = starttls if starttls is not None else os.getenv("SMTP_STARTTLS", "1") != "0"
+
+        self.server = None
+        self.connects = 0
+        # seconds per message sent, in order
+        self.latencies = []
+
+    def connect(self):
+        self.server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            self.server.starttls(context=ssl.create_default_context())
+        # local stand-ins don't need a login
+        if self.password:
+            self.server.login(self.user, self.password)
+        self.connects += 1
+
+    def close(self):
+        if self.server is None:
+            return
+
+        try:
+            self.server.quit()
+        except (smtplib.SMTPServerDisconnected, OSError):
+            pass
+        self.server = None
+
+    def send(self, msg):
+        """
+        Send one message, reconnecting first if the session was dropped.
+
+        Returns:
+            Seconds the send took
+        """
+        started = time.perf_counter()
+
+        if self.server is None:
+            self.connect()
+
+        try:
+            self.server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            self.connect()
+            self.server.send_message(msg)
+
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        return latency
+
+    def summary(self):
+        if not self.latencies:
+            return "no emails sent"
+
+        avg = sum(self.latencies) / len(self.latencies)
+        return (f"{len(self.latencies)} emails over {self.connects} connection(s), "
+                f"avg {avg * 1000:.0f} ms, max {max(self.latencies) * 1000:.0f} ms")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def homework_email(name, current_class, analysis):
+    """
+    The "homework uploaded" email for one account. The body is only the
+    part about this class, letter() adds the greeting and sign-off when
+    it's sent, alone or in a digest.
+
+    Args:
+        name: the account's name
+        current_class: the get_current_class row the homework is for
+        analysis: the CompletedClass analysis of that class
+
+    Returns:
+        {"subject": ..., "body": ...}
+    """
+    body = f"""Your son/daughter completed the {current_class[3]} class. Homework is available at https://app.codeabode.co
+
+Class info:
+Methods taught: {analysis.taught_methods}
+What needs practice: {analysis.needs_practice}
+Class Description: {current_class[4]}
+Methods intended to be taught: {current_class[5]}
+Stretch Methods: {current_class[6]}
+"""
+
+    return {"subject": f"Assignment Uploaded for {current_class[10]}", "body": body}
+
+
+def queue_homework_emails(cur, student_id, current_class, analysis, accounts):
+    """
+    Queue the homework email for every account with an address, in the
+    caller's transaction.
+
+    Args:
+        accounts: (account id, name, email) rows, as from save_homework
+
+    Returns:
+        Number of emails queued
+    """
+    return queue_emails(cur, [
+        {
+            "student_id": student_id, "class_id": current_class[8],
+            "account_id": account_id, "kind": "homework",
+            "name": name, "address": address,
+            **homework_email(name, current_class, analysis),
+        }
+        for account_id, name, address in accounts if address
+    ])
+
+
+def save_homework_and_notify(cur, student_id, version, analysis, hw, current_class):
+    """
+    save_homework, with the parent emails queued in the same transaction.
+
+    Returns:
+        (new version, number of emails queued)
+    """
+    version, accounts = save_homework(cur, student_id, version, analysis, hw)
+    return version, queue_homework_emails(cur, student_id, current_class, analysis, accounts)
+
+
+def letter(name, bodies):
+    return f"""
+Hi {name},
+
+""" + "\n---\n\n".join(bodies) + """
+Best,
+Om
+    """
+
+
+def digest_subject(subjects):
+    if len(set(subjects)) == 1:
+        return subjects[0]
+
+    return f"{len(subjects)} Assignments Uploaded"
+
+
+def outbox_message(sender, email_ids, name, address, subject, body):
+    msg = MIMEMultipart()
+    msg['From'] = f"Codeabode <{sender}>"
+    msg['To'] = f"{name} <{address}>"
+    msg['Subject'] = subject
+    # the same id on every attempt, so a resend after a crash between
+    # sending and marking it sent can be recognised as a duplicate
+    msg['Message-ID'] = f"<outbox-{'-'.join(map(str, email_ids))}@codeabode.co>"
+
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+
+def is_permanent(error):
+    """
+    Whether retrying a failed send could ever work.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+
+    return (isinstance(error, smtplib.SMTPResponseException)
+            and not isinstance(error, smtplib.SMTPAuthenticationError)
+            and 500 <= error.smtp_code < 600)
+
+
+def run_sender(conn, connect, batch_size=50, rate=2.0, poll=60, once=False, mailer=None, digest=None):
+    """
+    Deliver queued emails until interrupted, sleeping on LISTEN/NOTIFY when
+    the outbox is empty. Any number of senders can run at once.
+
+    Every send is recorded in its own transaction as soon as it finishes.
+    Failures are retried with backoff (see email_failed).
+
+    Args:
+        conn: psycopg2 connection used for claiming and recording emails
+        connect: opens a new connection, for the LISTEN one (conn.dsn has
+            the password masked, so it can't be reused)
+        batch_size: emails (or accounts, with digest) claimed per transaction
+        rate: most messages sent per second, or 0 for no limit
+        poll: seconds to wait for a notification before checking anyway
+        once: stop when nothing is due instead of waiting
+        mailer: Mailer to send with, by default one from the environment
+        digest: if set, hold emails for this many seconds and send each
+            account everything that piled up as one message
+
+    Returns:
+        (sent, failed) message counts
+    """
+    cur = conn.cursor()
+    mailer = mailer or Mailer()
+    interval = 1 / rate if rate else 0
+    last_send = 0
+    sent = failed = 0
+
+    if digest is not None:
+        # wake up in time for the next window even without notifications
+        poll = min(poll, max(digest, 1))
+
+    listener = connect()
+    listener.autocommit = True
+    listener.cursor().execute(f"LISTEN {MAIL_CHANNEL}")
+
+    try:
+        while True:
+            with conn:
+                if digest is None:
+                    emails = claim_emails(cur, batch_size)
+                else:
+                    emails = claim_digests(cur, digest, batch_size)
+
+            if not emails:
+                # don't hold an idle session open while waiting
+                mailer.close()
+                if once:
+                    return sent, failed
+
+                if select.select([listener], [], [], poll) != ([], [], []):
+                    listener.poll()
+                    listener.notifies.clear()
+                continue
+
+            # one message per email, or per account when digesting. emails
+            # queued as whole letters (before digests) always go on their own
+            messages = {}
+            for email in emails:
+                key = email[3] if digest is not None and email[9] else ("email", email[0])
+                messages.setdefault(key, []).append(email)
+
+            for group in messages.values():
+                email_ids = [email[0] for email in group]
+                _, _, _, _, name, address, _, body, attempts, section = group[0]
+
+                wait = last_send + interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                last_send = time.monotonic()
+
+                try:
+                    latency = mailer.send(outbox_message(
+                        mailer.user, email_ids, name, address,
+                        digest_subject([email[6] for email in group]),
+                        letter(name, [email[7] for email in group]) if section else body
+                    ))
+                except (smtplib.SMTPException, OSError) as e:
+                    # start the next message on a fresh session
+                    mailer.close()
+                    with conn:
+                        status = email_failed(cur, email_ids, str(e), is_permanent(e))
+                    failed += 1
+                    print(f"  {address}: {e} (attempt {attempts}, now {status})")
+                    continue
+
+                with conn:
+                    email_sent(cur, email_ids)
+                sent += 1
+                print(f"  {address}: {len(group)} email(s) sent in {latency * 1000:.0f} ms")
+    finally:
+        mailer.close()
+        listener.close()
+        cur.close()
@@ -7,12 +7,18 @@ class Class(BaseModel):
     methods: list[str]
     stretch_methods: Optional[list[str]]
 
+# the model writes fields in this order, and notes come before classes so
+# the first class's classwork can start while the rest is still streaming
 class Curriculum(BaseModel):
     current_level: str
     final_goal: str
+    notes: Optional[str]
     classes: list[Class]
     future_concepts: list[str]
-    notes: Optional[str]
+
+class ImportedStudent(Curriculum):
+    name: str
+    age: int
 
 class CompletedClass(BaseModel):
     notes: Optional[str]
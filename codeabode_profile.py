@@ -0,0 +1,192 @@
+# `--profile` and `--timings`, for any command.
+#
+# --profile runs the whole command under pyinstrument if it's installed (a
+# sampling profiler, so model calls and other waits show up as they are) or
+# cProfile otherwise, and writes the result next to where it was run:
+# codeabode-COMMAND-TIME.html or .prof (open with `python -m pstats FILE` or
+# snakeviz).
+#
+# --timings prints where the wall clock went when the command exits: startup
+# (imports and connecting), database, each model call, SMTP, commits, and the
+# time spent waiting on the teacher at a prompt, typing notes up to Ctrl+D
+# or in the pager, kept apart from the time the machine was busy. time is
+# counted once, in the innermost phase, so a commit's queries count as db and
+# the rest of it as commit.
+# model outputs that had to be repaired before they validated are counted too.
+#
+# both only import what they need when they're asked for, so startup stays
+# as fast without them.
+import atexit
+import functools
+import inspect
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+STARTED = time.perf_counter()
+
+# the teacher reading or typing, not the machine working
+USER_PHASES = ("input", "pager")
+
+# phase -> [seconds, calls]
+phases = {}
+# seconds per model call, in order
+model_calls = []
+lock = threading.Lock()
+local = threading.local()
+
+
+@contextmanager
+def timed(phase, call=True):
+    """
+    Count the time inside the block towards phase, minus whatever nested
+    timed blocks count towards theirs. With call=False it's added to the
+    phase's time without counting as a call of its own.
+    """
+    stack = local.__dict__.setdefault("stack", [])
+    frame = [time.perf_counter(), 0]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - frame[0]
+        if stack:
+            stack[-1][1] += elapsed
+
+        with lock:
+            phases.setdefault(phase, [0, 0])[0] += elapsed - frame[1]
+        local.elapsed = elapsed
+        if call:
+            count_call(phase, elapsed)
+
+
+def count_call(phase, elapsed):
+    with lock:
+        phases.setdefault(phase, [0, 0])[1] += 1
+        if phase == "model":
+            model_calls.append(elapsed)
+
+
+def timed_function(function, phase):
+    """
+    function, with every call timed as phase. Generators (streamed model
+    responses) are timed while they're being read.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timed(phase, call=False):
+            result = function(*args, **kwargs)
+        if not inspect.isgenerator(result):
+            count_call(phase, local.elapsed)
+            return result
+        return timed_generator(result, phase, local.elapsed)
+
+    return wrapper
+
+
+def timed_generator(generator, phase, elapsed):
+    # one call, however many chunks it comes back in
+    done = object()
+    try:
+        while True:
+            with timed(phase, call=False):
+                item = next(generator, done)
+            elapsed += local.elapsed
+            if item is done:
+                return
+            yield item
+    finally:
+        count_call(phase, elapsed)
+
+
+def wrap(owner, name, phase):
+    setattr(owner, name, timed_function(getattr(owner, name), phase))
+
+
+def start_timings():
+    """
+    Time input() and SMTP from here on and print the report at exit. The
+    database, model, pager and commit phases, and the teacher's notes read
+    from stdin, are wrapped by codeabode.py where they're set up.
+    """
+    import builtins
+    import smtplib
+
+    wrap(builtins, "input", "input")
+    for name in ("connect", "starttls", "login", "send_message", "quit"):
+        wrap(smtplib.SMTP, name, "smtp")
+
+    atexit.register(print_timings)
+
+
+def startup_done():
+    with lock:
+        phases["startup"] = [time.perf_counter() - STARTED - sum(s for s, _ in phases.values()), 1]
+
+
+def print_timings():
+    wall = time.perf_counter() - STARTED
+    user = sum(phases.get(phase, [0])[0] for phase in USER_PHASES)
+    machine = wall - user
+
+    out = sys.stderr
+    print(f"\nTimings: {wall:.2f}s wall, {machine:.2f}s machine, {user:.2f}s waiting on you", file=out)
+
+    accounted = 0
+    for phase, (seconds, calls) in sorted(phases.items(), key=lambda x: -x[1][0]):
+        if phase in USER_PHASES:
+            continue
+        accounted += seconds
+        detail = f"{calls:>5} calls" if phase != "startup" else ""
+        if phase == "model" and model_calls:
+            detail += f" ({', '.join(f'{s:.1f}s' for s in model_calls[:8])}{', ...' if len(model_calls) > 8 else ''})"
+        print(f"  {phase:<10} {seconds:>8.2f}s {detail}", file=out)
+
+    # threads (batch-homework, api, jobs) can add up to more than the wall
+    if machine > accounted:
+        print(f"  {'other':<10} {machine - accounted:>8.2f}s", file=out)
+
+    for phase in USER_PHASES:
+        if phase in phases:
+            print(f"  {phase:<10} {phases[phase][0]:>8.2f}s {phases[phase][1]:>5} times (you)", file=out)
+
+    # only if the command got as far as the model
+    agents = sys.modules.get("codeabode_agents")
+    if agents and any(agents.parse_counts.values()):
+        counts = agents.parse_counts
+        print(f"  outputs    {counts['parsed']} valid, {counts['repaired']} repaired "
+              f"(regenerations avoided), {counts['failed']} invalid", file=out)
+
+
+def start_profile(command):
+    """
+    Profile the rest of the process, writing the result at exit.
+    """
+    path = f"codeabode-{command}-{datetime.now():%Y%m%d-%H%M%S}"
+
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def write():
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+            print(f"Profile written to {path}.prof (python -m pstats {path}.prof)", file=sys.stderr)
+    else:
+        profiler = Profiler()
+        profiler.start()
+
+        def write():
+            profiler.stop()
+            with open(path + ".html", "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+            print(f"Profile written to {path}.html", file=sys.stderr)
+
+    atexit.register(write)
@@ -0,0 +1,275 @@
+# `./codeabode.py serve` keeps one process warm (imports, the Gemini client
+# and its connection pool, a Postgres connection) behind a Unix socket.
+# while it's running, other invocations of codeabode.py forward their
+# arguments to it and just relay input and output, so they start instantly.
+#
+# the protocol is JSON lines. the client sends {"argv", "cwd"} and then
+# {"in": text} / {"eof": true} as the teacher types (Ctrl+D is an eof, and
+# "final" is set on it when input is a pipe or file that has ended), the
+# server sends {"out": text} / {"err": text} and finally {"exit": code}.
+#
+# commands run one at a time, in the daemon process, because they share
+# sys.argv, the working directory and the warm connection. a second client
+# waits for the first to finish.
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+
+class SocketInput:
+    """
+    sys.stdin for a forwarded command. read() stops at the client's Ctrl+D
+    like a terminal does, and reading can carry on after it.
+    """
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.buffer = ""
+        self.eof = False
+        self.closed = False
+
+    def fill(self):
+        # returns False at an eof (or if the client went away)
+        line = self.rfile.readline()
+        if not line:
+            self.eof = True
+            return False
+
+        frame = json.loads(line)
+        if frame.get("eof"):
+            # a pipe or file ends for good, a terminal can keep going
+            self.eof = frame.get("final", False)
+            return False
+
+        self.buffer += frame.get("in", "")
+        return True
+
+    def readline(self, size=-1):
+        while "\n" not in self.buffer and not self.eof:
+            if not self.fill():
+                break
+
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        while not self.eof and self.fill():
+            pass
+
+        text, self.buffer = self.buffer, ""
+        return text
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        # exit() closes stdin, the socket is closed by the server
+        self.closed = True
+
+
+class SocketOutput:
+    """
+    sys.stdout or sys.stderr for a forwarded command.
+    """
+
+    def __init__(self, wfile, stream):
+        self.wfile = wfile
+        self.stream = stream
+
+    def write(self, text):
+        send(self.wfile, {self.stream: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        # the pager and anything else wanting a terminal falls back to plain output
+        return False
+
+
+def send(wfile, frame):
+    wfile.write((json.dumps(frame) + "\n").encode())
+    wfile.flush()
+
+
+def exit_code(e):
+    if e.code is None or isinstance(e.code, int):
+        return e.code or 0
+
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def serve(path, script, connect, client):
+    """
+    Run commands for clients of the socket at path until interrupted.
+
+    Args:
+        path: the Unix socket to listen on
+        script: codeabode.py's compiled code, which is run for every
+            request. Not its path, the PyInstaller binary has no source on disk
+        connect: makes a new Postgres connection
+        client: the Gemini client to share between requests
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+
+    lock = threading.Lock()
+    state = {"conn": connect()}
+
+    # import what the commands will, while nobody is waiting
+    import codeabode_db, codeabode_agents, codeabode_mail, codeabode_worker
+
+    def handle(sock):
+        rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+        try:
+            request = json.loads(rfile.readline())
+
+            if not lock.acquire(blocking=False):
+                send(wfile, {"err": "Waiting for another command to finish...\n"})
+                lock.acquire()
+
+            try:
+                code = run(request, rfile, wfile, state, script, connect, client)
+            finally:
+                lock.release()
+
+            send(wfile, {"exit": code})
+        except (OSError, ValueError):
+            # the client went away
+            pass
+        finally:
+            sock.close()
+
+    print(f"Serving on {path} (Ctrl+C to stop)")
+    try:
+        while True:
+            sock, _ = server.accept()
+            threading.Thread(target=handle, args=(sock,), daemon=True).start()
+    finally:
+        server.close()
+        os.unlink(path)
+        state["conn"].close()
+
+
+def run(request, rfile, wfile, state, script, connect, client):
+    """
+    Run one forwarded command with its input and output on the socket.
+
+    Returns:
+        The command's exit code
+    """
+    conn = state["conn"]
+    try:
+        # a connection that died while idle is replaced before anyone notices
+        conn.cursor().execute("SELECT 1")
+        conn.rollback()
+    except Exception:
+        conn = state["conn"] = connect()
+
+    saved = sys.argv, sys.stdin, sys.stdout, sys.stderr, os.getcwd()
+    # absolute, since the command runs in the client's directory
+    sys.argv = [os.path.abspath(saved[0][0])] + request["argv"]
+    sys.stdin = SocketInput(rfile)
+    sys.stdout = SocketOutput(wfile, "out")
+    sys.stderr = SocketOutput(wfile, "err")
+
+    import codeabode_db
+
+    # --db-stats is per command here, not per process
+    codeabode_db.query_stats.clear()
+
+    try:
+        os.chdir(request["cwd"])
+        exec(script, {
+            "__name__": "__main__", "__builtins__": __builtins__,
+            "serving": True, "client": client, "conn": conn,
+        })
+        code = 0
+    except SystemExit as e:
+        code = exit_code(e)
+    except (BrokenPipeError, ConnectionResetError):
+        code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        if "--db-stats" in request["argv"]:
+            try:
+                codeabode_db.print_query_stats()
+            except OSError:
+                pass
+
+        sys.argv, sys.stdin, sys.stdout, sys.stderr = saved[:4]
+        os.chdir(saved[4])
+        # anything the command left open shouldn't leak into the next one
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+
+    print(f"{' '.join(request['argv'])} exited with {code}")
+    return code
+
+
+def forward(path, args):
+    """
+    Run a command on the daemon at path, relaying this terminal's input and
+    output.
+
+    Returns:
+        The command's exit code, or None if no daemon is listening
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    rfile, wfile = sock.makefile("rb"), sock.makefile("wb")
+    send(wfile, {"argv": args, "cwd": os.getcwd()})
+
+    def relay_input():
+        tty = sys.stdin.isatty()
+        try:
+            while True:
+                line = sys.stdin.readline()
+                if line:
+                    send(wfile, {"in": line})
+                    continue
+
+                send(wfile, {"eof": True, "final": not tty})
+                if not tty:
+                    return
+        except (OSError, ValueError):
+            pass
+
+    threading.Thread(target=relay_input, daemon=True).start()
+
+    try:
+        for line in rfile:
+            frame = json.loads(line)
+            if "exit" in frame:
+                return frame["exit"]
+
+            out = sys.stdout if "out" in frame else sys.stderr
+            out.write(frame.get("out", frame.get("err", "")))
+            out.flush()
+    except KeyboardInterrupt:
+        # closing the socket aborts the command on the daemon
+        return 130
+    finally:
+        sock.close()
+
+    return 1
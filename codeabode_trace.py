@@ -0,0 +1,213 @@
+# tracing for batch and daemon runs: a span around every query, model call
+# (and each retry of it), pager and SMTP command, nested under the step or
+# draft they're part of and tagged with the student and the agent, so a
+# run can be read as a timeline rather than totals.
+#
+# `--trace` on any command (or CODEABODE_TRACE=FILE, for daemons) appends
+# spans as JSON lines of Chrome trace events. to look at them, turn the
+# lines into a JSON array and open it in Perfetto (ui.perfetto.dev) or
+# chrome://tracing:
+#
+#   python codeabode_trace.py codeabode-trace-….jsonl > trace.json
+#
+# --trace-sample 0.1 (or CODEABODE_TRACE_SAMPLE) keeps a tenth of the top
+# level spans, each with everything under it, for high volume runs.
+#
+# with tracing off, span() does nothing but check a global.
+import functools
+import inspect
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+out = None
+rate = 1.0
+lock = threading.Lock()
+local = threading.local()
+# perf_counter is what spans are timed with, this puts them on the wall clock
+EPOCH = time.time() - time.perf_counter()
+named_threads = set()
+# system prompt -> agent name, filled on the first model call
+agents = {}
+
+
+def start_tracing(path, sample=1.0):
+    """
+    Append spans to path from here on, keeping sample of the top level ones.
+    """
+    global out, rate
+    import atexit
+    import smtplib
+
+    out = open(path, "a", encoding="utf-8")
+    rate = sample
+    atexit.register(out.close)
+
+    for name in ("connect", "starttls", "login", "send_message", "quit"):
+        wrap(smtplib.SMTP, name, f"smtp {name}", "smtp")
+
+
+def emit(event):
+    line = json.dumps(event, default=str) + "\n"
+    with lock:
+        if out is None or out.closed:
+            return
+        # so Perfetto shows thread names instead of ids
+        if event["tid"] not in named_threads:
+            named_threads.add(event["tid"])
+            out.write(json.dumps({
+                "name": "thread_name", "ph": "M", "pid": event["pid"], "tid": event["tid"],
+                "args": {"name": threading.current_thread().name}
+            }) + "\n")
+        out.write(line)
+        out.flush()
+
+
+@contextmanager
+def attributes(**args):
+    """
+    Add args (student, agent, job...) to every span started inside the
+    block on this thread.
+    """
+    saved = getattr(local, "args", {})
+    local.args = {**saved, **{k: v for k, v in args.items() if v is not None}}
+    try:
+        yield
+    finally:
+        local.args = saved
+
+
+@contextmanager
+def span(name, cat, **args):
+    """
+    Time the block as one span. Whether it's kept is decided at the top
+    level span and holds for everything under it.
+    """
+    if out is None:
+        yield
+        return
+
+    stack = local.__dict__.setdefault("stack", [])
+    sampled = stack[-1] if stack else random.random() < rate
+    stack.append(sampled)
+    started = time.perf_counter()
+    error = None
+
+    try:
+        yield
+    except GeneratorExit:
+        # a stream that was dropped part way through
+        raise
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        stack.pop()
+        if sampled:
+            finished = time.perf_counter()
+            args = {**getattr(local, "args", {}), **args}
+            if error:
+                args["error"] = error
+            emit({
+                "name": name, "cat": cat, "ph": "X",
+                "ts": round((EPOCH + started) * 1e6), "dur": round((finished - started) * 1e6),
+                "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+            })
+
+
+def traced(function, name, cat, args=None):
+    """
+    function, with every call in a span. args(*args, **kwargs), if given,
+    returns attributes for the span. Generators (streamed model responses)
+    get one span from the call until they're used up.
+    """
+    @functools.wraps(function)
+    def wrapper(*a, **kw):
+        attrs = args(*a, **kw) if args and out is not None else {}
+        if inspect.isgeneratorfunction(function):
+            return traced_generator(function(*a, **kw), name, cat, attrs)
+
+        with span(name, cat, **attrs):
+            result = function(*a, **kw)
+        if not inspect.isgenerator(result):
+            return result
+        return traced_generator(result, name, cat, attrs)
+
+    return wrapper
+
+
+def traced_generator(generator, name, cat, attrs):
+    with span(name, cat, streamed=True, **attrs):
+        yield from generator
+
+
+def wrap(owner, name, span_name, cat, args=None):
+    setattr(owner, name, traced(getattr(owner, name), span_name, cat, args))
+
+
+def agent_name(config):
+    """
+    The agent a model config is for, from the *_prompt in codeabode_model
+    its system instruction is.
+    """
+    if not agents:
+        import codeabode_model
+        for name, value in vars(codeabode_model).items():
+            if name.endswith("_prompt") and isinstance(value, str):
+                agents.setdefault(value, name[:-len("_prompt")])
+
+    instruction = getattr(config, "system_instruction", None)
+    if isinstance(instruction, list) and instruction:
+        instruction = instruction[0]
+    return agents.get(instruction, "unknown") if isinstance(instruction, str) else "none"
+
+
+def model_args(*args, **kwargs):
+    return {"agent": agent_name(kwargs.get("config")), "model": kwargs.get("model")}
+
+
+def wrap_model(models, attempts=False):
+    """
+    Trace generate_content and generate_content_stream on the Models class.
+    With attempts, each try inside the retry wrapper gets its own span; wrap
+    once with attempts before the retry patch and once without after it.
+    """
+    if attempts:
+        wrap(models, "generate_content", "model attempt", "model", model_args)
+        return
+
+    wrap(models, "generate_content", "model", "model", model_args)
+    wrap(models, "generate_content_stream", "model", "model", model_args)
+
+
+def wrap_cursor(cursor_class):
+    """
+    A span per query, named after its *_SQL constant.
+    """
+    from codeabode_db import query_label
+
+    execute = cursor_class.execute
+
+    @functools.wraps(execute)
+    def traced_execute(self, query, vars=None):
+        if out is None:
+            return execute(self, query, vars)
+        with span(query_label(query), "db"):
+            return execute(self, query, vars)
+
+    cursor_class.execute = traced_execute
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if len(argv) < 2:
+        print("Usage: python codeabode_trace.py TRACE.jsonl > trace.json")
+        exit(2)
+
+    with open(argv[1], encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    print(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
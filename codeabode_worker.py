@@ -0,0 +1,208 @@
+import select
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import codeabode_trace
+from codeabode_db import *
+from codeabode_agents import *
+
+# notified by the triggers in initdb.py whenever a draft is queued
+CHANNEL = "codeabode_drafts"
+
+
+def run_draft(cur, client, student_id, kind):
+    """
+    Generate one draft.
+
+    Returns:
+        (status, output) to store on the draft
+    """
+    if kind == "refine":
+        classes = get_class_history(cur, student_id)
+        cur.connection.commit()
+
+        # same checks as the step 1 flow
+        if len(classes) == 0 or classes[0][0] == 0:
+            return "waiting", None
+
+        return "done", draft_refinement(client, classes)
+
+    current_class = get_current_class(cur, student_id)
+    cur.connection.commit()
+
+    # the analysis needs the teacher's notes on the class, and those may not
+    # have been written yet. the trigger queues the draft again when they are.
+    if current_class is None or not current_class[11]:
+        return "waiting", None
+
+    return "done", draft_homework(client, current_class, current_class[11])
+
+
+def finish_claimed(conn, cur, client, draft):
+    """
+    Generate a claimed draft and store the result.
+
+    Returns:
+        (status, traceback if it failed). The status is 'pending' if the
+        draft was queued again while it ran, and has to be done over.
+    """
+    draft_id, student_id, version, kind = draft
+
+    try:
+        with codeabode_trace.attributes(student=student_id), codeabode_trace.span(f"draft {kind}", "step"):
+            status, output = run_draft(cur, client, student_id, kind)
+        error = None
+    except Exception:
+        conn.rollback()
+        status, output, error = "failed", None, traceback.format_exc()
+
+    with conn:
+        status = finish_draft(cur, draft_id, status, output, error)
+
+    return status, error
+
+
+def run_worker(conn, client, connect, poll=60, once=False):
+    """
+    Claim and generate queued drafts until interrupted, sleeping on
+    LISTEN/NOTIFY when the queue is empty. Any number of workers can run
+    against the same database.
+
+    Args:
+        conn: psycopg2 connection used for claiming and storing drafts
+        client: the Gemini API client
+        connect: opens a new connection, for the LISTEN one (conn.dsn has
+            the password masked, so it can't be reused)
+        poll: seconds to wait for a notification before checking anyway
+        once: stop when the queue is empty instead of waiting
+    """
+    cur = conn.cursor()
+
+    listener = connect()
+    listener.autocommit = True
+    listener.cursor().execute(f"LISTEN {CHANNEL}")
+
+    try:
+        while True:
+            with conn:
+                draft = claim_draft(cur)
+
+            if draft is None:
+                if once:
+                    return
+
+                if select.select([listener], [], [], poll) != ([], [], []):
+                    listener.poll()
+                    listener.notifies.clear()
+                continue
+
+            draft_id, student_id, version, kind = draft
+            print(f"Drafting {kind} for student {student_id} (version {version})")
+
+            status, error = finish_claimed(conn, cur, client, draft)
+            if error:
+                print(error)
+
+            if status == "pending":
+                print(f"Draft {draft_id} was queued again while it ran, redoing it")
+            else:
+                print(f"Draft {draft_id} {status}")
+    finally:
+        listener.close()
+        cur.close()
+
+
+# what each step drafts
+STEP_DRAFTS = {1: "refine", 2: "homework"}
+
+
+class Lookahead:
+    """
+    Drafts the next students in a queue on background threads, each with
+    its own connection, while the teacher works on the current one. Drafts
+    go through student_drafts like the worker's, so the step flows pick
+    them up with get_draft.
+    """
+
+    def __init__(self, connect, client, size=2):
+        self.connect = connect
+        self.client = client
+        self.pool = ThreadPoolExecutor(max_workers=max(size, 1))
+        self.local = threading.local()
+        self.futures = {}
+        self.connections = []
+
+    def cursor(self):
+        if not hasattr(self.local, "conn"):
+            self.local.conn = self.connect()
+            self.connections.append(self.local.conn)
+        return self.local.conn, self.local.conn.cursor()
+
+    def draft(self, student_id, version, kind):
+        conn, cur = self.cursor()
+        while True:
+            with conn:
+                draft = claim_student_draft(cur, student_id, version, kind)
+
+            # already drafted, or the worker has it
+            if draft is None:
+                return None
+
+            status = finish_claimed(conn, cur, self.client, draft)[0]
+            # requeued while it ran (new notes), so write it again
+            if status != "pending":
+                return status
+
+    def prefetch(self, students):
+        """
+        Start drafting any of these (name, id, step, version) students that
+        aren't already under way.
+        """
+        for student in students:
+            kind = STEP_DRAFTS.get(student[2])
+            if kind and student[1] not in self.futures:
+                self.futures[student[1]] = self.pool.submit(
+                    self.draft, student[1], student[3], kind
+                )
+
+    def wait(self, student, poll=1.0):
+        """
+        Block until the (name, id, step, version) student's draft is
+        finished, whether this lookahead or a worker is writing it. A failed
+        draft just means the step runs live.
+        """
+        future = self.futures.pop(student[1], None)
+        if future is not None:
+            if not future.done():
+                print(f"Waiting for {student[0]}'s draft...")
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Drafting ahead failed: {e}")
+
+        # the worker may have claimed it first, in which case ours found
+        # nothing to do
+        kind = STEP_DRAFTS.get(student[2])
+        if kind is None:
+            return
+
+        conn, cur = self.cursor()
+        waiting = False
+        while True:
+            with conn:
+                if not draft_running(cur, student[1], student[3], kind):
+                    return
+
+            if not waiting:
+                print(f"Waiting for the worker to finish {student[0]}'s draft...")
+                waiting = True
+            time.sleep(poll)
+
+    def close(self):
+        # queued drafts are dropped, ones already running are finished so
+        # the tokens aren't wasted
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        for conn in self.connections:
+            conn.close()
@@ -1,41 +1,49 @@
+#!venv/bin/python3
+# A/B evaluation of the curriculum prompts. every variant is run against
+# every student profile (the fixtures below, or a JSON lines file of
+# {"name", "info"}), many calls at once, and each output is checked against
+# the Curriculum schema. per variant it reports latency, tokens, output size
+# and how often the output didn't fit the schema, so prompts can be picked on
+# cost and speed as well as on reading the curricula. everything, including
+# each raw output, is written to a results file.
+#
+# "current" is the prompt codeabode.py uses (codeabode_model.curcgpt_prompt),
+# v1-v4 are the earlier drafts kept here to compare against.
+#
+# usage: ./curcgpt-tests.py [--variants current,v1,...] [--fixtures FILE.jsonl]
+#            [--runs N] [--parallel N] [--output FILE]
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sys import argv
+
+import dotenv
 from google import genai
 from google.api_core import retry
 from google.genai.types import GenerateContentConfig
-from pydantic import BaseModel
-from typing import Literal, Optional
-import dotenv
-import os
+from pydantic import ValidationError
 
-class ClassTopic(BaseModel):
-    name: str
-    methods: list[str]
-    relevance: str
-    stretch_methods: Optional[list[str]]
-
-class Class(BaseModel):
-    status: Literal["upcoming", "assessment"]
-    topics: Optional[list[ClassTopic]]
-    project: Optional[str]
-    skills_tested: Optional[list[str]]
-    description: Optional[str]
-
-class Curriculum(BaseModel):
-    current_level: str
-    final_goal: str
-    classes: list[Class]
-    future_concepts: list[str]
-
-is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
-
-genai.models.Models.generate_content = retry.Retry(
-    predicate=is_retriable)(genai.models.Models.generate_content)
+from codeabode_agents import MODEL
+from codeabode_model import Curriculum, curcgpt_prompt as current_prompt
 
 dotenv.load_dotenv()
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-client = genai.Client(
-    api_key=GEMINI_API_KEY,
-)
+# what a teacher types into `./codeabode.py new`
+PROFILES = [
+    {"name": "beginner-game", "info": "Age 9. Has never coded before, plays a lot of Minecraft "
+     "and wants to make their own game. Short attention span, likes drawing."},
+    {"name": "scratch-to-python", "info": "Age 11. A year of Scratch, knows loops and variables "
+     "there but no Python yet. Final goal: a platformer in Pygame."},
+    {"name": "some-python", "info": "Age 14. Knows print, input, if/else and for loops in Python. "
+     "Wants to build a Discord bot that answers questions with an AI API."},
+    {"name": "artist", "info": "Age 8. Loves art and dragons. Has done a little turtle drawing at "
+     "school. Goal: an animated story with their own characters."},
+    {"name": "advanced", "info": "Age 16. Comfortable with functions, lists and dicts, some classes. "
+     "Wants to make a web app that tracks their basketball stats."},
+]
 
 curcgpt_prompt = """
 You are an adaptive curriculum generator for 1:1 coding education. Your role is to:
@@ -86,22 +94,6 @@ You are an adaptive curriculum generator for 1:1 coding education. Your role is
   - Relevance: "Dictionaries → Store response templates"
 """
 
-# TODO: how do you ask questions to curc GPT before?
-
-message = input("> ")
-completion = client.models.generate_content(
-    model="gemini-2.5-flash",  # Use the model identifier from your custom endpoint
-    contents=message,
-    config=GenerateContentConfig(
-        system_instruction=[curcgpt_prompt],
-        response_mime_type="application/json",
-        response_schema=Curriculum,
-    ),
-)
-print(completion.text)
-
-print("============================================")
-
 curcgpt_prompt2 = """
 ### Curriculum Agent System Prompt  
 **Role**: You are an expert 1:1 coding curriculum generator. Your job is to create hyper-personalized lesson plans that adapt to student progress while relentlessly connecting concepts to their unique final project goal.  
@@ -273,17 +265,6 @@ Occasionally a prompt with some information about the student, or JSON in this f
 **Output ONLY valid JSON. No explanations.**  
 """
 
-completion2 = client.models.generate_content(
-    model="gemini-2.5-flash",  # Use the model identifier from your custom endpoint
-    contents=completion.text,
-    config=GenerateContentConfig(
-        system_instruction=[curcgpt_prompt2],
-        response_mime_type="application/json",
-        response_schema=Curriculum,
-    ),
-)
-print(completion2.text)
-
 curcgpt_prompt3 = """
 **Role**: You are an expert 1:1 coding curriculum generator specializing in creative, project-based learning. Your job is to design personalized learning paths that:
 1. Teach FUNDAMENTAL programming concepts FIRST (variables, conditionals, loops, functions)
@@ -444,19 +425,6 @@ curcgpt_prompt3 = """
 **Output ONLY valid JSON. No commentary.**
 """
 
-
-completion = client.models.generate_content(
-    model="gemini-2.5-flash",  # Use the model identifier from your custom endpoint
-    contents=message,
-    config=GenerateContentConfig(
-        system_instruction=[curcgpt_prompt3],
-        response_mime_type="application/json",
-        response_schema=Curriculum,
-    ),
-)
-print("=======================================================")
-print(completion.text)
-
 curcgpt_prompt4 = """
 **Role**: Creative coding curriculum architect specializing in project-based learning for children. Design personalized learning paths that:
 1. Teach FUNDAMENTAL programming concepts (variables, conditionals, loops, functions) through ANY domain tools
@@ -551,3 +519,156 @@ curcgpt_prompt4 = """
 - 20-40 min project time
 - Pure JSON output
 """
+
+VARIANTS = {
+    "current": current_prompt,
+    "v1": curcgpt_prompt,
+    "v2": curcgpt_prompt2,
+    "v3": curcgpt_prompt3,
+    "v4": curcgpt_prompt4,
+}
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+def load_fixtures(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_one(client, variant, profile, run):
+    """
+    One generation, timed and checked against the schema.
+    """
+    record = {"variant": variant, "profile": profile["name"], "run": run}
+    started = time.perf_counter()
+
+    try:
+        response = client.models.generate_content(
+            model=MODEL,
+            contents=profile["info"],
+            config=GenerateContentConfig(
+                system_instruction=[VARIANTS[variant]],
+                response_mime_type="application/json",
+                response_schema=Curriculum,
+            ),
+        )
+    except Exception as e:
+        # a call that never came back isn't the prompt's fault, it's
+        # counted apart from schema failures
+        record.update(latency=time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+        return record
+
+    record["latency"] = time.perf_counter() - started
+    text = response.text or ""
+    usage = response.usage_metadata
+    record.update(
+        prompt_tokens=getattr(usage, "prompt_token_count", None) or 0,
+        output_tokens=getattr(usage, "candidates_token_count", None) or 0,
+        thinking_tokens=getattr(usage, "thoughts_token_count", None) or 0,
+        output_bytes=len(text.encode()),
+        output=text,
+    )
+
+    try:
+        curriculum = Curriculum.model_validate_json(text)
+        record["schema_ok"] = True
+        record["classes"] = len(curriculum.classes)
+    except ValidationError as e:
+        record["schema_ok"] = False
+        record["schema_error"] = str(e).splitlines()[0]
+
+    return record
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(records):
+    """
+    Totals and averages for one variant's records.
+    """
+    answered = [record for record in records if "error" not in record]
+    latencies = [record["latency"] for record in answered]
+    summary = {
+        "calls": len(records),
+        "errors": len(records) - len(answered),
+        "schema_failures": sum(not record["schema_ok"] for record in answered),
+    }
+    if not answered:
+        return summary
+
+    summary.update(
+        schema_failure_rate=summary["schema_failures"] / len(answered),
+        latency_median=statistics.median(latencies),
+        latency_p90=percentile(latencies, 0.9),
+        latency_max=max(latencies),
+        prompt_tokens=statistics.mean(record["prompt_tokens"] for record in answered),
+        output_tokens=statistics.mean(record["output_tokens"] for record in answered),
+        thinking_tokens=statistics.mean(record["thinking_tokens"] for record in answered),
+        output_bytes=statistics.mean(record["output_bytes"] for record in answered),
+    )
+    return summary
+
+
+variants = flag("--variants", ",".join(VARIANTS)).split(",")
+for variant in variants:
+    if variant not in VARIANTS:
+        print(f"No variant {variant}, pick from {', '.join(VARIANTS)}")
+        exit(2)
+
+profiles = load_fixtures(argv[argv.index("--fixtures") + 1]) if "--fixtures" in argv else PROFILES
+runs = flag("--runs", 1)
+parallel = flag("--parallel", 8)
+output = flag("--output", f"curcgpt-results-{datetime.now():%Y%m%d-%H%M%S}.json")
+
+is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
+
+genai.models.Models.generate_content = retry.Retry(
+    predicate=is_retriable)(genai.models.Models.generate_content)
+
+client = genai.Client(
+    api_key=os.getenv("GEMINI_API_KEY"),
+    http_options={"base_url": os.getenv("GEMINI_BASE_URL")} if os.getenv("GEMINI_BASE_URL") else None,
+)
+
+jobs = [(variant, profile, run) for run in range(runs) for profile in profiles for variant in variants]
+print(f"{len(variants)} variants x {len(profiles)} profiles x {runs} run(s) = {len(jobs)} calls, "
+      f"{parallel} at a time")
+
+started = time.perf_counter()
+with ThreadPoolExecutor(max_workers=max(parallel, 1)) as pool:
+    records = list(pool.map(lambda job: run_one(client, *job), jobs))
+elapsed = time.perf_counter() - started
+
+summaries = {
+    variant: summarize([record for record in records if record["variant"] == variant])
+    for variant in variants
+}
+
+print(f"\n{'variant':<10} {'calls':>5} {'errors':>6} {'schema':>7} {'median':>7} {'p90':>7} "
+      f"{'in tok':>7} {'out tok':>7} {'think':>7} {'bytes':>7}")
+for variant, summary in summaries.items():
+    if "latency_median" not in summary:
+        print(f"{variant:<10} {summary['calls']:>5} {summary['errors']:>6}   (no answers)")
+        continue
+    print(f"{variant:<10} {summary['calls']:>5} {summary['errors']:>6} "
+          f"{summary['schema_failure_rate']:>6.0%} {summary['latency_median']:>6.1f}s "
+          f"{summary['latency_p90']:>6.1f}s {summary['prompt_tokens']:>7.0f} "
+          f"{summary['output_tokens']:>7.0f} {summary['thinking_tokens']:>7.0f} "
+          f"{summary['output_bytes']:>7.0f}")
+
+with open(output, "w", encoding="utf-8") as f:
+    json.dump({
+        "model": MODEL,
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "elapsed": elapsed,
+        "profiles": profiles,
+        "summary": summaries,
+        "runs": records,
+    }, f, indent=2, ensure_ascii=False)
+
+print(f"\n{len(records)} calls in {elapsed:.1f}s, results in {output}")
@@ -49,6 +49,245 @@ cur.execute(
     """
 )
 
+# bumped on every step transition so concurrent sessions on the same student
+# are detected instead of overwriting each other
+cur.execute(
+    """
+    ALTER TABLE students
+    ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+    """
+)
+
+# set by a refinement until the classwork for it is saved
+cur.execute(
+    """
+    ALTER TABLE students
+    ADD COLUMN IF NOT EXISTS refined BOOLEAN NOT NULL DEFAULT false;
+    """
+)
+
+# lets the student picker search names by prefix/similarity without a
+# full scan of students
+cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+
+cur.execute(
+    """
+    CREATE INDEX IF NOT EXISTS students_name_trgm_idx
+    ON students USING gin (name gin_trgm_ops);
+    """
+)
+
+# completed classes are moved here by `./codeabode.py archive` so the hot
+# table only holds what sessions actually touch
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS students_classes_archive (
+        LIKE students_classes
+    );
+    """
+)
+
+cur.execute(
+    """
+    ALTER TABLE students_classes_archive
+    ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ NOT NULL DEFAULT now();
+    """
+)
+
+cur.execute(
+    """
+    CREATE INDEX IF NOT EXISTS students_classes_archive_student_idx
+    ON students_classes_archive (student_id, class_id);
+    """
+)
+
+cur.execute(
+    """
+    CREATE INDEX IF NOT EXISTS students_classes_student_idx
+    ON students_classes (student_id, class_id);
+    """
+)
+
+# rolling summary of archived classes, fed to the refiner
+cur.execute(
+    """
+    ALTER TABLE students
+    ADD COLUMN IF NOT EXISTS history_summary TEXT;
+    """
+)
+
+# drafts generated ahead of time by `./codeabode.py worker`, one per kind for
+# each version of a student
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS student_drafts (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+        version INTEGER NOT NULL,
+        kind VARCHAR(15) NOT NULL, -- refine (step 1) or homework (step 2)
+        status VARCHAR(15) NOT NULL DEFAULT 'pending',
+        claimed_at TIMESTAMPTZ,
+        output JSONB,
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        UNIQUE (student_id, version, kind)
+    );
+    """
+)
+
+# set when the draft is queued again while it's being written (teacher notes
+# landing mid-draft), so it's redone instead of finishing with stale input
+cur.execute(
+    """
+    ALTER TABLE student_drafts
+    ADD COLUMN IF NOT EXISTS requeued BOOLEAN NOT NULL DEFAULT false;
+    """
+)
+
+# queue a draft when a student reaches a step, or when teacher notes land on
+# the class a step 2 student is waiting on, and wake the workers
+cur.execute(
+    """
+    CREATE OR REPLACE FUNCTION codeabode_queue_draft() RETURNS trigger AS $$
+    DECLARE
+        s students%ROWTYPE;
+    BEGIN
+        IF TG_TABLE_NAME = 'students' THEN
+            s := NEW;
+        ELSE
+            SELECT * INTO s FROM students WHERE id = NEW.student_id;
+            IF s.step IS DISTINCT FROM 2 OR s.current_class IS DISTINCT FROM NEW.class_id THEN
+                RETURN NULL;
+            END IF;
+        END IF;
+
+        IF s.step IN (1, 2) THEN
+            INSERT INTO student_drafts (student_id, version, kind)
+            VALUES (s.id, s.version, CASE s.step WHEN 1 THEN 'refine' ELSE 'homework' END)
+            ON CONFLICT (student_id, version, kind) DO UPDATE
+            SET status = CASE student_drafts.status WHEN 'running' THEN 'running' ELSE 'pending' END,
+            requeued = student_drafts.status = 'running'
+            WHERE student_drafts.status IN ('waiting', 'failed', 'done', 'running');
+
+            PERFORM pg_notify('codeabode_drafts', s.id::text);
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+)
+
+cur.execute("DROP TRIGGER IF EXISTS students_queue_draft ON students;")
+cur.execute(
+    """
+    CREATE TRIGGER students_queue_draft
+    AFTER INSERT OR UPDATE OF step ON students
+    FOR EACH ROW EXECUTE FUNCTION codeabode_queue_draft();
+    """
+)
+
+cur.execute("DROP TRIGGER IF EXISTS students_classes_queue_draft ON students_classes;")
+cur.execute(
+    """
+    CREATE TRIGGER students_classes_queue_draft
+    AFTER UPDATE OF notes ON students_classes
+    FOR EACH ROW
+    WHEN (OLD.notes IS DISTINCT FROM NEW.notes)
+    EXECUTE FUNCTION codeabode_queue_draft();
+    """
+)
+
+# parent emails, written in the same transaction as the step that triggers
+# them and delivered by `./codeabode.py send-mail`. one row per class per
+# account, so committing or queueing twice never emails twice.
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS email_outbox (
+        id SERIAL PRIMARY KEY,
+        student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+        class_id INTEGER NOT NULL,
+        account_id INTEGER NOT NULL,
+        kind VARCHAR(15) NOT NULL DEFAULT 'homework',
+        name TEXT,
+        address TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        status VARCHAR(15) NOT NULL DEFAULT 'pending', -- pending, sending, sent, failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt TIMESTAMPTZ NOT NULL DEFAULT now(),
+        claimed_at TIMESTAMPTZ,
+        sent_at TIMESTAMPTZ,
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        UNIQUE (class_id, account_id, kind)
+    );
+    """
+)
+
+# bodies queued since digests hold only the class's section, and get the
+# greeting and sign-off when they're sent. rows queued before that are whole
+# letters, left NULL here so they go out as they are.
+cur.execute(
+    """
+    ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS section BOOLEAN;
+    ALTER TABLE email_outbox ALTER COLUMN section SET DEFAULT true;
+    """
+)
+
+cur.execute(
+    """
+    CREATE INDEX IF NOT EXISTS email_outbox_pending_idx
+    ON email_outbox (next_attempt)
+    WHERE status IN ('pending', 'sending');
+    """
+)
+
+# generation work queued by `./codeabode.py jobs add` and run by `jobs work`.
+# kind is one of the headless steps, higher priority runs first.
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS generation_jobs (
+        id SERIAL PRIMARY KEY,
+        kind VARCHAR(15) NOT NULL,
+        student_id INTEGER REFERENCES students(id) ON DELETE CASCADE,
+        request JSONB NOT NULL,
+        save BOOLEAN NOT NULL DEFAULT false,
+        priority INTEGER NOT NULL DEFAULT 0,
+        status VARCHAR(15) NOT NULL DEFAULT 'queued', -- queued, running, done, failed
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+        lease_expires_at TIMESTAMPTZ,
+        result JSONB,
+        error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        finished_at TIMESTAMPTZ
+    );
+    """
+)
+
+cur.execute(
+    """
+    CREATE INDEX IF NOT EXISTS generation_jobs_due_idx
+    ON generation_jobs (priority DESC, id)
+    WHERE status IN ('queued', 'running');
+    """
+)
+
+# every model response a job got, so a retry after a crash reuses them
+cur.execute(
+    """
+    CREATE TABLE IF NOT EXISTS generation_outputs (
+        job_id INTEGER NOT NULL REFERENCES generation_jobs(id) ON DELETE CASCADE,
+        prompt_hash CHAR(64) NOT NULL,
+        text TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (job_id, prompt_hash)
+    );
+    """
+)
+
 conn.commit()
 
 cur.close()
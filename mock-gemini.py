@@ -0,0 +1,248 @@
+#!venv/bin/python3
+# a local stand-in for the Gemini API, so the agents can be load tested and
+# timed without a key and without the model's own variance. it speaks the
+# part of the REST API the agents use: generateContent (which chats use too,
+# with the history in contents), streamGenerateContent over SSE, and
+# structured output. requests with a Curriculum or CompletedClass schema get
+# a canned JSON answer of that shape, anything else gets canned markdown.
+#
+# latency is drawn per request from --latency:
+#   fixed:SECONDS, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA
+# and --errors injects API errors at a rate per status code, e.g.
+# 429=0.05,503=0.02. GET /stats has the counts so far.
+#
+# point the CLI at it with GEMINI_BASE_URL (any GEMINI_API_KEY will do):
+#
+#   ./mock-gemini.py --port 8400 &
+#   GEMINI_BASE_URL=http://127.0.0.1:8400 GEMINI_API_KEY=mock ./codeabode.py run new < request.json
+#
+# usage: ./mock-gemini.py [--host H] [--port N] [--latency DIST] [--errors CODE=RATE,...]
+#            [--chunks N] [--seed N]
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sys import argv
+
+CURRICULUM = {
+    "current_level": "Python: print, input and variables",
+    "final_goal": "A Pygame platformer with their own characters",
+    "notes": None,
+    "classes": [
+        {
+            "name": f"Class {i}: {topic}",
+            "description": f"Practice {topic} by adding to the platformer.",
+            "methods": methods,
+            "stretch_methods": None,
+        }
+        for i, (topic, methods) in enumerate([
+            ("conditionals", ["if", "elif", "else", "comparison operators"]),
+            ("while loops", ["while", "break", "game loop"]),
+            ("for loops", ["for", "range()", "nested loops"]),
+            ("lists", ["list.append()", "indexing", "len()"]),
+            ("functions", ["def", "parameters", "return"]),
+        ], 1)
+    ],
+    "future_concepts": ["dictionaries", "classes", "pygame.sprite", "collision detection",
+                        "game states", "sound"],
+}
+
+COMPLETED_CLASS = {
+    "notes": "Got through the class, needed help with nested conditions.",
+    "taught_methods": ["if", "elif", "else", "comparison operators"],
+    "needs_practice": ["elif"],
+}
+
+MARKDOWN = """# Class plan
+
+## Warm up (10 minutes)
+Print a greeting that uses the student's name from `input()`.
+
+## Main activity
+1. Ask for the player's health and store it in a variable.
+2. Use `if` / `elif` / `else` to print whether the player is healthy, hurt or out.
+3. Add a second check for a power up.
+
+```python
+health = int(input("Health: "))
+if health > 50:
+    print("Healthy")
+elif health > 0:
+    print("Hurt")
+else:
+    print("Game over")
+```
+
+## Homework
+Day 1-5: extend the health check with shields, lives and a score.
+"""
+
+STATUSES = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+def flag(name, default):
+    return type(default)(argv[argv.index(name) + 1]) if name in argv else default
+
+
+def latency_sampler(spec, rng):
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",")] if args else []
+
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        # the median, and sigma of the underlying normal
+        return lambda: values[0] * rng.lognormvariate(0, values[1])
+
+    print(f"Unknown latency distribution {spec}, use fixed:S, uniform:LOW,HIGH or lognormal:MEDIAN,SIGMA")
+    exit(2)
+
+
+def parse_errors(spec):
+    errors = {}
+    for pair in filter(None, spec.split(",")):
+        code, rate = pair.split("=")
+        errors[int(code)] = float(rate)
+    return errors
+
+
+def canned_text(body):
+    # the schema comes through as responseSchema or responseJsonSchema
+    # depending on the SDK version, its property names are enough either way
+    config = json.dumps(body.get("generationConfig", {}))
+    if '"taught_methods"' in config:
+        return "completed_class", json.dumps(COMPLETED_CLASS)
+    if '"future_concepts"' in config:
+        return "curriculum", json.dumps(CURRICULUM)
+    return "text", MARKDOWN
+
+
+def prompt_chars(body):
+    return sum(len(part.get("text", "")) for content in body.get("contents", [])
+               for part in content.get("parts", [])) + len(json.dumps(body.get("systemInstruction", "")))
+
+
+def response_json(text, prompt_tokens, output_tokens, model, finished=True):
+    response = {
+        "candidates": [{
+            "content": {"role": "model", "parts": [{"text": text}]},
+            "index": 0,
+        }],
+        "modelVersion": model,
+    }
+    if finished:
+        response["candidates"][0]["finishReason"] = "STOP"
+        response["usageMetadata"] = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+    return response
+
+
+class MockGemini(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with lock:
+                self.send_json(200, stats)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "not found", "status": "NOT_FOUND"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+        model, _, method = path.rsplit("/", 1)[-1].partition(":")
+
+        if method not in ("generateContent", "streamGenerateContent"):
+            self.send_json(404, {"error": {"code": 404, "message": f"no method {method}",
+                                           "status": "NOT_FOUND"}})
+            return
+
+        with lock:
+            delay = sample_latency()
+            roll = rng.random()
+
+        # an injected error still takes a little while, like a real one
+        for code, rate in errors.items():
+            if roll < rate:
+                time.sleep(min(delay, 0.05))
+                with lock:
+                    stats["errors"][str(code)] = stats["errors"].get(str(code), 0) + 1
+                self.send_json(code, {"error": {"code": code, "message": "injected by mock-gemini",
+                                                "status": STATUSES.get(code, "UNKNOWN")}})
+                return
+            roll -= rate
+
+        kind, text = canned_text(body)
+        prompt_tokens = prompt_chars(body) // 4
+        output_tokens = len(text) // 4
+
+        with lock:
+            stats["requests"][kind] = stats["requests"].get(kind, 0) + 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["output_tokens"] += output_tokens
+
+        if method == "generateContent":
+            time.sleep(delay)
+            self.send_json(200, response_json(text, prompt_tokens, output_tokens, model))
+            return
+
+        # time to the first chunk, then the rest spread over the remaining
+        # latency. a client that goes away mid stream is fine.
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        size = len(text) // chunks + 1
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        time.sleep(delay * 0.3)
+        try:
+            for i, piece in enumerate(pieces):
+                last = i == len(pieces) - 1
+                event = response_json(piece, prompt_tokens, output_tokens, model, finished=last)
+                self.wfile.write(f"data: {json.dumps(event)}\r\n\r\n".encode())
+                self.wfile.flush()
+                if not last:
+                    time.sleep(delay * 0.7 / len(pieces))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+rng = random.Random(flag("--seed", 0))
+sample_latency = latency_sampler(flag("--latency", "lognormal:1.0,0.5"), rng)
+errors = parse_errors(flag("--errors", ""))
+chunks = max(flag("--chunks", 8), 1)
+
+lock = threading.Lock()
+stats = {"requests": {}, "errors": {}, "prompt_tokens": 0, "output_tokens": 0}
+
+host, port = flag("--host", "127.0.0.1"), flag("--port", 8400)
+server = ThreadingHTTPServer((host, port), MockGemini)
+server.daemon_threads = True
+print(f"Mock Gemini on http://{host}:{port} (latency {flag('--latency', 'lognormal:1.0,0.5')}, "
+      f"errors {errors or 'none'})", flush=True)
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()